@@ -1,5 +1,6 @@
 import os
 from sqlalchemy import create_engine
+from sqlalchemy.engine import URL, make_url
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
@@ -21,6 +22,50 @@ engine = create_engine(
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# 非同期エンジン（DATABASE_ASYNC=true の場合のみ、診断APIの保存処理で使う）
+# PostgreSQL は asyncpg、SQLite は aiosqlite で接続する
+DATABASE_ASYNC = os.getenv("DATABASE_ASYNC", "false").lower() == "true"
+
+def to_async_url(url: str) -> URL:
+    """同期ドライバのURLを非同期ドライバのURLに変換"""
+    url = make_url(url)
+    if url.get_backend_name() == "postgresql":
+        # asyncpg は sslmode を受け付けないため ssl に読み替える
+        query = dict(url.query)
+        if "sslmode" in query:
+            query["ssl"] = query.pop("sslmode")
+        return url.set(drivername="postgresql+asyncpg", query=query)
+    if url.get_backend_name() == "sqlite":
+        return url.set(drivername="sqlite+aiosqlite")
+    return url
+
+async_engine = None
+AsyncSessionLocal = None
+if DATABASE_ASYNC:
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+    async_url = to_async_url(DATABASE_URL)
+    if async_url.get_backend_name() == "sqlite":
+        # SQLite は書き込みが1本ずつのため、接続を1本にしてイベントループ上で順番待ちさせる
+        # （接続ごとに書き込みロックを取り合うと database is locked になる）
+        pool_options = dict(poolclass=AsyncAdaptedQueuePool, pool_size=1, max_overflow=0, pool_timeout=60)
+    else:
+        # 1ワーカーで多数のリクエストが同時にDBを待つため、同期より大きいプールを持つ
+        pool_options = dict(
+            pool_size=int(os.getenv("DATABASE_POOL_SIZE", "20")),
+            max_overflow=int(os.getenv("DATABASE_MAX_OVERFLOW", "20")),
+            pool_timeout=30,
+        )
+    async_engine = create_async_engine(
+        async_url,
+        pool_pre_ping=True,
+        pool_recycle=300,
+        **pool_options,
+    )
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 def get_db():
     db = SessionLocal()
     try:
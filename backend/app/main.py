@@ -1,18 +1,60 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from starlette.concurrency import run_in_threadpool
+from typing import Dict, List, Optional, Union
+import json
+import os
+import random
 import uuid
 
-from app.database.config import get_db, engine, Base
+from app.database.config import get_db, engine, Base, SessionLocal, AsyncSessionLocal
 from app.models import models
-from app.services.inference_engine import InferenceEngine, WorkingMemory, Rule, AnswerType, RuleStatus
-from app.services.visa_rules import VISA_RULES, VISA_GOALS
+from app.services.consultation_persistence import ConsultationPersistence, working_memory_columns
+from app.services.consultation_writer import (
+    WriteBehindPersistence, DEFAULT_BATCH_SIZE, DEFAULT_FLUSH_INTERVAL, DEFAULT_QUEUE_SIZE,
+    DURABILITY_COMPLETION, ON_FULL_BLOCK, SessionNotSaved
+)
+from app.services.inference_engine import (
+    InferenceEngine, RuleBase, Rule, AnswerType, RuleStatus, EVALUATION_MODE_AGENDA
+)
+from app.services.question_selector import (
+    AnswerPriors, AnswerPriorsRefresher, ResolutionCountSelector, QUESTION_SELECTORS,
+    QUESTION_SELECTOR_HEURISTIC, QUESTION_SELECTOR_RESOLUTION_COUNT
+)
+from app.services.question_table import load_question_tables, table_key
+from app.services.rule_cache import cached_response
+from app.services.rule_validator import IncrementalRuleValidator
+from app.services.rulebase_store import (
+    RuleBaseRegistry, RuleSet, RuleSetSessionCodec, RuleSetTokenCodec, update_rule_row,
+    DEFAULT_POLL_INTERVAL, DEFAULT_RETAIN
+)
+from app.services.session_state import (
+    changes_since, record_state_step, DEFAULT_STATE_LOG_SIZE
+)
+from app.services.session_store import (
+    create_session_store, DEFAULT_CACHE_SIZE, DEFAULT_IDLE_TTL, DEFAULT_MAX_SESSIONS, SESSION_STORE_MEMORY
+)
+from app.services.session_sweeper import SessionSweeper, DEFAULT_SWEEP_INTERVAL
+from app.services.session_token import (
+    DEFAULT_TOKEN_TTL, InvalidSessionToken, SessionTokenExpired, SessionTokenMismatch,
+    SESSION_MODE_MEMORY, SESSION_MODE_TOKEN
+)
+from app.services.visa_rules import VISA_RULES, VISA_GOALS, VISA_TYPE_GOALS
 from app.routers import admin
-from pydantic import BaseModel
+from pydantic import BaseModel, ValidationError
 
 # データベーステーブル作成
 Base.metadata.create_all(bind=engine)
+# 既存のテーブルに後から追加したインデックス（create_all は既存のテーブルにインデックスを追加しない）
+for index in models.ConsultationAnswer.__table__.indexes:
+    index.create(bind=engine, checkfirst=True)
+# 既存の rules テーブルに後から追加した列（create_all は既存のテーブルに列を追加しない）
+if "version" not in {column["name"] for column in inspect(engine).get_columns("rules")}:
+    with engine.begin() as connection:
+        connection.execute(text("ALTER TABLE rules ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
 
 app = FastAPI(title="Visa Expert System API", version="1.0.0")
 
@@ -31,16 +73,41 @@ app.include_router(admin.router)
 # ===== Pydanticモデル =====
 class ConsultationStartRequest(BaseModel):
     visa_types: Optional[List[str]] = ["E", "B", "L"]  # システムイメージ.txt 行21準拠
+    question_selector: Optional[str] = None  # heuristic / resolution_count（未指定はサーバー設定）
+    include_state: bool = False  # ルール状態・作業記憶（全体）をレスポンスに含める
+
+class SessionStateResponse(BaseModel):
+    """ルール状態・作業記憶の差分または全体（app.services.session_state）"""
+    version: int  # 適用後の状態の版
+    full: bool  # True: 全体（置き換える） / False: 直前の版からの差分
+    rule_statuses: Dict[int, str] = {}
+    findings: Dict[str, bool] = {}
+    hypotheses: Dict[str, bool] = {}
+    removed_findings: List[str] = []
+    removed_hypotheses: List[str] = []
+    conflict_set: Optional[List[int]] = None  # 変化した場合のみ（全体では常に）
+
+class RuleStatusChangesResponse(BaseModel):
+    """?since= 指定時のルール状態の変更（変更履歴で足りなければ full=True で全ルール）"""
+    version: int
+    full: bool
+    rule_statuses: Dict[int, str] = {}
 
 class ConsultationStartResponse(BaseModel):
     session_id: str
     next_question: Optional[str]
     message: str
+    question_selector: str = QUESTION_SELECTOR_HEURISTIC
+    session_token: Optional[str] = None  # ステートレスモードのセッショントークン
+    state: Optional[SessionStateResponse] = None  # include_state の場合のみ
 
 class AnswerRequest(BaseModel):
     session_id: str
     fact: str
     answer: str  # "yes", "no", "unknown"
+    session_token: Optional[str] = None  # ステートレスモードでは必須
+    include_state: bool = False  # ルール状態・作業記憶の差分をレスポンスに含める
+    state_version: Optional[int] = None  # クライアントが最後に受け取った状態の版（一致しなければ全体を返す）
 
 class AnswerResponse(BaseModel):
     session_id: str
@@ -51,15 +118,47 @@ class AnswerResponse(BaseModel):
     result: Optional[dict]
     detail_questions_needed: bool = False
     detail_questions: List[str] = []
+    invalidated_rules: int = 0  # この回答で連鎖的に無効化されたルール数
+    session_token: Optional[str] = None  # ステートレスモードの更新後のセッショントークン
+    state: Optional[SessionStateResponse] = None  # include_state の場合のみ
+
+class AnswerItem(BaseModel):
+    fact: str
+    answer: str  # "yes", "no", "unknown"
+
+class BatchAnswerRequest(BaseModel):
+    session_id: str
+    answers: List[AnswerItem]
+    session_token: Optional[str] = None
+    include_state: bool = False
+    state_version: Optional[int] = None
+
+class BatchAnswerResponse(BaseModel):
+    session_id: str
+    next_question: Optional[str]
+    fired_rules: List[int]
+    derived_facts: List[str]
+    is_completed: bool
+    result: Optional[dict]
+    answered_count: int  # 記録された回答数（詳細質問待ちの回答を除く）
+    detail_questions: List[str] = []  # 「わからない」と回答された導出可能な事実の詳細質問
+    invalidated_rules: int = 0
+    session_token: Optional[str] = None
+    state: Optional[SessionStateResponse] = None
 
 class UndoRequest(BaseModel):
     session_id: str
+    session_token: Optional[str] = None
+    include_state: bool = False
+    state_version: Optional[int] = None
 
 class UndoResponse(BaseModel):
     session_id: str
     next_question: Optional[str]
     message: str
     can_undo: bool
+    session_token: Optional[str] = None
+    state: Optional[SessionStateResponse] = None
 
 class RuleResponse(BaseModel):
     id: int
@@ -70,22 +169,300 @@ class RuleResponse(BaseModel):
     status: str  # not_evaluated, evaluating, fired, failed, skipped
 
 # ===== グローバル変数 =====
-# セッションごとの推論エンジンとWorkingMemoryを保持
-sessions = {}
-
-# ルールを推論エンジン用のRuleオブジェクトに変換
-inference_rules = [
-    Rule(
-        id=r["id"],
-        name=r["name"],
-        visa_type=r["visa_type"],
-        rule_type=r["rule_type"],
-        conditions=r["conditions"],
-        actions=r["actions"],
-        flag=r["flag"]
+# ルール評価モード（scan: 回答ごとに全ルール走査 / agenda: 変化した事実に依存するルールのみ評価）
+EVALUATION_MODE = os.getenv("INFERENCE_EVALUATION_MODE", EVALUATION_MODE_AGENDA)
+# 作業記憶を事実IDのビットマスクで保持するか（セッションあたりのメモリ削減）
+COMPACT_WORKING_MEMORY = os.getenv("COMPACT_WORKING_MEMORY", "true").lower() == "true"
+
+# 事前コンパイルした質問決定表（python -m app.services.question_table で作成）
+# 未設定またはルールベースと一致しない表は使わず、推論エンジンで次の質問を計算する
+QUESTION_TABLE_DIR = os.getenv("QUESTION_TABLE_DIR", "")
+
+# 質問選択方式（heuristic: 加算スコア / resolution_count: 過去の回答分布で確定する候補数の期待値）
+# 開始時に指定のないセッションは QUESTION_SELECTOR を使い、
+# RESOLUTION_COUNT_SESSION_RATIO の割合だけ resolution_count に割り当てる（A/Bテスト用）
+QUESTION_SELECTOR = os.getenv("QUESTION_SELECTOR", QUESTION_SELECTOR_HEURISTIC)
+RESOLUTION_COUNT_SESSION_RATIO = float(os.getenv("RESOLUTION_COUNT_SESSION_RATIO", "0"))
+# 回答分布は一定間隔でのみ consultation_answers から集計し直す
+ANSWER_PRIOR_REFRESH_SECONDS = float(os.getenv("ANSWER_PRIOR_REFRESH_SECONDS", "300"))
+
+def build_rule_set(version: int, rules: List[dict]) -> RuleSet:
+    """
+    ルール定義からコンパイル済みルールベースと推論エンジン等を作る
+    （その版で開始した全セッションで読み取り専用として共有する）
+    """
+    rule_base = RuleBase([Rule.from_dict(r) for r in rules], version=version)
+    return RuleSet(
+        version, rules,
+        engine=InferenceEngine(rule_base, evaluation_mode=EVALUATION_MODE),
+        question_tables=load_question_tables(QUESTION_TABLE_DIR, rule_base),
+        resolution_count_selector=ResolutionCountSelector(rule_base),
+        answer_priors=AnswerPriors(rule_base.fact_table, refresh_interval=ANSWER_PRIOR_REFRESH_SECONDS)
+    )
+
+# セッションの保持方式（memory: サーバーのメモリ / token: 署名付きトークンでクライアントに持たせる）
+# token ではどのワーカー・インスタンスでもセッションを継続できる（全インスタンスで同じ署名鍵を設定する）
+SESSION_MODE = os.getenv("SESSION_MODE", SESSION_MODE_MEMORY)
+
+# セッションごとのWorkingMemoryとゴール・回答履歴の保存先（推論エンジンは全セッションで共有）
+# memory: プロセス内の辞書 / sqlite: 同じホストのワーカーで共有 / redis: 複数インスタンスで共有
+# sqlite・redis ではワーカーごとに最近のセッションを SESSION_CACHE_SIZE 件までキャッシュし、回答ごとに書き通す
+# memory では SESSION_IDLE_TTL_SECONDS 秒アクセスのないセッションと、SESSION_MAX_COUNT を超えた分の
+# 最終アクセスが最も古いセッションを追い出す（0 は無制限）
+# ステートレスモードでは使わない（セッションはトークンとしてクライアントが持つ）
+SESSION_STORE = os.getenv("SESSION_STORE", SESSION_STORE_MEMORY)
+
+# ルールベース（rules テーブルから読み込む。テーブルが空なら VISA_RULES を初期データとして入れる）
+# RULEBASE_POLL_SECONDS ごとにルールベースの版を確認し、他のワーカーでの変更を取り込む（0 は確認しない）
+# 診断セッションは開始時のルールベースで最後まで診断し、古いルールベースは参照するセッションがなくなれば回収する
+# RULEBASE_RETAIN: トークン・共有ストアのセッション（ルールベースへの参照を持たない）のために残しておく直近の版の数
+SERIALIZED_SESSIONS = SESSION_MODE == SESSION_MODE_TOKEN or SESSION_STORE != SESSION_STORE_MEMORY
+rule_registry = RuleBaseRegistry(
+    SessionLocal, build_rule_set,
+    poll_interval=float(os.getenv("RULEBASE_POLL_SECONDS", str(DEFAULT_POLL_INTERVAL))),
+    retain=int(os.getenv("RULEBASE_RETAIN", str(DEFAULT_RETAIN))) if SERIALIZED_SESSIONS else 0,
+    seed=VISA_RULES
+)
+rule_registry.load()
+# resolution_count の質問選択で使う回答確率の集計（リクエスト処理とは別のスレッドで、古くなったら集計し直す）
+answer_prior_refresher = AnswerPriorsRefresher(lambda: rule_registry.current.answer_priors, SessionLocal)
+# 管理APIの整合性チェック（索引と結果を保持し、ルールの変更ごとに影響する範囲だけを検証し直す。初回の利用時に構築する）
+rule_validator = IncrementalRuleValidator()
+
+session_token_codec = None
+if SESSION_MODE == SESSION_MODE_TOKEN:
+    SESSION_TOKEN_SECRET = os.getenv("SESSION_TOKEN_SECRET", "")
+    if not SESSION_TOKEN_SECRET:
+        raise RuntimeError("SESSION_MODE=token には SESSION_TOKEN_SECRET の設定が必要です")
+    SESSION_TOKEN_TTL_SECONDS = int(os.getenv("SESSION_TOKEN_TTL_SECONDS", str(DEFAULT_TOKEN_TTL)))
+    session_token_codec = RuleSetTokenCodec(
+        rule_registry, SESSION_TOKEN_SECRET.encode("utf-8"), ttl=SESSION_TOKEN_TTL_SECONDS
+    )
+
+# トークン・共有ストアにはセッションを開始時のルールベースの事実IDで詰める
+sessions = create_session_store(
+    SESSION_STORE,
+    RuleSetSessionCodec(rule_registry),
+    location=os.getenv("SESSION_STORE_URL", ""),
+    cache_size=int(os.getenv("SESSION_CACHE_SIZE", str(DEFAULT_CACHE_SIZE))),
+    idle_ttl=float(os.getenv("SESSION_IDLE_TTL_SECONDS", str(DEFAULT_IDLE_TTL))),
+    max_sessions=int(os.getenv("SESSION_MAX_COUNT", str(DEFAULT_MAX_SESSIONS)))
+)
+# セッションごとに残すステップの差分の数（?since= と差分レスポンス用、これより古い版からは全体を返す）
+STATE_LOG_SIZE = int(os.getenv("SESSION_STATE_LOG_SIZE", str(DEFAULT_STATE_LOG_SIZE)))
+# 追い出したセッションをDB上で abandoned にするバックグラウンドの掃除
+session_sweeper = SessionSweeper(
+    sessions, SessionLocal,
+    interval=float(os.getenv("SESSION_SWEEP_INTERVAL_SECONDS", str(DEFAULT_SWEEP_INTERVAL)))
+)
+# 診断APIのDB保存（DATABASE_ASYNC=true では非同期ドライバ、それ以外はスレッドプールで同期ドライバを使う）
+# CONSULTATION_PERSISTENCE=write_behind では回答をキューに積んで応答し、書き込みスレッドがまとめて保存する
+# （耐久性は WRITE_BEHIND_DURABILITY、キューが一杯のときの扱いは WRITE_BEHIND_ON_FULL、詳細は consultation_writer）
+CONSULTATION_PERSISTENCE = os.getenv("CONSULTATION_PERSISTENCE", "immediate")
+if CONSULTATION_PERSISTENCE == "write_behind":
+    consultation_persistence = WriteBehindPersistence(
+        SessionLocal, AsyncSessionLocal,
+        queue_size=int(os.getenv("WRITE_BEHIND_QUEUE_SIZE", str(DEFAULT_QUEUE_SIZE))),
+        batch_size=int(os.getenv("WRITE_BEHIND_BATCH_SIZE", str(DEFAULT_BATCH_SIZE))),
+        flush_interval=float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL_SECONDS", str(DEFAULT_FLUSH_INTERVAL))),
+        durability=os.getenv("WRITE_BEHIND_DURABILITY", DURABILITY_COMPLETION),
+        on_full=os.getenv("WRITE_BEHIND_ON_FULL", ON_FULL_BLOCK)
     )
-    for r in VISA_RULES
-]
+else:
+    consultation_persistence = ConsultationPersistence(SessionLocal, AsyncSessionLocal)
+# 管理APIからセッション数・メモリの概算を参照できるようにする
+app.state.session_store = sessions
+app.state.session_sweeper = session_sweeper
+app.state.consultation_persistence = consultation_persistence
+app.state.rule_registry = rule_registry
+app.state.rule_validator = rule_validator
+
+@app.on_event("startup")
+def start_session_sweeper():
+    if session_token_codec is None:
+        session_sweeper.start()
+    if isinstance(consultation_persistence, WriteBehindPersistence):
+        consultation_persistence.start()
+    rule_registry.start()
+    answer_prior_refresher.start()
+
+@app.on_event("shutdown")
+def stop_session_sweeper():
+    session_sweeper.stop()
+    rule_registry.stop()
+    answer_prior_refresher.stop()
+    # キューに残った回答をすべて保存してから止める
+    if isinstance(consultation_persistence, WriteBehindPersistence):
+        consultation_persistence.stop()
+
+def choose_question_selector(requested: Optional[str]) -> str:
+    """セッションの質問選択方式を決める"""
+    if requested is not None:
+        if requested not in QUESTION_SELECTORS:
+            raise HTTPException(status_code=400, detail=f"不正な質問選択方式です: {requested}")
+        return requested
+    if RESOLUTION_COUNT_SESSION_RATIO > 0 and random.random() < RESOLUTION_COUNT_SESSION_RATIO:
+        return QUESTION_SELECTOR_RESOLUTION_COUNT
+    return QUESTION_SELECTOR
+
+def get_next_question(engine: InferenceEngine, session: dict) -> Optional[str]:
+    """次の質問（質問決定表の範囲内なら表から引き、範囲外なら推論エンジンで計算）"""
+    if session.get("question_selector") == QUESTION_SELECTOR_RESOLUTION_COUNT:
+        rule_set = session["rule_set"]
+        return rule_set.resolution_count_selector.select(
+            engine, session["goals"], session["wm"], rule_set.answer_priors
+        )
+    table = session.get("question_table")
+    node = session.get("question_node")
+    if table is not None and node is not None and table.fingerprint == engine.rule_base.fingerprint:
+        return table.question(node)
+    return engine.get_next_question(session["goals"], session["wm"])
+
+def advance_question_node(session: dict, fact: str, answer_type: AnswerType):
+    """回答に合わせて質問決定表のノードを進める（範囲外になったら以降は推論エンジンで計算）"""
+    table = session.get("question_table")
+    node = session.get("question_node")
+    if table is not None and node is not None:
+        node = table.step(node, fact, answer_type)
+    session["question_node"] = node
+
+def finish_state_step(session: dict, trails: Optional[List[list]]):
+    """状態の版を進め、ステップのトレイルから作った差分を変更履歴に残す（変更履歴がある場合のみ）"""
+    record_state_step(session, trails, session["wm"])
+
+def state_changes(session: dict, since: Optional[int]) -> dict:
+    """
+    クライアントの版より後の差分（変更履歴で足りなければ全体。ルールはセッションのルールベースのもの）
+    初めて呼ばれた時にセッションの変更履歴を作る
+    """
+    return changes_since(session, since, session["rule_set"].rule_base.rules, STATE_LOG_SIZE)
+
+def build_step_state(session: dict, include_state: bool, client_version: Optional[int]) -> Optional[dict]:
+    """レスポンスに含める状態（クライアントの版より後の差分、変更履歴で足りなければ全体）"""
+    if not include_state:
+        return None
+    return state_changes(session, client_version)
+
+def state_etag(session: dict, resource: str) -> str:
+    """セッションの状態の版によるETag（ルール定義の変更も反映するためルールベースの指紋を含める）"""
+    fingerprint = session["rule_set"].rule_base.fingerprint
+    return f'"{resource}-{session.get("state_version", 0)}-{fingerprint[:12]}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """If-None-Match がこのETagを含むか"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    return any(tag.strip() in ("*", etag, "W/" + etag) for tag in header.split(","))
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+def load_session(session_id: str, session_token: Optional[str]) -> dict:
+    """セッションを取得（ステートレスモードではトークンから復元）"""
+    if session_token_codec is None:
+        try:
+            session = sessions.get(session_id)
+        except SessionTokenMismatch as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        if session is None:
+            raise HTTPException(status_code=404, detail="セッションが見つかりません")
+        if "question_table" not in session:
+            attach_question_table(session)
+        return session
+
+    if not session_token:
+        raise HTTPException(status_code=400, detail="セッショントークンがありません")
+    try:
+        token_session_id, session = session_token_codec.decode(session_token)
+    except SessionTokenMismatch as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except SessionTokenExpired as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    except InvalidSessionToken:
+        raise HTTPException(status_code=401, detail="セッショントークンが不正です")
+    if token_session_id != session_id:
+        raise HTTPException(status_code=401, detail="セッションIDとセッショントークンが一致しません")
+    attach_question_table(session)
+    return session
+
+def attach_question_table(session: dict):
+    """
+    トークン・共有ストアから復元したセッションに質問決定表を付け直す
+    （このインスタンスで読み込んだ表を引き直し、なければ推論エンジンで計算する）
+    """
+    question_table = None
+    if session["question_selector"] == QUESTION_SELECTOR_HEURISTIC:
+        question_table = session["rule_set"].question_tables.get(table_key(session["goals"]))
+    node = session["question_node"]
+    if question_table is None or node is not None and node >= len(question_table):
+        node = None
+    session["question_table"] = question_table
+    session["question_node"] = node
+
+def save_session(session_id: str, session: dict) -> Optional[str]:
+    """
+    更新後のセッションを保存する（共有ストアには書き通す）
+    Returns: ステートレスモードでは更新後のセッショントークン、それ以外は None
+    """
+    if session_token_codec is None:
+        sessions.put(session_id, session)
+        return None
+    return session_token_codec.encode(session_id, session)
+
+async def load_session_async(session_id: str, session_token: Optional[str]) -> dict:
+    """load_session の非同期版（共有ストアの読み込みはスレッドプールで行い、イベントループを止めない）"""
+    if session_token_codec is None and SESSION_STORE != SESSION_STORE_MEMORY:
+        return await run_in_threadpool(load_session, session_id, session_token)
+    return load_session(session_id, session_token)
+
+async def save_session_async(session_id: str, session: dict) -> Optional[str]:
+    """save_session の非同期版（共有ストアへの書き込みはスレッドプールで行う）"""
+    if session_token_codec is None and SESSION_STORE != SESSION_STORE_MEMORY:
+        return await run_in_threadpool(save_session, session_id, session)
+    return save_session(session_id, session)
+
+def replay_answer_history(engine: InferenceEngine, session: dict):
+    """
+    回答履歴を最初から適用し直して作業記憶と質問決定表の位置を復元する
+    （トークン・共有ストアから復元したセッションの戻る機能用、これらには回答ごとの差分を保存しない）
+    一括回答は記録してから1回だけ評価する（途中まで戻った一括回答も同じ）。
+    """
+    wm = session["wm"] = engine.create_working_memory(compact=True)
+    session["question_node"] = 0 if session.get("question_table") is not None else None
+    answer_history = session["answer_history"]
+    i = 0
+    while i < len(answer_history):
+        batch_id = answer_history[i].get("batch_id")
+        if batch_id is None:
+            entry = answer_history[i]
+            answer_type = AnswerType(entry["answer"].lower())
+            engine.process_answer(entry["fact"], answer_type, wm)
+            advance_question_node(session, entry["fact"], answer_type)
+            i += 1
+            continue
+
+        recorded = []
+        while i < len(answer_history) and answer_history[i].get("batch_id") == batch_id:
+            entry = answer_history[i]
+            answer_type = AnswerType(entry["answer"].lower())
+            if engine.record_answer(entry["fact"], answer_type, wm) is None:
+                recorded.append((entry["fact"], answer_type))
+            i += 1
+        engine.settle_answers(recorded, wm)
+        session["question_node"] = None
+
+def build_diagnosis_result(engine: InferenceEngine, goals: List[str], wm) -> dict:
+    """ゴール達成状況から診断結果を作成"""
+    goal_results = engine.check_goals(goals, wm)
+    achieved_goals = [goal for goal, achieved in goal_results.items() if achieved]
+
+    return {
+        "applicable_visas": achieved_goals,
+        "all_goals": goal_results,
+        "findings": dict(wm.findings),
+        "hypotheses": dict(wm.hypotheses)
+    }
 
 # ===== APIエンドポイント =====
 @app.get("/")
@@ -96,248 +473,493 @@ def read_root():
 def health_check():
     return {"status": "healthy"}
 
-@app.post("/api/consultation/start", response_model=ConsultationStartResponse)
-def start_consultation(request: ConsultationStartRequest, db: Session = Depends(get_db)):
-    """診断セッションを開始"""
+# ===== 診断の各ステップ（REST・WebSocket で共通） =====
+async def open_consultation(visa_types: List[str], requested_selector: Optional[str]):
+    """
+    診断セッションを作成
+    Returns: (セッションID, セッション, 最初の質問)
+    """
     session_id = str(uuid.uuid4())
-
-    # 推論エンジンとWorkingMemoryを初期化
-    engine = InferenceEngine(inference_rules)
-    wm = WorkingMemory()
+    # セッションは開始時のルールベースに固定する（途中でルールが変更されても同じルールで診断を続ける）
+    rule_set = rule_registry.current
+    question_selector = choose_question_selector(requested_selector)
+
+    # WorkingMemoryを初期化（推論エンジンは共有のものを使う）
+    # トークン・共有ストアには事実IDのビットマスクで詰めるため、その場合は常にビットマスク版
+    engine = rule_set.engine
+    wm = engine.create_working_memory(
+        compact=COMPACT_WORKING_MEMORY or session_token_codec is not None or SESSION_STORE != SESSION_STORE_MEMORY
+    )
 
     # visa_typesに基づいてゴールをフィルタリング
     filtered_goals = []
-    visa_type_map = {
-        "E": ["Eビザでの申請ができます"],
-        "L": ["Blanket Lビザでの申請ができます", "Lビザ（Individual）での申請ができます"],
-        "B": ["Bビザの申請ができます", "契約書に基づくBビザの申請ができます",
-              "B-1 in lieu of H-1Bビザの申請ができます", "B-1 in lieu of H3ビザの申請ができます"],
-        "H-1B": ["H-1Bビザでの申請ができます"],
-        "J-1": ["J-1ビザの申請ができます"]
-    }
-
-    for visa_type in request.visa_types:
-        if visa_type in visa_type_map:
-            filtered_goals.extend(visa_type_map[visa_type])
+    for visa_type in visa_types:
+        if visa_type in VISA_TYPE_GOALS:
+            filtered_goals.extend(VISA_TYPE_GOALS[visa_type])
 
     # セッション保存（システムイメージ.txt 行25-31: 回答履歴管理）
-    sessions[session_id] = {
-        "engine": engine,
+    # 質問決定表は加算スコアの質問順をコンパイルしたもの
+    question_table = None
+    if question_selector == QUESTION_SELECTOR_HEURISTIC:
+        question_table = rule_set.question_tables.get(table_key(filtered_goals))
+    session = {
+        "rule_set": rule_set,  # 開始時のルールベース（推論エンジン・質問決定表等）
         "wm": wm,
-        "visa_types": request.visa_types,
+        "visa_types": visa_types,
         "goals": filtered_goals,  # フィルタリングされたゴール
-        "answer_history": []  # 回答履歴スタック（戻る機能用）
+        "answer_history": [],  # 回答履歴スタック（戻る機能用）
+        "question_selector": question_selector,
+        "question_table": question_table,  # このゴールの組み合わせの質問決定表（なければ None）
+        "question_node": 0 if question_table is not None else None,  # 質問決定表上の現在位置
+        "state_version": 0  # 回答・戻るのたびに進める状態の版（差分レスポンス用）
     }
 
     # データベースにセッション保存
-    db_session = models.ConsultationSession(
-        session_id=session_id,
-        visa_types=request.visa_types,
-        status="in_progress"
-    )
-    db.add(db_session)
-    db.commit()
+    # 主キーをセッションに持たせ、以降の保存は主キーで引く（トークン・共有ストアには含めない）
+    session["db_id"] = await consultation_persistence.create_session(session_id, visa_types)
 
     # 最初の質問を取得
-    next_question = engine.get_next_question(filtered_goals, wm)
-
-    return ConsultationStartResponse(
-        session_id=session_id,
-        next_question=next_question,
-        message="診断を開始しました"
-    )
-
-@app.post("/api/consultation/answer", response_model=AnswerResponse)
-def answer_question(request: AnswerRequest, db: Session = Depends(get_db)):
-    """質問に回答"""
-    session_id = request.session_id
-
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="セッションが見つかりません")
+    return session_id, session, get_next_question(engine, session)
 
-    session = sessions[session_id]
-    engine = session["engine"]
+async def apply_answer(session_id: str, session: dict, fact: str, answer: str) -> dict:
+    """
+    質問への回答を適用
+    Returns: AnswerResponse の項目（session_id・session_token・state を除く）
+    """
+    engine = session["rule_set"].engine
     wm = session["wm"]
     goals = session["goals"]
     answer_history = session["answer_history"]
 
-    # 回答処理の前の状態をスナップショット（戻る機能用）
-    wm_snapshot_before = {
-        "findings": dict(wm.findings),
-        "hypotheses": dict(wm.hypotheses),
-        "conflict_set": set(wm.conflict_set),
-        "evaluated_rules": dict(wm.evaluated_rules),
-        "skipped_facts": set(wm.skipped_facts),
-        "asked_derivable_facts": set(wm.asked_derivable_facts)
+    # 回答を処理（この回答による作業記憶の変更を差分として記録、戻る機能用）
+    answer_type = AnswerType(answer.lower())
+    with wm.journal() as trail:
+        result = engine.process_answer(fact, answer_type, wm)
+
+    # 回答履歴の項目（処理前の状態に戻すための差分と質問決定表の位置を保存）
+    question_node = session.get("question_node")
+    entry = {
+        "fact": fact,
+        "answer": answer,
+        "trail": trail,
+        "question_node": question_node
     }
-
-    # 回答を処理
-    answer_type = AnswerType(request.answer.lower())
-    result = engine.process_answer(request.fact, answer_type, wm)
-
-    # 回答履歴に追加（処理前の状態を保存）
-    answer_history.append({
-        "fact": request.fact,
-        "answer": request.answer,
-        "wm_snapshot_before": wm_snapshot_before
-    })
+    advance_question_node(session, fact, answer_type)
 
     # 「わからない」回答で詳細質問が必要な場合
     if result.get("detail_questions_needed", False):
+        answer_history.append(entry)
+        finish_state_step(session, [trail])
         # 詳細質問を返す（診断は継続）
-        return AnswerResponse(
-            session_id=session_id,
-            next_question=result["detail_questions"][0] if result["detail_questions"] else None,
-            fired_rules=[],
-            derived_facts=[],
-            is_completed=False,
-            result=None,
-            detail_questions_needed=True,
-            detail_questions=result["detail_questions"]
-        )
-
-    # データベースに回答を保存
-    db_session = db.query(models.ConsultationSession).filter(
-        models.ConsultationSession.session_id == session_id
-    ).first()
-
-    if db_session:
-        # 回答履歴を追加
-        answer_record = models.ConsultationAnswer(
-            session_id=db_session.id,
-            fact_name=request.fact,
-            answer=request.answer,
-            question_order=len(db_session.answers) + 1
-        )
-        db.add(answer_record)
-
-        # セッション情報を更新
-        db_session.findings = wm.findings
-        db_session.hypotheses = wm.hypotheses
-        db_session.evaluated_rules = [rule_id for rule_id, status in wm.evaluated_rules.items()]
-        db_session.fired_rules = list(wm.conflict_set)
-
-        db.commit()
+        return {
+            "next_question": result["detail_questions"][0] if result["detail_questions"] else None,
+            "fired_rules": [],
+            "derived_facts": [],
+            "is_completed": False,
+            "result": None,
+            "detail_questions_needed": True,
+            "detail_questions": result["detail_questions"]
+        }
 
     # 次の質問を取得
-    next_question = engine.get_next_question(goals, wm)
+    next_question = get_next_question(engine, session)
 
     # 診断完了かチェック
     is_completed = next_question is None
     diagnosis_result = None
+    stored_result = None
 
     if is_completed:
         # ゴール達成状況をチェック
-        goal_results = engine.check_goals(goals, wm)
-        achieved_goals = [goal for goal, achieved in goal_results.items() if achieved]
-
-        diagnosis_result = {
-            "applicable_visas": achieved_goals,
-            "all_goals": goal_results,
-            "findings": wm.findings,
-            "hypotheses": wm.hypotheses
-        }
+        diagnosis_result = build_diagnosis_result(engine, goals, wm)
+        # 質問選択方式ごとの質問数を比較できるよう方式も保存
+        stored_result = dict(diagnosis_result, question_selector=session["question_selector"])
+
+    # データベースに回答と作業記憶の状態（完了時は診断結果も）を保存
+    # 保存に失敗した場合は回答を適用する前の状態に戻す（回答履歴・状態の版は保存できてから進める）
+    try:
+        await consultation_persistence.save_answers(
+            session_id, [(fact, answer)], working_memory_columns(wm), stored_result,
+            db_id=session.get("db_id")
+        )
+    except Exception:
+        wm.rollback(trail)
+        session["question_node"] = question_node
+        raise
 
-        # データベース更新
-        if db_session:
-            db_session.status = "completed"
-            db_session.result = diagnosis_result
-            from datetime import datetime
-            db_session.completed_at = datetime.utcnow()
-            db.commit()
+    answer_history.append(entry)
+    finish_state_step(session, [trail])
 
-    return AnswerResponse(
-        session_id=session_id,
-        next_question=next_question,
-        fired_rules=result["fired_rules"],
-        derived_facts=result["derived_facts"],
-        is_completed=is_completed,
-        result=diagnosis_result,
-        detail_questions_needed=False,
-        detail_questions=[]
-    )
+    return {
+        "next_question": next_question,
+        "fired_rules": result["fired_rules"],
+        "derived_facts": result["derived_facts"],
+        "is_completed": is_completed,
+        "result": diagnosis_result,
+        "detail_questions_needed": False,
+        "detail_questions": [],
+        "invalidated_rules": result["invalidated_rules"]
+    }
 
-@app.post("/api/consultation/undo", response_model=UndoResponse)
-def undo_answer(request: UndoRequest, db: Session = Depends(get_db)):
+async def apply_answers(session_id: str, session: dict, answers: List[AnswerItem]) -> dict:
     """
-    前の質問に戻る（システムイメージ.txt 行25-31準拠）
-    - 直前の質問に戻り、回答を変更可能
-    - 該当する回答をクリア
-    - その回答に依存する導出事実も自動的にクリア
-    - 推論過程の表示もリセット
+    複数の回答をまとめて適用
+    Returns: BatchAnswerResponse の項目（session_id・session_token・state を除く）
     """
-    session_id = request.session_id
+    if not answers:
+        raise HTTPException(status_code=400, detail="回答がありません")
 
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="セッションが見つかりません")
+    # 一部だけ適用されないよう、先に全回答を検証する
+    try:
+        answer_types = [AnswerType(item.answer.lower()) for item in answers]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="不正な回答が含まれています")
 
-    session = sessions[session_id]
-    answer_history = session["answer_history"]
-    engine = session["engine"]
+    engine = session["rule_set"].engine
     wm = session["wm"]
     goals = session["goals"]
+    answer_history = session["answer_history"]
+
+    # 各回答を記録（戻る機能のため回答ごとに差分を記録）
+    recorded = []  # 詳細質問待ちでない回答 (fact, AnswerType)
+    recorded_items = []
+    detail_questions = []
+    entries = []
+    batch_id = len(answer_history)  # 一括回答の先頭の位置（同じ一括回答の回答で共通）
+    for item, answer_type in zip(answers, answer_types):
+        with wm.journal() as trail:
+            pending_details = engine.record_answer(item.fact, answer_type, wm)
+
+        if pending_details is None:
+            recorded.append((item.fact, answer_type))
+            recorded_items.append(item)
+        else:
+            detail_questions.extend(q for q in pending_details if q not in detail_questions)
+
+        # batch[:batch_size] はこの回答までに記録された回答（途中まで戻った時の再評価用）
+        entries.append({
+            "fact": item.fact,
+            "answer": item.answer,
+            "trail": trail,
+            "batch": recorded,
+            "batch_size": len(recorded),
+            "settled": False,
+            "batch_id": batch_id,
+            "question_node": None
+        })
+
+    # 連鎖的無効化とルール評価は最後に1回だけ（差分は最後の回答に含める）
+    with wm.journal() as trail:
+        result = engine.settle_answers(recorded, wm)
+    entries[-1]["trail"].extend(trail)
+    entries[-1]["settled"] = True
+
+    # 一括回答後は質問決定表を使わない（先頭まで戻れば元の位置に復帰する）
+    question_node = entries[0]["question_node"] = session.get("question_node")
+    session["question_node"] = None
+
+    next_question = get_next_question(engine, session)
+    is_completed = next_question is None
+    diagnosis_result = build_diagnosis_result(engine, goals, wm) if is_completed else None
+
+    # データベースに1トランザクションで保存
+    try:
+        await consultation_persistence.save_answers(
+            session_id,
+            [(item.fact, item.answer) for item in recorded_items],
+            working_memory_columns(wm),
+            dict(diagnosis_result, question_selector=session["question_selector"]) if is_completed else None,
+            db_id=session.get("db_id")
+        )
+    except Exception:
+        for entry in reversed(entries):
+            wm.rollback(entry["trail"])
+        session["question_node"] = question_node
+        raise
+
+    answer_history.extend(entries)
+    finish_state_step(session, [entry["trail"] for entry in entries])
+
+    return {
+        "next_question": next_question,
+        "fired_rules": result["fired_rules"],
+        "derived_facts": result["derived_facts"],
+        "is_completed": is_completed,
+        "result": diagnosis_result,
+        "answered_count": len(recorded),
+        "detail_questions": detail_questions,
+        "invalidated_rules": result["invalidated_rules"]
+    }
+
+async def apply_undo(session_id: str, session: dict) -> dict:
+    """
+    直前の回答を取り消す
+    Returns: UndoResponse の項目（session_id・session_token・state を除く）
+    """
+    answer_history = session["answer_history"]
+    engine = session["rule_set"].engine
 
     # 回答履歴が空の場合
     if not answer_history:
-        return UndoResponse(
-            session_id=session_id,
-            next_question=engine.get_next_question(goals, wm),
-            message="戻る履歴がありません",
-            can_undo=False
-        )
+        return {
+            "next_question": get_next_question(engine, session),
+            "message": "戻る履歴がありません",
+            "can_undo": False
+        }
 
     # 最後の回答を取り出す
     last_answer = answer_history.pop()
-
-    # 作業記憶を前の状態に復元
-    wm_snapshot = last_answer["wm_snapshot_before"]
-    wm.findings = dict(wm_snapshot["findings"])
-    wm.hypotheses = dict(wm_snapshot["hypotheses"])
-    wm.conflict_set = set(wm_snapshot["conflict_set"])
-    wm.evaluated_rules = dict(wm_snapshot["evaluated_rules"])
-    wm.skipped_facts = set(wm_snapshot["skipped_facts"])
-    wm.asked_derivable_facts = set(wm_snapshot["asked_derivable_facts"])
+    question_node = session.get("question_node")
+    wm = session["wm"]
+    undo_trail = None  # 取り消した変更（保存に失敗したら、これを取り消して回答を戻す）
+    settle_trail = None  # 一括回答の途中まで戻った場合の再評価による変更
+
+    if "trail" not in last_answer:
+        # トークン・共有ストアから復元した回答には差分がないため、残った回答履歴を適用し直す
+        replay_answer_history(engine, session)
+    else:
+        # 作業記憶を前の状態に復元（記録した差分を逆順に取り消す）
+        with wm.journal() as undo_trail:
+            wm.rollback(last_answer["trail"])
+        session["question_node"] = last_answer.get("question_node")
+
+        # 一括回答の途中まで戻った場合、残った回答で連鎖的無効化とルール評価をやり直す
+        if answer_history and not answer_history[-1].get("settled", True):
+            previous_answer = answer_history[-1]
+            with wm.journal() as settle_trail:
+                engine.settle_answers(previous_answer["batch"][:previous_answer["batch_size"]], wm)
 
     # 次の質問を再計算
-    next_question = engine.get_next_question(goals, wm)
+    next_question = get_next_question(engine, session)
+
+    # データベースから最後の回答を削除（失敗した場合は取り消す前の状態に戻す）
+    try:
+        await consultation_persistence.delete_last_answer(
+            session_id, working_memory_columns(session["wm"]), db_id=session.get("db_id")
+        )
+    except Exception:
+        if undo_trail is None:
+            session["wm"] = wm
+        else:
+            if settle_trail is not None:
+                wm.rollback(settle_trail)
+            wm.rollback(undo_trail)
+        session["question_node"] = question_node
+        answer_history.append(last_answer)
+        raise
+
+    if settle_trail is not None:
+        answer_history[-1]["trail"].extend(settle_trail)
+        answer_history[-1]["settled"] = True
+    # 回答履歴を適用し直した場合は差分記録がない（変更履歴を空にし、クライアントには全体を返す）
+    finish_state_step(session, None if undo_trail is None else [undo_trail, settle_trail or []])
 
-    # データベースから最後の回答を削除
-    db_session = db.query(models.ConsultationSession).filter(
-        models.ConsultationSession.session_id == session_id
-    ).first()
+    return {
+        "next_question": next_question,
+        "message": "前の質問に戻りました",
+        "can_undo": len(answer_history) > 0
+    }
 
-    if db_session and db_session.answers:
-        # 最後の回答を削除
-        last_db_answer = db_session.answers[-1]
-        db.delete(last_db_answer)
+# ===== 診断API（REST） =====
+@app.post("/api/consultation/start", response_model=ConsultationStartResponse)
+async def start_consultation(request: ConsultationStartRequest):
+    """診断セッションを開始"""
+    session_id, session, next_question = await open_consultation(request.visa_types, request.question_selector)
 
-        # セッション情報を更新
-        db_session.findings = wm.findings
-        db_session.hypotheses = wm.hypotheses
-        db_session.evaluated_rules = [rule_id for rule_id, status in wm.evaluated_rules.items()]
-        db_session.fired_rules = list(wm.conflict_set)
-        db_session.status = "in_progress"  # 完了状態から戻る場合もあるので
+    return ConsultationStartResponse(
+        session_id=session_id,
+        next_question=next_question,
+        message="診断を開始しました",
+        question_selector=session["question_selector"],
+        session_token=await save_session_async(session_id, session),
+        state=state_changes(session, None) if request.include_state else None
+    )
 
-        db.commit()
+@app.post("/api/consultation/answer", response_model=AnswerResponse)
+async def answer_question(request: AnswerRequest):
+    """質問に回答"""
+    session_id = request.session_id
+    session = await load_session_async(session_id, request.session_token)
+    step = await apply_answer(session_id, session, request.fact, request.answer)
+
+    return AnswerResponse(
+        session_id=session_id,
+        **step,
+        session_token=await save_session_async(session_id, session),
+        state=build_step_state(session, request.include_state, request.state_version)
+    )
+
+@app.post("/api/consultation/answers:batch", response_model=BatchAnswerResponse)
+async def answer_questions_batch(request: BatchAnswerRequest):
+    """
+    複数の回答をまとめて適用（事前に分かっている基本事実の一括入力用）
+    - 全回答を記録してから、連鎖的無効化とルール評価を1回だけ行う
+    - 回答は1トランザクションで保存し、失敗した場合は作業記憶も元に戻す
+    - 戻る機能は1回答ずつ（一括回答の途中まで戻ることもできる）
+    """
+    session_id = request.session_id
+    session = await load_session_async(session_id, request.session_token)
+    step = await apply_answers(session_id, session, request.answers)
+
+    return BatchAnswerResponse(
+        session_id=session_id,
+        **step,
+        session_token=await save_session_async(session_id, session),
+        state=build_step_state(session, request.include_state, request.state_version)
+    )
+
+@app.post("/api/consultation/undo", response_model=UndoResponse)
+async def undo_answer(request: UndoRequest):
+    """
+    前の質問に戻る（システムイメージ.txt 行25-31準拠）
+    - 直前の質問に戻り、回答を変更可能
+    - 該当する回答をクリア
+    - その回答に依存する導出事実も自動的にクリア
+    - 推論過程の表示もリセット
+    """
+    session_id = request.session_id
+    session = await load_session_async(session_id, request.session_token)
+    step = await apply_undo(session_id, session)
 
     return UndoResponse(
         session_id=session_id,
-        next_question=next_question,
-        message="前の質問に戻りました",
-        can_undo=len(answer_history) > 0
+        **step,
+        session_token=await save_session_async(session_id, session),
+        state=build_step_state(session, request.include_state, request.state_version)
     )
 
-@app.get("/api/consultation/{session_id}/rules", response_model=List[RuleResponse])
-def get_session_rules(session_id: str):
-    """セッションのルール状態を取得（推論過程の可視化用）"""
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="セッションが見つかりません")
+# ===== 診断API（WebSocket） =====
+# 常に含める項目（それ以外は空・偽なら省く）
+_WS_KEPT_FIELDS = ("next_question", "is_completed", "can_undo", "version", "full", "conflict_set")
+
+def _compact(message: dict) -> dict:
+    return {
+        key: value for key, value in message.items()
+        if value or (key in _WS_KEPT_FIELDS and (value is not None or key == "next_question"))
+    }
+
+async def _send_ws(websocket: WebSocket, message: dict):
+    # 日本語をエスケープせず、区切りの空白も省く
+    await websocket.send_text(json.dumps(_compact(message), ensure_ascii=False, separators=(",", ":")))
+
+@app.websocket("/ws/consultation")
+async def consultation_websocket(websocket: WebSocket, session_id: Optional[str] = None,
+                                 session_token: Optional[str] = None):
+    """
+    診断のWebSocket（セッションを接続に結び付け、1ステップあたり小さなメッセージを1往復する）
+    推論・保存は REST の診断APIと同じ処理（apply_answer 等）を使う。
+    session_id（ステートレスモードでは session_token も）を指定して接続すると既存のセッションを再開する。
+
+    クライアント → サーバー:
+        {"type": "start", "visa_types": [...], "question_selector": ...}
+        {"type": "answer", "fact": ..., "answer": "yes" | "no" | "unknown"}
+        {"type": "answers", "answers": [{"fact": ..., "answer": ...}, ...]}
+        {"type": "undo"}
+        {"type": "sync"}（ルール状態・作業記憶の全体を再送）
+    サーバー → クライアント（空の項目は省く）:
+        {"type": "session", "session_id", "question_selector", "next_question", "state"}（開始・再開時、state は全体）
+        {"type": "step", "next_question", "is_completed", "fired_rules", ..., "state"}（state は前回送った版からの差分）
+        {"type": "state", "state"} / {"type": "error", "status", "detail"}
+    ステートレスモードでは各メッセージに更新後の session_token を含める（再接続用）。
+    """
+    await websocket.accept()
+    session = None
+    sent_version = None  # このクライアントに最後に送った状態の版
+
+    async def send_session(next_question: Optional[str], token: Optional[str]):
+        nonlocal sent_version
+        state = state_changes(session, None)
+        sent_version = state["version"]
+        await _send_ws(websocket, {
+            "type": "session", "session_id": session_id, "question_selector": session["question_selector"],
+            "next_question": next_question, "state": _compact(state), "session_token": token
+        })
+
+    try:
+        if session_id is not None:
+            try:
+                session = await load_session_async(session_id, session_token)
+            except HTTPException as e:
+                await _send_ws(websocket, {"type": "error", "status": e.status_code, "detail": e.detail})
+                await websocket.close(code=1008)
+                return
+            await send_session(get_next_question(session["rule_set"].engine, session), session_token)
+
+        while True:
+            text = await websocket.receive_text()
+            try:
+                message = json.loads(text)
+                if not isinstance(message, dict):
+                    raise ValueError(text)
+                kind = message.get("type")
+                if kind == "start":
+                    session_id, session, next_question = await open_consultation(
+                        message.get("visa_types") or ConsultationStartRequest().visa_types,
+                        message.get("question_selector")
+                    )
+                    await send_session(next_question, await save_session_async(session_id, session))
+                    continue
+                if session is None:
+                    raise HTTPException(status_code=400, detail="診断が開始されていません")
+
+                if kind == "answer":
+                    step = await apply_answer(session_id, session, message["fact"], message["answer"])
+                elif kind == "answers":
+                    items = [AnswerItem(**item) for item in message.get("answers") or []]
+                    step = await apply_answers(session_id, session, items)
+                elif kind == "undo":
+                    step = await apply_undo(session_id, session)
+                elif kind == "sync":
+                    state = state_changes(session, None)
+                    sent_version = state["version"]
+                    await _send_ws(websocket, {"type": "state", "state": state})
+                    continue
+                else:
+                    raise HTTPException(status_code=400, detail=f"不正なメッセージの種類です: {kind}")
+
+                state = state_changes(session, sent_version)
+                sent_version = state["version"]
+                step.pop("message", None)
+                await _send_ws(websocket, dict(
+                    step, type="step", state=_compact(state),
+                    session_token=await save_session_async(session_id, session)
+                ))
+            except HTTPException as e:
+                await _send_ws(websocket, {"type": "error", "status": e.status_code, "detail": e.detail})
+            except (KeyError, TypeError, ValueError, ValidationError):
+                await _send_ws(websocket, {"type": "error", "status": 400, "detail": "不正なメッセージです"})
+            except (SQLAlchemyError, SessionNotSaved):
+                # 保存に失敗したステップは取り消し済み（REST の 500 と同じ）。接続は切らず、再送を待つ
+                await _send_ws(websocket, {"type": "error", "status": 500, "detail": "保存に失敗しました"})
+    except WebSocketDisconnect:
+        pass
+
+@app.get("/api/consultation/{session_id}/rules",
+         response_model=Union[List[RuleResponse], RuleStatusChangesResponse])
+def get_session_rules(session_id: str, request: Request, response: Response,
+                      session_token: Optional[str] = None, since: Optional[int] = None):
+    """
+    セッションのルール状態を取得（推論過程の可視化用）
+    - ETag は状態の版で決まり、If-None-Match が一致すれば 304 を返す
+    - since を指定すると、その版より後に状態が変わったルールだけを返す
+    """
+    session = load_session(session_id, session_token)
+    etag = state_etag(session, "rules")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
+    if since is not None:
+        changes = state_changes(session, since)
+        return RuleStatusChangesResponse(
+            version=changes["version"], full=changes["full"], rule_statuses=changes["rule_statuses"]
+        )
 
-    session = sessions[session_id]
     wm = session["wm"]
 
     rules_status = []
-    for rule in inference_rules:
+    for rule in session["rule_set"].rule_base.rules.values():
         status = wm.evaluated_rules.get(rule.id, RuleStatus.NOT_EVALUATED)
         rules_status.append(
             RuleResponse(
@@ -353,58 +975,100 @@ def get_session_rules(session_id: str):
     return rules_status
 
 @app.get("/api/rules")
-def get_all_rules():
-    """全ルールを取得"""
-    return VISA_RULES
+def get_all_rules(request: Request):
+    """全ルールを取得（作り置いた本文を返す。ETag・gzip/brotli 対応）"""
+    return cached_response(request, rule_registry.current.responses.rules)
 
 @app.get("/api/rules/{rule_id}")
-def get_rule(rule_id: int):
+def get_rule(rule_id: int, request: Request):
     """特定のルールを取得"""
-    rule = next((r for r in VISA_RULES if r["id"] == rule_id), None)
-    if not rule:
+    body = rule_registry.current.responses.by_id.get(rule_id)
+    if body is None:
         raise HTTPException(status_code=404, detail="ルールが見つかりません")
-    return rule
+    return cached_response(request, body)
 
 @app.put("/api/rules/{rule_id}")
 def update_rule(rule_id: int, updated_rule: dict, db: Session = Depends(get_db)):
     """ルールを更新（管理機能）"""
     # 実装簡略化のため、ここでは基本実装のみ
-    rule = next((r for r in VISA_RULES if r["id"] == rule_id), None)
-    if not rule:
+    old_rule = rule_registry.current.by_id.get(rule_id)
+    if old_rule is None:
         raise HTTPException(status_code=404, detail="ルールが見つかりません")
 
-    # ルールを更新
-    rule.update(updated_rule)
+    # ルールを更新（ルールベースの版も進め、全ワーカーに反映する）
+    rule = update_rule_row(db, rule_id, updated_rule)
+    if rule is None:
+        raise HTTPException(status_code=404, detail="ルールが見つかりません")
 
     # 監査ログに記録
     audit_log = models.AuditLog(
         action="update",
         table_name="rules",
         record_id=rule_id,
-        old_value=rule,
+        old_value=old_rule,
         new_value=updated_rule
     )
     db.add(audit_log)
     db.commit()
+    rule_registry.reload()
 
     return {"message": "ルールを更新しました", "rule": rule}
 
 @app.get("/api/consultation/{session_id}/working-memory")
-def get_working_memory(session_id: str):
-    """作業記憶の状態を取得（デバッグ・可視化用）"""
-    if session_id not in sessions:
-        raise HTTPException(status_code=404, detail="セッションが見つかりません")
+def get_working_memory(session_id: str, request: Request, response: Response,
+                       session_token: Optional[str] = None, since: Optional[int] = None):
+    """
+    作業記憶の状態を取得（デバッグ・可視化用）
+    - ETag は状態の版で決まり、If-None-Match が一致すれば 304 を返す
+    - since を指定すると、その版より後の事実の変更とルール状態の遷移だけを返す
+      （evaluated_rules の not_evaluated は未評価に戻ったルール）
+    """
+    session = load_session(session_id, session_token)
+    etag = state_etag(session, "working-memory")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
+    if since is not None:
+        changes = state_changes(session, since)
+        return {
+            "version": changes["version"],
+            "full": changes["full"],
+            "findings": changes["findings"],
+            "hypotheses": changes["hypotheses"],
+            "removed_findings": changes["removed_findings"],
+            "removed_hypotheses": changes["removed_hypotheses"],
+            "conflict_set": changes["conflict_set"],
+            "evaluated_rules": changes["rule_statuses"]
+        }
 
-    session = sessions[session_id]
     wm = session["wm"]
 
+    memory = wm.to_dict()
+
     return {
-        "findings": wm.findings,
-        "hypotheses": wm.hypotheses,
-        "conflict_set": list(wm.conflict_set),
-        "evaluated_rules": {rule_id: status.value for rule_id, status in wm.evaluated_rules.items()}
+        "findings": memory["findings"],
+        "hypotheses": memory["hypotheses"],
+        "conflict_set": memory["conflict_set"],
+        "evaluated_rules": memory["evaluated_rules"]
     }
 
+@app.get("/api/consultation/{session_id}/state", response_model=SessionStateResponse)
+def get_session_state(session_id: str, request: Request, response: Response,
+                      session_token: Optional[str] = None, since: Optional[int] = None):
+    """
+    ルール状態・作業記憶と状態の版（差分レスポンスを取りこぼしたクライアントの再同期用）
+    since を指定すると、その版より後の差分を返す（変更履歴で足りなければ全体）
+    """
+    session = load_session(session_id, session_token)
+    etag = state_etag(session, "state")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return state_changes(session, since)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
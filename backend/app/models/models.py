@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, Index, JSON
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from app.database.config import Base
@@ -16,9 +16,18 @@ class Rule(Base):
     priority = Column(Integer, default=0)  # 優先順位
     flag = Column(Boolean, default=True)  # ルールの有効/無効
     description = Column(Text)  # ルールの説明
+    version = Column(Integer, nullable=False, default=1)  # 楽観的ロック用（システムイメージ.txt 行143）
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+class RuleBaseVersion(Base):
+    """ルールベースの版 - ルールを変更するたびに進める（1行のみ。各ワーカーはこれを見てルールを読み直す）"""
+    __tablename__ = "rulebase_versions"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 class Fact(Base):
     """事実テーブル - 基本事実と導出事実"""
     __tablename__ = "facts"
@@ -80,6 +89,11 @@ class ConsultationAnswer(Base):
 
     session = relationship("ConsultationSession", back_populates="answers")
 
+    # セッションの最後の回答（順序の最大値）を回答の行を読まずに引くためのインデックス
+    __table_args__ = (
+        Index("ix_consultation_answers_session_order", "session_id", "question_order"),
+    )
+
 class RuleDependency(Base):
     """ルール依存関係テーブル"""
     __tablename__ = "rule_dependencies"
@@ -3,9 +3,10 @@
 システムイメージ.txt 行108-143準拠
 """
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from sqlalchemy.orm import Session
-from sqlalchemy import text
+from sqlalchemy import func, text
+from sqlalchemy.exc import IntegrityError
 from typing import List, Dict, Optional
 from pydantic import BaseModel
 import json
@@ -13,12 +14,28 @@ from datetime import datetime
 
 from app.database.config import get_db
 from app.models import models
-from app.services.visa_rules import VISA_RULES, VISA_GOALS
+from app.services.visa_rules import VISA_GOALS
 from app.services.inference_engine import Rule
-from app.services.rule_validator import RuleValidator
+from app.services.rule_validator import IncrementalRuleValidator
+from app.services.rule_cache import cached_response
+from app.services.rulebase_store import (
+    RuleBaseRegistry, bump_rulebase_version, delete_rule_row, insert_rule, update_rule_row
+)
+from app.services.question_selector import QUESTION_SELECTOR_HEURISTIC
 
 router = APIRouter(prefix="/api/admin", tags=["admin"])
 
+def get_rule_registry(request: Request) -> RuleBaseRegistry:
+    """ルールベース（main で作成し app.state に置いたもの）"""
+    return request.app.state.rule_registry
+
+def get_rule_validator(request: Request) -> IncrementalRuleValidator:
+    """現在のルールベースに合わせた整合性チェック（前回の版から変わったルールだけを反映する）"""
+    rule_set = request.app.state.rule_registry.current
+    validator = request.app.state.rule_validator
+    validator.sync(rule_set.rule_base.rules.values(), rule_set.version)
+    return validator
+
 # ===== Pydanticモデル =====
 class RuleCreateRequest(BaseModel):
     name: str
@@ -50,71 +67,58 @@ class ExportFormat(BaseModel):
 # ===== ルール管理エンドポイント =====
 
 @router.get("/rules")
-def get_all_rules_admin():
-    """全ルールを取得（管理用）"""
-    return {
-        "rules": VISA_RULES,
-        "count": len(VISA_RULES)
-    }
+def get_all_rules_admin(request: Request, registry: RuleBaseRegistry = Depends(get_rule_registry)):
+    """全ルールを取得（管理用。作り置いた本文を返す）"""
+    return cached_response(request, registry.current.responses.admin_rules)
 
 @router.get("/rules/{rule_id}")
-def get_rule_admin(rule_id: int):
+def get_rule_admin(rule_id: int, request: Request, registry: RuleBaseRegistry = Depends(get_rule_registry)):
     """特定のルールを取得"""
-    rule = next((r for r in VISA_RULES if r["id"] == rule_id), None)
-    if not rule:
+    body = registry.current.responses.by_id.get(rule_id)
+    if body is None:
         raise HTTPException(status_code=404, detail="ルールが見つかりません")
-    return rule
+    return cached_response(request, body)
 
 @router.post("/rules")
-def create_rule(request: RuleCreateRequest, db: Session = Depends(get_db)):
-    """新しいルールを作成"""
-    # 新しいIDを生成
-    max_id = max(r["id"] for r in VISA_RULES) if VISA_RULES else 0
-    new_id = max_id + 1
-
+def create_rule(request: RuleCreateRequest, db: Session = Depends(get_db),
+                registry: RuleBaseRegistry = Depends(get_rule_registry),
+                validator: IncrementalRuleValidator = Depends(get_rule_validator)):
+    """新しいルールを作成（rules テーブルに追加し、ルールベースの版を進めて全ワーカーに反映する）"""
     new_rule = {
-        "id": new_id,
         "name": request.name,
         "visa_type": request.visa_type,
         "rule_type": request.rule_type,
         "conditions": request.conditions,
         "actions": request.actions,
         "flag": request.flag,
-        "version": 1,  # システムイメージ.txt 行143: 楽観的ロック用の初期バージョン
         "priority": request.priority  # システムイメージ.txt 行116: 質問の優先順位
     }
+    # 先に追加して、DBが振ったID（最大のID + 1）と初期バージョン（楽観的ロック用）を得る（コミットは検証の後）
+    try:
+        new_rule = insert_rule(db, new_rule)
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="同時に作成されたルールとIDが重複しました。再度実行してください")
 
-    # 整合性チェック
-    test_rules = VISA_RULES + [new_rule]
-    inference_rules = [
-        Rule(
-            id=r["id"],
-            name=r["name"],
-            visa_type=r["visa_type"],
-            rule_type=r["rule_type"],
-            conditions=r["conditions"],
-            actions=r["actions"],
-            flag=r["flag"]
-        )
-        for r in test_rules
-    ]
-
-    validator = RuleValidator(inference_rules)
-    validation_result = validator.validate_all()
+    # 整合性チェック（追加するルールに関係する範囲だけを、実際のIDで検証し直す）
+    validation_result = validator.validate_change(new_rule["id"], Rule.from_dict(new_rule))
 
     # 監査ログに記録
     audit_log = models.AuditLog(
         action="create",
         table_name="rules",
-        record_id=new_id,
+        record_id=new_rule["id"],
         old_value=None,
         new_value=new_rule
     )
     db.add(audit_log)
-    db.commit()
-
-    # 実際にはVISA_RULESに追加（本番環境ではDBから読み込む想定）
-    VISA_RULES.append(new_rule)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="同時に作成されたルールとIDが重複しました。再度実行してください")
+    registry.reload()
+    validator.apply_change(new_rule["id"], Rule.from_dict(new_rule), registry.current.version)
 
     return {
         "message": "ルールを作成しました",
@@ -123,13 +127,14 @@ def create_rule(request: RuleCreateRequest, db: Session = Depends(get_db)):
     }
 
 @router.put("/rules/{rule_id}")
-def update_rule_admin(rule_id: int, request: RuleUpdateRequest, db: Session = Depends(get_db)):
+def update_rule_admin(rule_id: int, request: RuleUpdateRequest, db: Session = Depends(get_db),
+                      registry: RuleBaseRegistry = Depends(get_rule_registry),
+                      validator: IncrementalRuleValidator = Depends(get_rule_validator)):
     """ルールを更新（システムイメージ.txt 行143: 楽観的ロックサポート）"""
-    rule_index = next((i for i, r in enumerate(VISA_RULES) if r["id"] == rule_id), None)
-    if rule_index is None:
+    if rule_id not in registry.current.by_id:
         raise HTTPException(status_code=404, detail="ルールが見つかりません")
 
-    old_rule = VISA_RULES[rule_index].copy()
+    old_rule = registry.current.by_id[rule_id].copy()
 
     # 楽観的ロックチェック（システムイメージ.txt 行143準拠）
     current_version = old_rule.get("version", 1)
@@ -160,23 +165,22 @@ def update_rule_admin(rule_id: int, request: RuleUpdateRequest, db: Session = De
     # バージョンを1増やす（システムイメージ.txt 行143準拠）
     updated_rule["version"] = current_version + 1
 
-    # 整合性チェック
-    test_rules = [updated_rule if r["id"] == rule_id else r for r in VISA_RULES]
-    inference_rules = [
-        Rule(
-            id=r["id"],
-            name=r["name"],
-            visa_type=r["visa_type"],
-            rule_type=r["rule_type"],
-            conditions=r["conditions"],
-            actions=r["actions"],
-            flag=r["flag"]
-        )
-        for r in test_rules
-    ]
+    # 整合性チェック（変更したルールに関係する範囲だけを検証し直す）
+    validation_result = validator.validate_change(rule_id, Rule.from_dict(updated_rule))
 
-    validator = RuleValidator(inference_rules)
-    validation_result = validator.validate_all()
+    # DB上の版が一致する場合だけ更新する（他のワーカーで先に更新された場合も検出する）
+    saved_rule = update_rule_row(db, rule_id, updated_rule, expected_version=current_version)
+    if saved_rule is None:
+        db.rollback()
+        registry.reload()
+        latest = registry.current.by_id.get(rule_id)
+        if latest is None:
+            raise HTTPException(status_code=404, detail="ルールが見つかりません")
+        raise HTTPException(
+            status_code=409,
+            detail=f"編集競合が発生しました。他のユーザーがこのルールを更新しています。現在のバージョン: {latest['version']}"
+        )
+    updated_rule = saved_rule
 
     # 監査ログに記録
     audit_log = models.AuditLog(
@@ -189,8 +193,9 @@ def update_rule_admin(rule_id: int, request: RuleUpdateRequest, db: Session = De
     db.add(audit_log)
     db.commit()
 
-    # 更新を適用
-    VISA_RULES[rule_index] = updated_rule
+    # このワーカーにはすぐに反映する（他のワーカーは版のポーリングで取り込む）
+    registry.reload()
+    validator.apply_change(rule_id, Rule.from_dict(updated_rule), registry.current.version)
 
     return {
         "message": "ルールを更新しました",
@@ -199,14 +204,14 @@ def update_rule_admin(rule_id: int, request: RuleUpdateRequest, db: Session = De
     }
 
 @router.delete("/rules/{rule_id}")
-def delete_rule(rule_id: int, db: Session = Depends(get_db)):
-    """ルールを削除"""
-    rule_index = next((i for i, r in enumerate(VISA_RULES) if r["id"] == rule_id), None)
-    if rule_index is None:
+def delete_rule(rule_id: int, db: Session = Depends(get_db),
+                registry: RuleBaseRegistry = Depends(get_rule_registry),
+                validator: IncrementalRuleValidator = Depends(get_rule_validator)):
+    """ルールを削除（実行中の診断は開始時のルールで続ける）"""
+    deleted_rule = delete_rule_row(db, rule_id)
+    if deleted_rule is None:
         raise HTTPException(status_code=404, detail="ルールが見つかりません")
 
-    deleted_rule = VISA_RULES[rule_index]
-
     # 監査ログに記録
     audit_log = models.AuditLog(
         action="delete",
@@ -217,9 +222,8 @@ def delete_rule(rule_id: int, db: Session = Depends(get_db)):
     )
     db.add(audit_log)
     db.commit()
-
-    # 削除
-    VISA_RULES.pop(rule_index)
+    registry.reload()
+    validator.apply_change(rule_id, None, registry.current.version)
 
     return {
         "message": "ルールを削除しました",
@@ -229,22 +233,8 @@ def delete_rule(rule_id: int, db: Session = Depends(get_db)):
 # ===== 整合性チェックエンドポイント =====
 
 @router.get("/rules/validation/check")
-def validate_rules():
-    """全ルールの整合性をチェック（システムイメージ.txt 行117-120）"""
-    inference_rules = [
-        Rule(
-            id=r["id"],
-            name=r["name"],
-            visa_type=r["visa_type"],
-            rule_type=r["rule_type"],
-            conditions=r["conditions"],
-            actions=r["actions"],
-            flag=r["flag"]
-        )
-        for r in VISA_RULES
-    ]
-
-    validator = RuleValidator(inference_rules)
+def validate_rules(validator: IncrementalRuleValidator = Depends(get_rule_validator)):
+    """全ルールの整合性をチェック（システムイメージ.txt 行117-120。結果はルールベースの内容ごとにキャッシュする）"""
     validation_results = validator.validate_all()
 
     # 問題の総数をカウント
@@ -257,9 +247,11 @@ def validate_rules():
     }
 
 @router.post("/rules/{rule_id}/test")
-def test_rule_modification(rule_id: int, request: RuleUpdateRequest):
+def test_rule_modification(rule_id: int, request: RuleUpdateRequest,
+                           registry: RuleBaseRegistry = Depends(get_rule_registry),
+                           validator: IncrementalRuleValidator = Depends(get_rule_validator)):
     """ルール変更をテスト実行（本番反映前の検証）"""
-    rule = next((r for r in VISA_RULES if r["id"] == rule_id), None)
+    rule = registry.current.by_id.get(rule_id)
     if not rule:
         raise HTTPException(status_code=404, detail="ルールが見つかりません")
 
@@ -274,30 +266,7 @@ def test_rule_modification(rule_id: int, request: RuleUpdateRequest):
     if request.flag is not None:
         test_rule_dict["flag"] = request.flag
 
-    test_rule = Rule(
-        id=test_rule_dict["id"],
-        name=test_rule_dict["name"],
-        visa_type=test_rule_dict["visa_type"],
-        rule_type=test_rule_dict["rule_type"],
-        conditions=test_rule_dict["conditions"],
-        actions=test_rule_dict["actions"],
-        flag=test_rule_dict["flag"]
-    )
-
-    inference_rules = [
-        Rule(
-            id=r["id"],
-            name=r["name"],
-            visa_type=r["visa_type"],
-            rule_type=r["rule_type"],
-            conditions=r["conditions"],
-            actions=r["actions"],
-            flag=r["flag"]
-        )
-        for r in VISA_RULES
-    ]
-
-    validator = RuleValidator(inference_rules)
+    test_rule = Rule.from_dict(test_rule_dict)
     test_result = validator.test_rule_modification(test_rule)
 
     return {
@@ -435,7 +404,8 @@ def export_database(format: str = "json", db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"エクスポートエラー: {str(e)}")
 
 @router.post("/database/import")
-def import_database(data: Dict, db: Session = Depends(get_db)):
+def import_database(data: Dict, db: Session = Depends(get_db),
+                    registry: RuleBaseRegistry = Depends(get_rule_registry)):
     """データベースにインポート（システムイメージ.txt 行135）"""
     try:
         imported_tables = []
@@ -463,7 +433,12 @@ def import_database(data: Dict, db: Session = Depends(get_db)):
 
             imported_tables.append(table_name)
 
+        # ルールを入れた場合はルールベースの版も進め、全ワーカーに反映する
+        if "rules" in imported_tables:
+            bump_rulebase_version(db)
         db.commit()
+        if "rules" in imported_tables:
+            registry.reload()
 
         return {
             "success": True,
@@ -521,6 +496,60 @@ def get_consultation_statistics(db: Session = Depends(get_db)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"統計取得エラー: {str(e)}")
 
+@router.get("/analytics/question-selectors")
+def get_question_selector_statistics(db: Session = Depends(get_db)):
+    """質問選択方式ごとの完了診断数と平均質問数（A/Bテスト用）"""
+    rows = db.query(
+        models.ConsultationSession.result,
+        func.count(models.ConsultationAnswer.id)
+    ).outerjoin(
+        models.ConsultationAnswer,
+        models.ConsultationAnswer.session_id == models.ConsultationSession.id
+    ).filter(
+        models.ConsultationSession.status == "completed"
+    ).group_by(models.ConsultationSession.id).all()
+
+    totals = {}
+    for result, answer_count in rows:
+        selector = (result or {}).get("question_selector", QUESTION_SELECTOR_HEURISTIC)
+        stats = totals.setdefault(selector, {"completed_consultations": 0, "total_questions": 0})
+        stats["completed_consultations"] += 1
+        stats["total_questions"] += answer_count
+
+    return {
+        selector: {
+            "completed_consultations": stats["completed_consultations"],
+            "average_questions": stats["total_questions"] / stats["completed_consultations"]
+        }
+        for selector, stats in totals.items()
+    }
+
+@router.get("/analytics/live-sessions")
+def get_live_session_statistics(request: Request):
+    """このワーカーが保持している診断セッション数とメモリの概算（バイト）、追い出したセッション数"""
+    store = getattr(request.app.state, "session_store", None)
+    sweeper = getattr(request.app.state, "session_sweeper", None)
+    stats = store.stats() if store is not None else {"sessions": 0, "bytes": 0}
+    return {
+        "live_sessions": stats["sessions"],
+        "bytes_held": stats["bytes"],
+        "evicted_total": sweeper.evicted_total if sweeper is not None else 0,
+        "abandoned_total": sweeper.abandoned_total if sweeper is not None else 0
+    }
+
+@router.get("/analytics/persistence-queue")
+def get_persistence_queue_statistics(request: Request):
+    """診断APIの遅延書き込み（CONSULTATION_PERSISTENCE=write_behind）のキューの状態"""
+    persistence = getattr(request.app.state, "consultation_persistence", None)
+    if persistence is None or not hasattr(persistence, "stats"):
+        return {"mode": "immediate"}
+    return dict(persistence.stats(), mode="write_behind", durability=persistence.durability)
+
+@router.get("/analytics/rulebase")
+def get_rulebase_statistics(registry: RuleBaseRegistry = Depends(get_rule_registry)):
+    """ルールベースの版と、実行中のセッションが参照している版（RULEBASE_POLL_SECONDS ごとに他のワーカーの変更を取り込む）"""
+    return registry.stats()
+
 @router.get("/analytics/question-paths")
 def get_question_paths(limit: int = 10, db: Session = Depends(get_db)):
     """よく使われる質問パスを分析（システムイメージ.txt 行140）"""
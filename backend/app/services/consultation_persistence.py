@@ -0,0 +1,160 @@
+"""
+診断セッションのDB保存 - 診断APIの回答・戻る操作を consultation_sessions / consultation_answers に反映する
+
+保存処理は同期の Session で書き、実行方法だけを切り替える:
+- 同期モード: スレッドプールで Session（psycopg2 / sqlite3）を使う
+- 非同期モード（DATABASE_ASYNC=true）: AsyncSession.run_sync でイベントループ上で実行する
+  （asyncpg / aiosqlite。DBの応答を待つ間はスレッドを占有せず、他のリクエストを処理できる）
+"""
+
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app.models import models
+
+
+def working_memory_columns(wm) -> Dict:
+    """作業記憶のうち consultation_sessions に保存する列"""
+    return {
+        "findings": dict(wm.findings),
+        "hypotheses": dict(wm.hypotheses),
+        "evaluated_rules": [rule_id for rule_id, status in wm.evaluated_rules.items()],
+        "fired_rules": list(wm.conflict_set)
+    }
+
+
+_sessions = models.ConsultationSession.__table__
+_answers = models.ConsultationAnswer.__table__
+
+
+def _session_filter(session_id: str, db_id: Optional[int]):
+    """主キーが分かっていれば主キーで、なければ session_id（一意インデックス）で引く"""
+    if db_id is not None:
+        return _sessions.c.id == db_id
+    return _sessions.c.session_id == session_id
+
+
+def create_consultation_session(db: Session, session_id: str, visa_types: List[str]) -> int:
+    """診断セッションを作成 Returns: 主キー（以降の保存でセッションを主キーで引くため）"""
+    db_session = models.ConsultationSession(
+        session_id=session_id,
+        visa_types=visa_types,
+        status="in_progress"
+    )
+    db.add(db_session)
+    db.flush()
+    db_id = db_session.id
+    db.commit()
+    return db_id
+
+
+def save_consultation_answers(db: Session, session_id: str, answers: List[Tuple[str, str]],
+                              memory: Dict, result: Optional[Dict] = None, db_id: Optional[int] = None):
+    """
+    回答を追加し、作業記憶の状態を更新する（1トランザクション）
+    result を渡すと診断完了として保存する。
+    回答数によらず文は3つ（セッションの更新、最後の回答の順序の取得、回答の追加）で、過去の回答の行は読まない。
+    """
+    values = dict(memory)
+    if result is not None:
+        values.update(status="completed", result=result, completed_at=datetime.utcnow())
+    db_id = db.execute(
+        _sessions.update().where(_session_filter(session_id, db_id)).values(values).returning(_sessions.c.id)
+    ).scalar()
+    if db_id is None:
+        db.rollback()
+        return
+
+    if answers:
+        # 最後の回答の順序は (session_id, question_order) のインデックスだけで求まる
+        question_order = db.execute(
+            select(func.max(_answers.c.question_order)).where(_answers.c.session_id == db_id)
+        ).scalar() or 0
+        answered_at = datetime.utcnow()
+        db.execute(_answers.insert(), [
+            {"session_id": db_id, "fact_name": fact, "answer": answer,
+             "question_order": question_order + i + 1, "answered_at": answered_at}
+            for i, (fact, answer) in enumerate(answers)
+        ])
+
+    db.commit()
+
+
+def delete_last_consultation_answer(db: Session, session_id: str, memory: Dict, db_id: Optional[int] = None):
+    """
+    最後の回答を削除し、作業記憶の状態を更新する（完了済みのセッションは進行中に戻す）
+    主キーが分かっていれば文は2つ（順序が最後の回答の削除、セッションの更新）。
+    """
+    if db_id is None:
+        db_id = db.execute(select(_sessions.c.id).where(_session_filter(session_id, None))).scalar()
+        if db_id is None:
+            return
+
+    last_answer = (
+        select(_answers.c.id)
+        .where(_answers.c.session_id == db_id)
+        .order_by(_answers.c.question_order.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    if db.execute(_answers.delete().where(_answers.c.id == last_answer)).rowcount == 0:
+        db.rollback()
+        return
+
+    db.execute(
+        _sessions.update()
+        .where(_sessions.c.id == db_id)
+        .values(dict(memory, status="in_progress"))  # 完了状態から戻る場合もあるので
+    )
+    db.commit()
+
+
+class ConsultationPersistence:
+    """
+    保存処理の実行方法（同期はスレッドプール、非同期は AsyncSession.run_sync）
+    どちらもリクエストごとに新しいDBセッションを開いて閉じる。
+    """
+
+    def __init__(self, session_factory: Callable[[], Session], async_session_factory=None):
+        self.session_factory = session_factory
+        self.async_session_factory = async_session_factory
+
+    @property
+    def is_async(self) -> bool:
+        return self.async_session_factory is not None
+
+    def _run_sync(self, operation: Callable, *args):
+        db = self.session_factory()
+        try:
+            return operation(db, *args)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    async def run(self, operation: Callable, *args):
+        """operation(db, *args) を実行する（operation は同期の Session を受け取る関数）"""
+        if self.async_session_factory is None:
+            return await run_in_threadpool(self._run_sync, operation, *args)
+        async with self.async_session_factory() as db:
+            try:
+                return await db.run_sync(operation, *args)
+            except Exception:
+                await db.rollback()
+                raise
+
+    async def create_session(self, session_id: str, visa_types: List[str]) -> Optional[int]:
+        """Returns: セッションの主キー（メモリ上のセッションに db_id として持たせる）"""
+        return await self.run(create_consultation_session, session_id, visa_types)
+
+    async def save_answers(self, session_id: str, answers: List[Tuple[str, str]],
+                           memory: Dict, result: Optional[Dict] = None, db_id: Optional[int] = None):
+        await self.run(save_consultation_answers, session_id, answers, memory, result, db_id)
+
+    async def delete_last_answer(self, session_id: str, memory: Dict, db_id: Optional[int] = None):
+        await self.run(delete_last_consultation_answer, session_id, memory, db_id)
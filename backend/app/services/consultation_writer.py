@@ -0,0 +1,407 @@
+"""
+診断セッションの遅延書き込み（write-behind） - 回答をキューに積み、バックグラウンドでまとめて保存する
+
+次の質問はメモリ上の作業記憶だけで決まるため、回答のたびにDBのコミットを待つ必要はない。
+診断APIは保存内容（セッション作成・回答・戻る）をプロセス内の上限付きキューに積んですぐに応答し、
+書き込みスレッドがキューからまとめて取り出して1トランザクションで保存する
+（同じ種類の文は executemany でまとめ、バッチごとに1回だけコミットする）。
+
+耐久性（どこまで保存を待ってから応答するか）は durability で選ぶ:
+- none: 保存を待たない。プロセスが異常終了するとキューに残った分（最大でキューの上限、
+  通常は flush_interval 秒分）が失われる
+- completion（既定）: 診断が完了する回答だけ、その回答を含むバッチのコミットを待つ
+  （表示した診断結果は必ず保存されている。途中の回答は none と同じく失われうる）
+- all: すべての回答でコミットを待つ（失われないが、DBの待ち時間が応答に戻る。
+  同時に届いた回答は1回のコミットにまとめる）
+
+キューが一杯のとき（DBが遅い・止まっている）は on_full で選ぶ:
+- block（既定）: 空きができるまで応答を待たせる（失わない）
+- drop: 回答・戻るは保存を諦めて捨てる（dropped_events に数える）。
+  セッション作成は捨てると以降の保存がすべて無駄になるため、drop でも空きができるまで待つ
+
+コミットに失敗したバッチは間隔を倍にしながら max_retries 回までやり直す。
+それでも失敗したら、1件ずつ別のトランザクションで保存し直し、保存できなかった分だけを捨てる
+（1件の不正な保存内容でバッチ全体を失わないため）。同じセッションのそれ以降の保存内容は、
+回答の順序が崩れないよう保存せずに捨てる。DBに接続できない等（OperationalError）の場合は
+1件ずつにしても保存できないため、バッチ全体を捨てる。
+捨てた分は failed_events に数え、保存を待っていた応答にはエラーを返す。
+セッション作成を保存できなかったセッションは覚えておき、以降の保存内容もエラーにする
+（SessionNotSaved。DBにないセッションへの回答を黙って捨てない）。
+正常終了時（shutdown）はキューに残った分をすべて保存してから止まる。
+"""
+
+import asyncio
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from app.models import models
+from app.services.consultation_persistence import ConsultationPersistence
+
+# 耐久性
+DURABILITY_NONE = "none"
+DURABILITY_COMPLETION = "completion"
+DURABILITY_ALL = "all"
+DURABILITIES = (DURABILITY_NONE, DURABILITY_COMPLETION, DURABILITY_ALL)
+
+# キューが一杯のときの扱い
+ON_FULL_BLOCK = "block"
+ON_FULL_DROP = "drop"
+ON_FULL_POLICIES = (ON_FULL_BLOCK, ON_FULL_DROP)
+
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 0.2  # 秒
+DEFAULT_MAX_RETRIES = 5
+RETRY_DELAY = 0.5  # 秒（やり直すたびに倍にする）
+STOP_POLL_INTERVAL = 0.5  # 秒（キューが空の間に停止を確認する間隔）
+QUERY_CHUNK_SIZE = 500  # 1回の SELECT で引くセッション数（IN句の大きさ）
+UNSAVED_SESSIONS_LIMIT = 10000  # 作成を保存できなかったセッションを覚えておく数
+
+# キューに積む保存内容の種類
+_CREATE = "create"
+_ANSWERS = "answers"
+_UNDO = "undo"
+
+_sessions = models.ConsultationSession.__table__
+_answers = models.ConsultationAnswer.__table__
+
+
+class SessionNotSaved(Exception):
+    """セッション作成（または同じバッチの先行する保存内容）を保存できなかったため保存しない"""
+
+
+class _Event:
+    """キューに積む保存内容（waiter は保存を待つ応答の Future）"""
+
+    __slots__ = ("kind", "session_id", "payload", "at", "waiter")
+
+    def __init__(self, kind: str, session_id: str, payload, waiter=None):
+        self.kind = kind
+        self.session_id = session_id
+        self.payload = payload
+        self.at = datetime.utcnow()
+        self.waiter = waiter
+
+
+def _chunks(items: List, size: int = QUERY_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def write_events(db: Session, events: List[_Event]) -> int:
+    """
+    保存内容をまとめて1トランザクションで書き込む（コミットは呼び出し側）
+    セッションごとに回答・戻るを順に畳み込み、追加・削除・更新をそれぞれ executemany で実行する。
+    Returns: 書き込んだ保存内容の数（DBにセッションがないものは数えない）
+    """
+    created = [event for event in events if event.kind == _CREATE]
+    if created:
+        db.execute(_sessions.insert(), [
+            {"session_id": event.session_id, "visa_types": event.payload, "status": "in_progress",
+             "findings": {}, "hypotheses": {}, "evaluated_rules": [], "fired_rules": [],
+             "created_at": event.at, "updated_at": event.at}
+            for event in created
+        ])
+
+    # セッションのDB上のIDと、最後の回答の順序
+    session_ids = list({event.session_id for event in events if event.kind != _CREATE})
+    db_ids: Dict[str, int] = {}
+    for chunk in _chunks(session_ids):
+        db_ids.update(db.execute(
+            select(_sessions.c.session_id, _sessions.c.id).where(_sessions.c.session_id.in_(chunk))
+        ).all())
+    last_orders: Dict[int, int] = {}
+    for chunk in _chunks(list(db_ids.values())):
+        last_orders.update(db.execute(
+            select(_answers.c.session_id, func.max(_answers.c.question_order))
+            .where(_answers.c.session_id.in_(chunk))
+            .group_by(_answers.c.session_id)
+        ).all())
+
+    # セッションごとに畳み込む（このバッチ内で追加して戻した回答は書き込まない）
+    inserted: Dict[int, List[Dict]] = {}
+    deleted: List[Dict] = []
+    updated: Dict[int, Dict] = {}
+    written = len(created)
+    for event in events:
+        if event.kind == _CREATE:
+            continue
+        db_id = db_ids.get(event.session_id)
+        if db_id is None:
+            continue
+        order = last_orders.get(db_id, 0)
+        pending = inserted.setdefault(db_id, [])
+        values = updated.setdefault(db_id, {})
+        if event.kind == _ANSWERS:
+            answers, memory, result = event.payload
+            for fact, answer in answers:
+                order += 1
+                pending.append({"session_id": db_id, "fact_name": fact, "answer": answer,
+                                "question_order": order, "answered_at": event.at})
+            values.update(memory)
+            if result is not None:
+                values.update(status="completed", result=result, completed_at=event.at)
+        else:
+            if order == 0:
+                continue
+            if pending and pending[-1]["question_order"] == order:
+                pending.pop()
+            else:
+                deleted.append({"db_id": db_id, "db_order": order})
+            order -= 1
+            values.update(event.payload, status="in_progress")  # 完了状態から戻る場合もあるので
+        last_orders[db_id] = order
+        written += 1
+
+    if deleted:
+        db.execute(
+            _answers.delete().where(
+                _answers.c.session_id == bindparam("db_id"),
+                _answers.c.question_order == bindparam("db_order")
+            ),
+            deleted
+        )
+    rows = [row for pending in inserted.values() for row in pending]
+    if rows:
+        db.execute(_answers.insert(), rows)
+    # 更新する列の組み合わせごとにまとめる
+    groups: Dict[Tuple[str, ...], List[Dict]] = {}
+    for db_id, values in updated.items():
+        if values:
+            groups.setdefault(tuple(sorted(values)), []).append(dict(values, db_id=db_id))
+    for columns, params in groups.items():
+        db.execute(
+            _sessions.update()
+            .where(_sessions.c.id == bindparam("db_id"))
+            .values({column: bindparam(column) for column in columns}),
+            params
+        )
+    return written
+
+
+class WriteBehindPersistence(ConsultationPersistence):
+    """
+    診断APIの保存処理をキューに積み、書き込みスレッドでまとめて保存する
+    読み込み（run）は ConsultationPersistence と同じくその場で実行する。
+    """
+
+    def __init__(self, session_factory: Callable[[], Session], async_session_factory=None,
+                 queue_size: int = DEFAULT_QUEUE_SIZE, batch_size: int = DEFAULT_BATCH_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL, durability: str = DURABILITY_COMPLETION,
+                 on_full: str = ON_FULL_BLOCK, max_retries: int = DEFAULT_MAX_RETRIES):
+        if durability not in DURABILITIES:
+            raise ValueError(f"不正な耐久性の指定です: {durability}")
+        if on_full not in ON_FULL_POLICIES:
+            raise ValueError(f"不正なキューが一杯のときの指定です: {on_full}")
+        super().__init__(session_factory, async_session_factory)
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.on_full = on_full
+        self.max_retries = max_retries
+        self.written_events = 0  # 保存した数
+        self.batches = 0  # コミットした回数
+        self.dropped_events = 0  # キューが一杯で捨てた数
+        self.failed_events = 0  # やり直しても保存できずに捨てた数
+        self.last_error: Optional[str] = None
+        self._unsaved_sessions: Dict[str, None] = {}  # 作成を保存できなかったセッション（古い順）
+        self._queue: "queue.Queue[_Event]" = queue.Queue(maxsize=max(1, queue_size))
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    # ===== 診断APIから呼ぶ保存処理 =====
+    async def create_session(self, session_id: str, visa_types: List[str]) -> Optional[int]:
+        """Returns: None（主キーは書き込みスレッドが保存するまで分からない）"""
+        await self._enqueue(_Event(_CREATE, session_id, visa_types), self.durability == DURABILITY_ALL)
+        return None
+
+    async def save_answers(self, session_id: str, answers: List[Tuple[str, str]],
+                           memory: Dict, result: Optional[Dict] = None, db_id: Optional[int] = None):
+        wait = self.durability == DURABILITY_ALL or (
+            self.durability == DURABILITY_COMPLETION and result is not None
+        )
+        await self._enqueue(_Event(_ANSWERS, session_id, (answers, memory, result)), wait)
+
+    async def delete_last_answer(self, session_id: str, memory: Dict, db_id: Optional[int] = None):
+        await self._enqueue(_Event(_UNDO, session_id, memory), self.durability == DURABILITY_ALL)
+
+    async def _enqueue(self, event: _Event, wait: bool):
+        loop = asyncio.get_running_loop()
+        if wait:
+            event.waiter = (loop, loop.create_future())
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            if self.on_full == ON_FULL_DROP and event.kind != _CREATE:
+                self.dropped_events += 1
+                return
+            await loop.run_in_executor(None, self._queue.put, event)
+        if wait:
+            await event.waiter[1]
+
+    # ===== 書き込みスレッド =====
+    def _next_batch(self) -> List[_Event]:
+        """最初の1件が届いてから flush_interval 秒または batch_size 件までまとめて取り出す"""
+        try:
+            batch = [self._queue.get(timeout=STOP_POLL_INTERVAL)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, events: List[_Event]) -> Optional[Exception]:
+        """保存内容を1トランザクションで保存する Returns: 失敗"""
+        db = self.session_factory()
+        try:
+            written = write_events(db, events)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            self.last_error = f"{type(e).__name__}: {e}"
+            return e
+        finally:
+            db.close()
+        self.written_events += written
+        self.batches += 1
+        return None
+
+    def _write(self, batch: List[_Event]) -> List[Optional[Exception]]:
+        """
+        バッチを保存する（まとめて失敗したらやり直し、それでも失敗したら1件ずつ保存し直す）
+        Returns: 保存内容ごとの失敗（batch と同順、保存できたものは None）
+        """
+        errors: List[Optional[Exception]] = [None] * len(batch)
+        events = []
+        for i, event in enumerate(batch):
+            if event.session_id in self._unsaved_sessions:
+                errors[i] = SessionNotSaved(f"診断セッションの作成を保存できていません: {event.session_id}")
+            else:
+                events.append(event)
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if not events:
+                break
+            if attempt:
+                time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+            error = self._commit(events)
+            if error is None:
+                break
+        else:
+            if len(events) == 1 or isinstance(error, OperationalError):
+                for i, event in enumerate(batch):
+                    errors[i] = errors[i] or error
+            else:
+                errors = self._write_each(batch, errors)
+
+        for event, event_error in zip(batch, errors):
+            if event_error is not None:
+                self.failed_events += 1
+                if event.kind == _CREATE:
+                    self._unsaved_sessions[event.session_id] = None
+                    if len(self._unsaved_sessions) > UNSAVED_SESSIONS_LIMIT:
+                        del self._unsaved_sessions[next(iter(self._unsaved_sessions))]
+        return errors
+
+    def _write_each(self, batch: List[_Event], errors: List[Optional[Exception]]) -> List[Optional[Exception]]:
+        """1件ずつ保存し直す（失敗したセッションのそれ以降の保存内容は保存しない）"""
+        failed_sessions: Dict[str, Exception] = {}
+        for i, event in enumerate(batch):
+            if errors[i] is not None:
+                continue
+            previous = failed_sessions.get(event.session_id)
+            if previous is not None:
+                errors[i] = SessionNotSaved(f"同じセッションの先行する保存に失敗しました: {previous}")
+                continue
+            errors[i] = self._commit([event])
+            if errors[i] is not None:
+                failed_sessions[event.session_id] = errors[i]
+        return errors
+
+    def write_pending(self) -> int:
+        """
+        キューに積まれた分をその場でまとめて保存する（書き込みスレッドと同じ処理）
+        Returns: 保存したバッチの数
+        """
+        count = 0
+        while True:
+            batch = []
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return count
+            self._finish(batch, self._write(batch))
+            count += 1
+
+    def _finish(self, batch: List[_Event], errors: List[Optional[Exception]]):
+        for event, error in zip(batch, errors):
+            if event.waiter is not None:
+                loop, future = event.waiter
+                loop.call_soon_threadsafe(_resolve, future, error)
+            self._queue.task_done()
+
+    def _run(self):
+        while not self._stop.is_set():
+            batch = self._next_batch()
+            if batch:
+                self._finish(batch, self._write(batch))
+        # 停止時はキューに残った分をすべて保存する
+        self.write_pending()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="consultation-writer", daemon=True)
+        self._thread.start()
+
+    def flush(self):
+        """キューに積んだ分の保存が終わるまで待つ"""
+        if self._thread is None:
+            self.write_pending()
+        else:
+            self._queue.join()
+
+    def stop(self):
+        """キューに残った分を保存してから書き込みスレッドを止める"""
+        if self._thread is None:
+            self.write_pending()
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def stats(self) -> Dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written_events": self.written_events,
+            "batches": self.batches,
+            "dropped_events": self.dropped_events,
+            "failed_events": self.failed_events,
+            "unsaved_sessions": len(self._unsaved_sessions),
+            "last_error": self.last_error
+        }
+
+
+def _resolve(future: asyncio.Future, error: Optional[Exception]):
+    if future.done():
+        return
+    if error is None:
+        future.set_result(None)
+    else:
+        future.set_exception(error)
@@ -3,7 +3,13 @@
 システムイメージ.txt完全準拠版
 """
 
-from typing import Dict, List, Set, Optional, Tuple
+import hashlib
+import heapq
+import json
+from contextlib import contextmanager
+from collections.abc import MutableMapping, MutableSet
+from types import MappingProxyType
+from typing import Dict, Iterable, List, Mapping, Set, Optional, Tuple, Union
 from dataclasses import dataclass, field
 from enum import Enum
 
@@ -20,8 +26,101 @@ class RuleStatus(Enum):
     FAILED = "failed"
     SKIPPED = "skipped"
 
+# ルール評価モード
+EVALUATION_MODE_SCAN = "scan"  # 回答ごとに全ルールを走査（従来方式）
+EVALUATION_MODE_AGENDA = "agenda"  # 変化した事実に依存するルールのみをアジェンダで評価
+EVALUATION_MODES = (EVALUATION_MODE_SCAN, EVALUATION_MODE_AGENDA)
+
+# 差分記録で「値が存在しなかった」ことを表す印
+_MISSING = object()
+# 差分記録で「集合に含まれていた」ことを表す印（取り消しを記録した差分でのみ使う）
+_PRESENT = object()
+
+class _JournalMixin:
+    """
+    作業記憶への書き込みを差分（トレイル）として記録する - 戻る機能用
+    journal() の間に set_finding 等で書き込むと、書き込み前の値がトレイルに積まれ、
+    rollback(trail) でその回答の変更だけを O(差分) で取り消せる
+    """
+
+    __slots__ = ()
+
+    @contextmanager
+    def journal(self):
+        trail = []
+        self.trail = trail
+        try:
+            yield trail
+        finally:
+            self.trail = None
+
+    def _record_map(self, name: str, mapping, key):
+        if self.trail is not None:
+            self.trail.append((name, key, mapping.get(key, _MISSING)))
+
+    def _record_set(self, name: str, members, key):
+        if self.trail is not None and key not in members:
+            self.trail.append((name, key, _MISSING))
+
+    def set_finding(self, fact: str, value: bool):
+        findings = self.findings
+        self._record_map("findings", findings, fact)
+        findings[fact] = value
+
+    def set_hypothesis(self, fact: str, value: bool):
+        hypotheses = self.hypotheses
+        self._record_map("hypotheses", hypotheses, fact)
+        hypotheses[fact] = value
+
+    def set_rule_status(self, rule_id: int, status: "RuleStatus"):
+        self._record_map("evaluated_rules", self.evaluated_rules, rule_id)
+        self.evaluated_rules[rule_id] = status
+
+    def add_conflict(self, rule_id: int):
+        self._record_set("conflict_set", self.conflict_set, rule_id)
+        self.conflict_set.add(rule_id)
+
+    def add_skipped_fact(self, fact: str):
+        skipped_facts = self.skipped_facts
+        self._record_set("skipped_facts", skipped_facts, fact)
+        skipped_facts.add(fact)
+
+    def add_asked_derivable_fact(self, fact: str):
+        asked = self.asked_derivable_facts
+        self._record_set("asked_derivable_facts", asked, fact)
+        asked.add(fact)
+
+    def rollback(self, trail: List[Tuple]):
+        """
+        トレイルを逆順に適用し、journal() 開始時点の状態に戻す
+        journal() の間に呼ぶと、取り消した変更も差分として記録する（その差分で取り消しを取り消せる）
+        """
+        record = self.trail
+        for name, key, old in reversed(trail):
+            if name == "mask":
+                if record is not None:
+                    record.append((name, key, getattr(self, key)))
+                setattr(self, key, old)
+                continue
+            container = getattr(self, name)
+            if isinstance(container, MutableMapping):
+                if record is not None:
+                    record.append((name, key, container.get(key, _MISSING)))
+                if old is _MISSING:
+                    del container[key]
+                else:
+                    container[key] = old
+            elif old is _PRESENT:
+                if record is not None and key not in container:
+                    record.append((name, key, _MISSING))
+                container.add(key)
+            else:
+                if record is not None and key in container:
+                    record.append((name, key, _PRESENT))
+                container.discard(key)
+
 @dataclass
-class WorkingMemory:
+class WorkingMemory(_JournalMixin):
     """作業記憶 - Smalltalkの WorkingMemory に相当"""
     findings: Dict[str, bool] = field(default_factory=dict)  # 確認された基本事実
     hypotheses: Dict[str, bool] = field(default_factory=dict)  # 導出された仮説
@@ -29,6 +128,357 @@ class WorkingMemory:
     evaluated_rules: Dict[int, RuleStatus] = field(default_factory=dict)  # ルール評価状態
     skipped_facts: Set[str] = field(default_factory=set)  # スキップされた事実
     asked_derivable_facts: Set[str] = field(default_factory=set)  # 直接質問した導出可能な事実
+    trail: Optional[List[Tuple]] = field(default=None, repr=False, compare=False)  # 記録中の差分
+
+    def to_dict(self) -> Dict:
+        """API・DB用の辞書形式に変換"""
+        return {
+            "findings": dict(self.findings),
+            "hypotheses": dict(self.hypotheses),
+            "conflict_set": sorted(self.conflict_set),
+            "evaluated_rules": {rule_id: status.value for rule_id, status in self.evaluated_rules.items()},
+            "skipped_facts": list(self.skipped_facts),
+            "asked_derivable_facts": list(self.asked_derivable_facts)
+        }
+
+    def load_dict(self, data: Dict):
+        """to_dict() 形式の辞書から状態を復元"""
+        self.findings = dict(data.get("findings", {}))
+        self.hypotheses = dict(data.get("hypotheses", {}))
+        self.conflict_set = set(data.get("conflict_set", []))
+        self.evaluated_rules = {
+            int(rule_id): RuleStatus(status)
+            for rule_id, status in data.get("evaluated_rules", {}).items()
+        }
+        self.skipped_facts = set(data.get("skipped_facts", []))
+        self.asked_derivable_facts = set(data.get("asked_derivable_facts", []))
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "WorkingMemory":
+        wm = cls()
+        wm.load_dict(data)
+        return wm
+
+class FactTable:
+    """
+    事実の内部ID表
+    ルールベースに現れる事実文字列を小さな整数に対応付け、ビットマスクで扱えるようにする
+    """
+
+    __slots__ = ("facts", "ids")
+
+    def __init__(self, facts: Iterable[str] = ()):
+        self.facts: List[str] = []
+        self.ids: Dict[str, int] = {}
+        for fact in facts:
+            if fact not in self.ids:
+                self.ids[fact] = len(self.facts)
+                self.facts.append(fact)
+
+    @classmethod
+    def from_rules(cls, rules: Iterable["Rule"]) -> "FactTable":
+        """ルールの条件部・結論部に現れる事実から表を作成"""
+        facts = []
+        for rule in rules:
+            facts.extend(cond["fact"] for cond in rule.conditions)
+            facts.extend(action["fact"] for action in rule.actions)
+        return cls(facts)
+
+    def __len__(self) -> int:
+        return len(self.facts)
+
+    def __contains__(self, fact: str) -> bool:
+        return fact in self.ids
+
+    def bit(self, fact: str) -> int:
+        """事実のビット（表にない事実は0）"""
+        fact_id = self.ids.get(fact)
+        return 0 if fact_id is None else 1 << fact_id
+
+    def mask_of(self, facts: Iterable[str]) -> int:
+        """事実の集合をビットマスクに変換"""
+        mask = 0
+        for fact in facts:
+            mask |= self.bit(fact)
+        return mask
+
+    def facts_of(self, mask: int) -> List[str]:
+        """ビットマスクを事実のリスト（ID順）に変換"""
+        facts = []
+        while mask:
+            low = mask & -mask
+            facts.append(self.facts[low.bit_length() - 1])
+            mask ^= low
+        return facts
+
+class _FactMaskMap(MutableMapping):
+    """
+    BitsetWorkingMemory の findings / hypotheses を辞書として見せるビュー
+    列挙は辞書と同じく挿入順（値の更新では順序は変わらず、削除して入れ直すと末尾に移る）
+    """
+
+    __slots__ = ("_wm", "_name")
+
+    def __init__(self, wm: "BitsetWorkingMemory", name: str):
+        self._wm = wm
+        self._name = name
+
+    def _extra(self, create: bool = False) -> Optional[Dict[str, bool]]:
+        # 事実表にない事実（APIから直接回答された事実等）の退避先
+        extra = self._wm.extra
+        if extra is None:
+            if not create:
+                return None
+            extra = self._wm.extra = {}
+        if create:
+            return extra.setdefault(self._name, {})
+        return extra.get(self._name)
+
+    def __getitem__(self, fact: str) -> bool:
+        fact_id = self._wm.fact_table.ids.get(fact)
+        if fact_id is None:
+            extra = self._extra()
+            if extra is None:
+                raise KeyError(fact)
+            return extra[fact]
+        known, true = self._wm.masks(self._name)
+        bit = 1 << fact_id
+        if not known & bit:
+            raise KeyError(fact)
+        return bool(true & bit)
+
+    def __contains__(self, fact) -> bool:
+        fact_id = self._wm.fact_table.ids.get(fact)
+        if fact_id is None:
+            extra = self._extra()
+            return extra is not None and fact in extra
+        known, _ = self._wm.masks(self._name)
+        return bool(known >> fact_id & 1)
+
+    def __setitem__(self, fact: str, value: bool):
+        fact_id = self._wm.fact_table.ids.get(fact)
+        self._wm.order[self._name].setdefault(fact)
+        if fact_id is None:
+            self._extra(create=True)[fact] = bool(value)
+            return
+        known, true = self._wm.masks(self._name)
+        bit = 1 << fact_id
+        self._wm.set_masks(self._name, known | bit, true | bit if value else true & ~bit)
+
+    def __delitem__(self, fact: str):
+        fact_id = self._wm.fact_table.ids.get(fact)
+        if fact_id is None:
+            extra = self._extra()
+            if extra is None:
+                raise KeyError(fact)
+            del extra[fact]
+            self._wm.order[self._name].pop(fact, None)
+            return
+        known, true = self._wm.masks(self._name)
+        bit = 1 << fact_id
+        if not known & bit:
+            raise KeyError(fact)
+        self._wm.set_masks(self._name, known & ~bit, true & ~bit)
+        self._wm.order[self._name].pop(fact, None)
+
+    def __iter__(self):
+        order = self._wm.order[self._name]
+        facts = list(order)
+        yield from facts
+        if len(facts) < len(self):
+            # マスクを直接設定した事実（挿入順が分からない）は後ろにID順で並べる
+            known, _ = self._wm.masks(self._name)
+            yield from self._wm.fact_table.facts_of(known & ~self._wm.fact_table.mask_of(facts))
+            extra = self._extra()
+            if extra:
+                yield from [fact for fact in extra if fact not in order]
+
+    def __len__(self) -> int:
+        known, _ = self._wm.masks(self._name)
+        extra = self._extra()
+        return known.bit_count() + (len(extra) if extra else 0)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+class _FactMaskSet(MutableSet):
+    """BitsetWorkingMemory の skipped_facts / asked_derivable_facts を集合として見せるビュー"""
+
+    __slots__ = ("_wm", "_name")
+
+    def __init__(self, wm: "BitsetWorkingMemory", name: str):
+        self._wm = wm
+        self._name = name
+
+    def _extra(self, create: bool = False) -> Optional[Set[str]]:
+        extra = self._wm.extra
+        if extra is None:
+            if not create:
+                return None
+            extra = self._wm.extra = {}
+        if create:
+            return extra.setdefault(self._name, set())
+        return extra.get(self._name)
+
+    def __contains__(self, fact) -> bool:
+        fact_id = self._wm.fact_table.ids.get(fact)
+        if fact_id is None:
+            extra = self._extra()
+            return extra is not None and fact in extra
+        return bool(getattr(self._wm, self._name) >> fact_id & 1)
+
+    def add(self, fact: str):
+        fact_id = self._wm.fact_table.ids.get(fact)
+        if fact_id is None:
+            self._extra(create=True).add(fact)
+            return
+        setattr(self._wm, self._name, getattr(self._wm, self._name) | 1 << fact_id)
+
+    def discard(self, fact: str):
+        fact_id = self._wm.fact_table.ids.get(fact)
+        if fact_id is None:
+            extra = self._extra()
+            if extra is not None:
+                extra.discard(fact)
+            return
+        setattr(self._wm, self._name, getattr(self._wm, self._name) & ~(1 << fact_id))
+
+    def __iter__(self):
+        yield from self._wm.fact_table.facts_of(getattr(self._wm, self._name))
+        extra = self._extra()
+        if extra:
+            yield from list(extra)
+
+    def __len__(self) -> int:
+        extra = self._extra()
+        return getattr(self._wm, self._name).bit_count() + (len(extra) if extra else 0)
+
+    def __repr__(self) -> str:
+        return repr(set(self))
+
+class BitsetWorkingMemory(_JournalMixin):
+    """
+    ビットマスク版の作業記憶
+    事実を FactTable の内部IDで表し、既知/真偽/スキップ/直接質問をそれぞれ整数のビットマスクで保持する。
+    findings 等は辞書・集合のビューとして公開するため、WorkingMemory と同じように扱える。
+    """
+
+    __slots__ = (
+        "fact_table",
+        "known_findings", "true_findings",  # 確認された基本事実
+        "known_hypotheses", "true_hypotheses",  # 導出された仮説
+        "skipped_mask",  # スキップされた事実
+        "asked_mask",  # 直接質問した導出可能な事実
+        "conflict_set",  # 発火したルールの集合
+        "evaluated_rules",  # ルール評価状態
+        "extra",  # 事実表にない事実（通常は None）
+        "order",  # findings / hypotheses の挿入順（辞書版と同じ順で列挙するため）
+        "trail",  # 記録中の差分（journal() の間のみ）
+    )
+
+    _MAP_MASKS = {
+        "findings": ("known_findings", "true_findings"),
+        "hypotheses": ("known_hypotheses", "true_hypotheses"),
+    }
+
+    def __init__(self, fact_table: FactTable):
+        self.fact_table = fact_table
+        self.known_findings = 0
+        self.true_findings = 0
+        self.known_hypotheses = 0
+        self.true_hypotheses = 0
+        self.skipped_mask = 0
+        self.asked_mask = 0
+        self.conflict_set: Set[int] = set()
+        self.evaluated_rules: Dict[int, RuleStatus] = {}
+        self.extra: Optional[Dict] = None
+        self.order: Dict[str, Dict[str, None]] = {"findings": {}, "hypotheses": {}}
+        self.trail: Optional[List[Tuple]] = None
+
+    def add_skipped_mask(self, mask: int):
+        """ビットマスクでまとめてスキップ（差分はマスクの旧値として記録）"""
+        if self.trail is not None:
+            self.trail.append(("mask", "skipped_mask", self.skipped_mask))
+        self.skipped_mask |= mask
+
+    def masks(self, name: str) -> Tuple[int, int]:
+        known_attr, true_attr = self._MAP_MASKS[name]
+        return getattr(self, known_attr), getattr(self, true_attr)
+
+    def set_masks(self, name: str, known: int, true: int):
+        known_attr, true_attr = self._MAP_MASKS[name]
+        setattr(self, known_attr, known)
+        setattr(self, true_attr, true)
+
+    def _load_map(self, name: str, values: Dict[str, bool]):
+        self.set_masks(name, 0, 0)
+        self.order[name] = {}
+        if self.extra is not None:
+            self.extra.pop(name, None)
+        view = _FactMaskMap(self, name)
+        for fact, value in values.items():
+            view[fact] = value
+
+    def _load_set(self, name: str, facts: Iterable[str]):
+        setattr(self, name, 0)
+        if self.extra is not None:
+            self.extra.pop(name, None)
+        view = _FactMaskSet(self, name)
+        for fact in facts:
+            view.add(fact)
+
+    @property
+    def findings(self) -> _FactMaskMap:
+        return _FactMaskMap(self, "findings")
+
+    @findings.setter
+    def findings(self, values: Dict[str, bool]):
+        self._load_map("findings", values)
+
+    @property
+    def hypotheses(self) -> _FactMaskMap:
+        return _FactMaskMap(self, "hypotheses")
+
+    @hypotheses.setter
+    def hypotheses(self, values: Dict[str, bool]):
+        self._load_map("hypotheses", values)
+
+    @property
+    def skipped_facts(self) -> _FactMaskSet:
+        return _FactMaskSet(self, "skipped_mask")
+
+    @skipped_facts.setter
+    def skipped_facts(self, facts: Iterable[str]):
+        self._load_set("skipped_mask", facts)
+
+    @property
+    def asked_derivable_facts(self) -> _FactMaskSet:
+        return _FactMaskSet(self, "asked_mask")
+
+    @asked_derivable_facts.setter
+    def asked_derivable_facts(self, facts: Iterable[str]):
+        self._load_set("asked_mask", facts)
+
+    @property
+    def known_mask(self) -> int:
+        """値が判明している事実（findings または hypotheses）"""
+        return self.known_findings | self.known_hypotheses
+
+    @property
+    def true_mask(self) -> int:
+        """真と判明している事実（findings を hypotheses より優先）"""
+        return (self.true_findings & self.known_findings) | \
+            (self.true_hypotheses & self.known_hypotheses & ~self.known_findings)
+
+    to_dict = WorkingMemory.to_dict
+    load_dict = WorkingMemory.load_dict
+
+    @classmethod
+    def from_dict(cls, data: Dict, fact_table: FactTable) -> "BitsetWorkingMemory":
+        wm = cls(fact_table)
+        wm.load_dict(data)
+        return wm
+
 
 @dataclass
 class Rule:
@@ -40,49 +490,45 @@ class Rule:
     conditions: List[Dict]
     actions: List[Dict]
     flag: bool
+    priority: Optional[int] = None  # 質問の優先順位（小さいほど優先、未指定はルールID）
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Rule":
+        """ルール定義（VISA_RULES 形式の辞書）から作成"""
+        return cls(
+            id=data["id"],
+            name=data["name"],
+            visa_type=data["visa_type"],
+            rule_type=data["rule_type"],
+            conditions=data["conditions"],
+            actions=data["actions"],
+            flag=data["flag"],
+            priority=data.get("priority")
+        )
+
+    @property
+    def effective_priority(self) -> int:
+        return self.id if self.priority is None else self.priority
 
-    def check_conditions(self, wm: WorkingMemory) -> Tuple[bool, List[str], List[str]]:
+    def condition_groups(self) -> Tuple[Tuple[str, ...], ...]:
         """
-        条件をチェック
-        Returns: (全条件成立?, 満たされた条件, 満たされていない条件)
+        条件を AND-of-OR 形式にまとめる
+        operator が "OR" の連続する条件を1つのORグループとし、それ以外の条件は1件ずつのグループとする。
+        ルールは全グループが成立したときに成立する。
         """
-        if not self.conditions:
-            return True, [], []
-
-        satisfied = []
-        unsatisfied = []
-        unknown = []
-
+        groups = []
+        or_group = []
         for cond in self.conditions:
-            fact = cond["fact"]
-
-            # スキップされた事実は評価不要
-            if fact in wm.skipped_facts:
-                continue
-
-            # findingsまたはhypothesesから値を取得
-            if fact in wm.findings:
-                value = wm.findings[fact]
-            elif fact in wm.hypotheses:
-                value = wm.hypotheses[fact]
-            else:
-                unknown.append(fact)
+            if str(cond.get("operator", "AND")).upper() == "OR":
+                or_group.append(cond["fact"])
                 continue
-
-            if value:
-                satisfied.append(fact)
-            else:
-                unsatisfied.append(fact)
-
-        # AND条件の場合、一つでもfalseがあれば失敗
-        if unsatisfied:
-            return False, satisfied, unsatisfied + unknown
-
-        # 全て判明していて満たされている
-        if unknown:
-            return False, satisfied, unknown
-
-        return True, satisfied, []
+            if or_group:
+                groups.append(tuple(or_group))
+                or_group = []
+            groups.append((cond["fact"],))
+        if or_group:
+            groups.append(tuple(or_group))
+        return tuple(groups)
 
     def fire(self, wm: WorkingMemory) -> List[str]:
         """ルールを発火させ、結論を導出"""
@@ -90,19 +536,96 @@ class Rule:
         for action in self.actions:
             fact = action["fact"]
             value = action.get("value", True)
-            wm.hypotheses[fact] = value
+            wm.set_hypothesis(fact, value)
             derived_facts.append(fact)
         return derived_facts
 
-class InferenceEngine:
-    """推論エンジン - システムイメージ.txt完全準拠"""
-
-    def __init__(self, rules: List[Rule]):
-        self.rules = {rule.id: rule for rule in rules}
+@dataclass(frozen=True)
+class GoalSet:
+    """セッションのゴール集合 - 質問スコアのうちゴールで決まる部分を事前計算したもの"""
+    goals: Tuple[str, ...]
+    goal_mask: int  # ゴール自体（質問しない）
+    visa_type_bonuses: Tuple[int, ...]  # goals と同順
+
+def visa_type_bonus(goal: str) -> int:
+    """ビザタイプ優先度ボーナス（E > L > B）"""
+    if "Eビザ" in goal:
+        return 50  # Eビザ最優先
+    if "Lビザ" in goal or "Blanket L" in goal:
+        return 30  # Lビザ次
+    if "Bビザ" in goal or "B-1" in goal:
+        return 10  # Bビザ最後
+    return 0
+
+class RuleBase:
+    """
+    コンパイル済みルールベース（不変）
+    索引・事実表・ゴール閉包・質問スコア表をルールベースのバージョンごとに一度だけ構築し、
+    全セッション・全エンジンで読み取り専用として共有する。
+    ゴール閉包とゴール集合はルールベースのみで決まる値を初回利用時にキャッシュする。
+    """
+
+    __slots__ = (
+        "version", "fingerprint", "rules", "fact_to_deriving_rules", "fact_to_dependent_rules",
+        "rule_order", "unconditional_rule_ids", "fact_table", "condition_masks",
+        "condition_groups", "condition_group_masks",
+        "derivable_mask", "derivation_masks", "derivation_group_masks", "or_member_mask", "static_question_scores",
+        "_closure_cache", "_goal_set_cache", "_frozen",
+    )
+
+    def __init__(self, rules: Iterable[Rule], version: int = 0):
+        self.version = version
+        self.rules = MappingProxyType({rule.id: rule for rule in rules})
+        self.fingerprint = self._build_fingerprint()
         self.fact_to_deriving_rules = self._build_fact_to_rules_map()
         self.fact_to_dependent_rules = self._build_dependency_map()
+        # アジェンダ用: ルールID→走査順（全走査と同じ順序で発火させるため）
+        self.rule_order = MappingProxyType({rule_id: i for i, rule_id in enumerate(self.rules)})
+        self.unconditional_rule_ids = tuple(
+            rule_id for rule_id, rule in self.rules.items() if not rule.conditions
+        )
+        # 事実の内部ID表と、ルールごとの条件ビットマスク（BitsetWorkingMemory用）
+        self.fact_table = FactTable.from_rules(self.rules.values())
+        self.condition_masks = MappingProxyType({
+            rule_id: self.fact_table.mask_of(cond["fact"] for cond in rule.conditions)
+            for rule_id, rule in self.rules.items()
+        })
+        # 条件の AND-of-OR 形式（事実名のタプルと、グループごとのビットマスク）
+        self.condition_groups = MappingProxyType({
+            rule_id: rule.condition_groups() for rule_id, rule in self.rules.items()
+        })
+        self.condition_group_masks = MappingProxyType({
+            rule_id: tuple(self.fact_table.mask_of(group) for group in groups)
+            for rule_id, groups in self.condition_groups.items()
+        })
+        # ゴール閉包: 事実→最も条件の少ない導出ルールの条件事実（ルールベースのみで決まる）
+        self.derivable_mask = self.fact_table.mask_of(self.fact_to_deriving_rules)
+        self.derivation_masks, self.derivation_group_masks = self._build_derivation_masks()
+        # 2件以上のメンバーを持つORグループに現れる事実（1件が true になると兄弟が不要になりうる）
+        self.or_member_mask = self.fact_table.mask_of(
+            fact for groups in self.condition_groups.values() for group in groups if len(group) > 1 for fact in group
+        )
+        self._closure_cache: Dict[int, int] = {}
+        # 質問スコアのうちルールベースのみで決まる部分（事実ID順）
+        self.static_question_scores = self._build_static_question_scores()
+        self._goal_set_cache: Dict[Tuple[str, ...], GoalSet] = {}
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise AttributeError("RuleBase は変更できません。新しいバージョンを構築してください")
+        object.__setattr__(self, name, value)
+
+    def _build_fingerprint(self) -> str:
+        """推論結果に影響するルール内容のハッシュ（事前コンパイルした成果物の照合用）"""
+        payload = [
+            [rule.id, rule.conditions, rule.actions, rule.flag, rule.effective_priority]
+            for rule in self.rules.values()
+        ]
+        encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()[:16]
 
-    def _build_fact_to_rules_map(self) -> Dict[str, List[int]]:
+    def _build_fact_to_rules_map(self) -> Mapping[str, Tuple[int, ...]]:
         """事実→それを導出するルールIDのマッピング"""
         mapping = {}
         for rule_id, rule in self.rules.items():
@@ -111,9 +634,9 @@ class InferenceEngine:
                 if fact not in mapping:
                     mapping[fact] = []
                 mapping[fact].append(rule_id)
-        return mapping
+        return MappingProxyType({fact: tuple(rule_ids) for fact, rule_ids in mapping.items()})
 
-    def _build_dependency_map(self) -> Dict[str, List[int]]:
+    def _build_dependency_map(self) -> Mapping[str, Tuple[int, ...]]:
         """事実→それを条件とするルールIDのマッピング"""
         mapping = {}
         for rule_id, rule in self.rules.items():
@@ -122,7 +645,218 @@ class InferenceEngine:
                 if fact not in mapping:
                     mapping[fact] = []
                 mapping[fact].append(rule_id)
-        return mapping
+        return MappingProxyType({fact: tuple(rule_ids) for fact, rule_ids in mapping.items()})
+
+    def _build_derivation_masks(self) -> Tuple[Mapping[int, int], Mapping[int, Tuple[int, ...]]]:
+        """
+        導出可能な事実ID→最も条件の少ない導出ルールの (条件ビットマスク, ORグループごとのビットマスク)
+        """
+        masks = {}
+        group_masks = {}
+        for fact, rule_ids in self.fact_to_deriving_rules.items():
+            min_rule = min(
+                [self.rules[rid] for rid in rule_ids if rid in self.rules],
+                key=lambda r: len(r.conditions),
+                default=None
+            )
+            if min_rule:
+                fact_id = self.fact_table.ids[fact]
+                masks[fact_id] = self.condition_masks[min_rule.id]
+                group_masks[fact_id] = self.condition_group_masks[min_rule.id]
+        return MappingProxyType(masks), MappingProxyType(group_masks)
+
+    def _build_static_question_scores(self) -> Tuple[int, ...]:
+        """
+        事実ごとの静的な質問スコア（システムイメージ.txt 行41-46準拠）
+        - ルール優先度（その事実を条件とするルールの priority が小さいほど高得点）
+        - 基本事実を優先（ユーザーが直接答えられる）
+        - 答えやすい質問を優先（短い質問文）
+        ビザタイプ優先度（E > L > B）はゴール集合ごとに GoalSet で計算する
+        """
+        scores = []
+        for fact in self.fact_table.facts:
+            score = 0
+
+            # ルール優先度ボーナス（priority 1-10 → 97-70点）
+            priorities = [self.rules[rid].effective_priority for rid in self.get_dependent_rules(fact)]
+            if priorities:
+                score += max(0, 100 - min(priorities) * 3)
+
+            # 基本事実を優先（ユーザーが直接答えられる）
+            if self.is_basic_fact(fact):
+                score += 40  # 基本事実を優先
+            else:
+                score += 20  # 導出可能な事実は次点
+
+            # 答えやすさボーナス（短い質問文 = 抽象的で答えやすい）
+            if len(fact) <= 30:
+                score += 20  # 短い質問は答えやすい
+
+            scores.append(score)
+        return tuple(scores)
+
+    def compile_goal_set(self, goals: List[str]) -> GoalSet:
+        """ゴール集合を事前計算（同じ組み合わせはキャッシュを再利用）"""
+        key = tuple(goals)
+        goal_set = self._goal_set_cache.get(key)
+        if goal_set is None:
+            goal_set = GoalSet(
+                goals=key,
+                goal_mask=self.fact_table.mask_of(key),
+                visa_type_bonuses=tuple(visa_type_bonus(goal) for goal in key)
+            )
+            self._goal_set_cache[key] = goal_set
+        return goal_set
+
+    def _expand(self, frontier: int, true: int = 0) -> int:
+        """
+        frontier の各事実について、最小導出ルールの条件事実を集める
+        true を渡すと、true のメンバーを含む（成立済みの）グループの事実は集めない
+        """
+        expanded = 0
+        frontier &= self.derivable_mask
+        while frontier:
+            low = frontier & -frontier
+            fact_id = low.bit_length() - 1
+            if true:
+                for group in self.derivation_group_masks.get(fact_id, ()):
+                    if not group & true:
+                        expanded |= group
+            else:
+                expanded |= self.derivation_masks.get(fact_id, 0)
+            frontier ^= low
+        return expanded
+
+    def get_goal_closure(self, goal: str) -> int:
+        """
+        ゴールの静的閉包（最小導出ルールをたどって到達する全事実、ゴール自身を含む）
+        ルールベースのみで決まるため、一度計算したらキャッシュする
+        """
+        goal_id = self.fact_table.ids[goal]
+        closure = self._closure_cache.get(goal_id)
+        if closure is None:
+            closure = frontier = 1 << goal_id
+            while frontier:
+                frontier = self._expand(frontier) & ~closure
+                closure |= frontier
+            self._closure_cache[goal_id] = closure
+        return closure
+
+    def memory_masks(self, wm: WorkingMemory) -> Tuple[int, int]:
+        """作業記憶の (判明済み事実, スキップされた事実) のビットマスク"""
+        if isinstance(wm, BitsetWorkingMemory) and wm.fact_table is self.fact_table:
+            return wm.known_mask, wm.skipped_mask
+        table = self.fact_table
+        return table.mask_of(wm.findings) | table.mask_of(wm.hypotheses), table.mask_of(wm.skipped_facts)
+
+    def true_mask(self, wm: WorkingMemory) -> int:
+        """作業記憶で真と判明している事実のビットマスク（findings を hypotheses より優先）"""
+        if isinstance(wm, BitsetWorkingMemory) and wm.fact_table is self.fact_table:
+            return wm.true_mask
+        findings = wm.findings
+        return self.fact_table.mask_of(
+            [fact for fact, value in findings.items() if value]
+            + [fact for fact, value in wm.hypotheses.items() if value and fact not in findings]
+        )
+
+    def get_needed_fact_mask(self, goal: str, known: int, true: int = 0) -> int:
+        """
+        ゴール達成に必要な事実のビットマスク（導出可能な事実を含む）
+        判明済みの事実はたどらない。true（真と判明済みの事実）を渡すと、既に成立したORグループの
+        残りのメンバーもたどらない。閉包の内部に判明済みの導出可能な事実も true のORメンバーもなければ
+        閉包との差分だけで求まり、ある場合のみ閉包をたどり直す。
+        事実表にないゴールはどのルールにも現れないため0を返す。
+        """
+        goal_bit = self.fact_table.bit(goal)
+        if not goal_bit or goal_bit & known:
+            return 0
+
+        closure = self.get_goal_closure(goal)
+        true &= closure & self.or_member_mask
+        if not closure & known & self.derivable_mask and not true:
+            return closure & ~known
+
+        needed = frontier = goal_bit
+        while frontier:
+            frontier = self._expand(frontier, true) & ~needed & ~known
+            needed |= frontier
+        return needed
+
+    def check_rule(self, rule_id: int, wm: WorkingMemory) -> Optional[bool]:
+        """
+        コンパイル済みの条件でルールを判定する
+        Returns: True（全グループ成立）/ False（いずれかのグループが全てfalse）/ None（未確定）
+        false のグループが見つかった時点で打ち切り、ORグループは true のメンバーが見つかった時点で打ち切る。
+        スキップされた事実は評価しない（全メンバーがスキップされたグループは成立扱い）。
+        """
+        if isinstance(wm, BitsetWorkingMemory) and wm.fact_table is self.fact_table:
+            live = ~wm.skipped_mask
+            known = wm.known_mask
+            true = wm.true_mask
+            undecided = False
+            for group in self.condition_group_masks[rule_id]:
+                members = group & live
+                if not members or members & true:
+                    continue
+                if members & ~known:
+                    undecided = True
+                else:
+                    return False
+            return None if undecided else True
+
+        findings = wm.findings
+        hypotheses = wm.hypotheses
+        skipped = wm.skipped_facts
+        undecided = False
+        for group in self.condition_groups[rule_id]:
+            has_member = False
+            group_unknown = False
+            for fact in group:
+                if fact in skipped:
+                    continue
+                has_member = True
+                value = findings.get(fact)
+                if value is None:
+                    value = hypotheses.get(fact)
+                if value:
+                    break
+                if value is None:
+                    group_unknown = True
+            else:
+                if group_unknown:
+                    undecided = True
+                elif has_member:
+                    return False
+        return None if undecided else True
+
+    def is_falsified_by(self, rule_id: int, fact: str, wm: WorkingMemory) -> bool:
+        """
+        事実 fact が false になったことでルールが不成立になるか
+        fact を含むグループの他のメンバー（スキップ以外）が全て false なら不成立（AND条件なら常に不成立）
+        """
+        if isinstance(wm, BitsetWorkingMemory) and wm.fact_table is self.fact_table and fact in self.fact_table:
+            bit = self.fact_table.bit(fact)
+            # スキップ以外で true または未確認の他メンバー
+            open_members = ~bit & ~wm.skipped_mask & (wm.true_mask | ~wm.known_mask)
+            for group in self.condition_group_masks[rule_id]:
+                if group & bit and not group & open_members:
+                    return True
+            return False
+
+        for group in self.condition_groups[rule_id]:
+            if fact not in group:
+                continue
+            for other in group:
+                if other == fact or other in wm.skipped_facts:
+                    continue
+                value = wm.findings.get(other)
+                if value is None:
+                    value = wm.hypotheses.get(other)
+                if value is not False:
+                    break
+            else:
+                return True
+        return False
 
     def is_derivable_fact(self, fact: str) -> bool:
         """導出可能な事実かどうか"""
@@ -132,242 +866,284 @@ class InferenceEngine:
         """基本事実かどうか（どのルールからも導出されない）"""
         return not self.is_derivable_fact(fact)
 
-    def get_deriving_rules(self, fact: str) -> List[int]:
+    def get_deriving_rules(self, fact: str) -> Tuple[int, ...]:
         """指定された事実を導出できるルールIDのリスト"""
-        return self.fact_to_deriving_rules.get(fact, [])
+        return self.fact_to_deriving_rules.get(fact, ())
 
-    def get_dependent_rules(self, fact: str) -> List[int]:
+    def get_dependent_rules(self, fact: str) -> Tuple[int, ...]:
         """指定された事実を条件とするルールIDのリスト"""
-        return self.fact_to_dependent_rules.get(fact, [])
+        return self.fact_to_dependent_rules.get(fact, ())
 
-    def cascade_invalidate_rules(self, fact: str, wm: WorkingMemory):
+class InferenceEngine:
+    """推論エンジン - システムイメージ.txt完全準拠"""
+
+    def __init__(self, rules: Union[List[Rule], RuleBase], evaluation_mode: str = EVALUATION_MODE_SCAN):
         """
-        ルール間依存関係の連鎖的無効化（システムイメージ行53-55）
-        事実がfalseになった場合、それを条件とする全ルールを連鎖的に無効化
+        rules に RuleBase を渡すと、それを共有する（エンジン自体はセッション状態を持たない）
+        ルールのリストを渡した場合は、このエンジン専用の RuleBase を構築する
         """
-        # この事実を条件とするルールを全て取得
-        dependent_rule_ids = self.get_dependent_rules(fact)
-
-        for rule_id in dependent_rule_ids:
-            if rule_id not in self.rules:
-                continue
-
-            # まだ評価されていないか、失敗していないルールのみ処理
-            current_status = wm.evaluated_rules.get(rule_id, RuleStatus.NOT_EVALUATED)
-            if current_status in [RuleStatus.FIRED, RuleStatus.SKIPPED]:
-                continue
-
-            # ルールをスキップ状態にする
-            wm.evaluated_rules[rule_id] = RuleStatus.SKIPPED
-
-            # このルールの結論も連鎖的に無効化
-            rule = self.rules[rule_id]
-            for action in rule.actions:
-                derived_fact = action["fact"]
-                # 導出された事実をfalseに設定（既に存在する場合）
-                if derived_fact in wm.hypotheses:
-                    wm.hypotheses[derived_fact] = False
-                # この事実に依存するルールも連鎖的に無効化
-                self.cascade_invalidate_rules(derived_fact, wm)
-
-    def get_next_question(self, goals: List[str], wm: WorkingMemory) -> Optional[str]:
+        if evaluation_mode not in EVALUATION_MODES:
+            raise ValueError(f"未知の評価モードです: {evaluation_mode}")
+        self.evaluation_mode = evaluation_mode
+        self.rule_base = rules if isinstance(rules, RuleBase) else RuleBase(rules)
+        self.rules = self.rule_base.rules
+        self.fact_to_deriving_rules = self.rule_base.fact_to_deriving_rules
+        self.fact_to_dependent_rules = self.rule_base.fact_to_dependent_rules
+        self.fact_table = self.rule_base.fact_table
+        self.condition_masks = self.rule_base.condition_masks
+
+    def create_working_memory(self, compact: bool = False):
         """
-        次に質問すべき事実を決定（システムイメージ行41-46準拠）
-        導出可能な条件も直接質問する
+        新しい作業記憶を作成
+        compact=True の場合、このエンジンの事実表を使うビットマスク版を返す
         """
-        # 各ゴールに必要な事実を収集（導出可能な事実も含む）
-        all_needed_facts = set()
-        goal_facts_map = {}
+        if compact:
+            return BitsetWorkingMemory(self.fact_table)
+        return WorkingMemory()
 
-        for goal in goals:
-            # このゴールは既に評価済みか確認
-            if goal in wm.hypotheses or goal in wm.findings:
-                continue
+    def compile_goal_set(self, goals: List[str]) -> GoalSet:
+        """ゴール集合を事前計算（共有ルールベースのキャッシュを使う）"""
+        return self.rule_base.compile_goal_set(goals)
 
-            needed = self._get_facts_for_goal(goal, wm, include_derivable=True)
-            goal_facts_map[goal] = needed
-            all_needed_facts.update(needed)
+    def get_goal_closure(self, goal: str) -> int:
+        """ゴールの静的閉包（RuleBase.get_goal_closure 参照）"""
+        return self.rule_base.get_goal_closure(goal)
 
-        # 既に質問済みまたはスキップされた事実を除外
-        # ゴール自体も質問候補から除外（ゴールは結論なので質問しない）
-        unasked_facts = [
-            fact for fact in all_needed_facts
-            if fact not in wm.findings
-            and fact not in wm.skipped_facts
-            and fact not in wm.hypotheses  # 既に導出された事実も除外
-            and fact not in goals  # ゴール（結論）は質問しない
-        ]
+    def get_needed_fact_mask(self, goal: str, known: int, true: int = 0) -> int:
+        """ゴール達成に必要な事実のビットマスク（RuleBase.get_needed_fact_mask 参照）"""
+        return self.rule_base.get_needed_fact_mask(goal, known, true)
 
-        if not unasked_facts:
-            return None
+    def is_derivable_fact(self, fact: str) -> bool:
+        """導出可能な事実かどうか"""
+        return fact in self.fact_to_deriving_rules
 
-        # 質問の優先順位を決定（システムイメージ.txt 行41-46準拠）
-        # 1. ルール優先度（より上位のルールの条件を優先）
-        # 2. ビザタイプ優先度（E > L > B）
-        # 3. 基本事実を優先（ユーザーが直接答えられる）
-        # 4. 答えやすい質問を優先（短い質問文）
-        fact_scores = {}
-        for fact in unasked_facts:
-            score = 0
+    def is_basic_fact(self, fact: str) -> bool:
+        """基本事実かどうか（どのルールからも導出されない）"""
+        return not self.is_derivable_fact(fact)
 
-            # ルール優先度ボーナス（ルールIDが小さいほど基本的）
-            min_rule_id = 999
-            for rule_id in self.get_dependent_rules(fact):
-                if rule_id in self.rules:
-                    min_rule_id = min(min_rule_id, rule_id)
-
-            # ルールIDが小さいほど高得点（1-10 → 90-0点）
-            if min_rule_id < 999:
-                rule_bonus = max(0, 100 - min_rule_id * 3)
-                score += rule_bonus
-
-            # ビザタイプ優先度ボーナス（E > L > B）
-            visa_type_bonus = 0
-            for goal, needed_facts in goal_facts_map.items():
-                if fact in needed_facts:
-                    if "Eビザ" in goal:
-                        visa_type_bonus = max(visa_type_bonus, 50)  # Eビザ最優先
-                    elif "Lビザ" in goal or "Blanket L" in goal:
-                        visa_type_bonus = max(visa_type_bonus, 30)  # Lビザ次
-                    elif "Bビザ" in goal or "B-1" in goal:
-                        visa_type_bonus = max(visa_type_bonus, 10)  # Bビザ最後
-
-            score += visa_type_bonus
-
-            # 複数のゴールで共有されているか
-            shared_count = sum(1 for needed in goal_facts_map.values() if fact in needed)
-            score += shared_count * 5
+    def get_deriving_rules(self, fact: str) -> Tuple[int, ...]:
+        """指定された事実を導出できるルールIDのリスト"""
+        return self.fact_to_deriving_rules.get(fact, ())
 
-            # 基本事実を優先（ユーザーが直接答えられる）
-            if self.is_basic_fact(fact):
-                score += 40  # 基本事実を優先
-            else:
-                score += 20  # 導出可能な事実は次点
+    def get_dependent_rules(self, fact: str) -> Tuple[int, ...]:
+        """指定された事実を条件とするルールIDのリスト"""
+        return self.fact_to_dependent_rules.get(fact, ())
 
-            # 答えやすさボーナス（短い質問文 = 抽象的で答えやすい）
-            if len(fact) <= 30:
-                score += 20  # 短い質問は答えやすい
+    def cascade_invalidate_rules(self, fact: str, wm: WorkingMemory,
+                                 changed_facts: Optional[Set[str]] = None) -> int:
+        """
+        ルール間依存関係の連鎖的無効化（システムイメージ行53-55）
+        事実がfalseになった場合、それを条件とする全ルールを連鎖的に無効化
+        changed_facts を渡すと、値を書き換えた導出事実をそこに記録する
+        Returns: 無効化（スキップ状態に）したルール数
+        """
+        return self.cascade_invalidate_facts([fact], wm, changed_facts)
 
-            fact_scores[fact] = score
+    def cascade_invalidate_facts(self, facts: Iterable[str], wm: WorkingMemory,
+                                 changed_facts: Optional[Set[str]] = None) -> int:
+        """
+        複数の事実を起点にまとめて連鎖的無効化を行う
+        再帰せずワークリストでたどり、各事実・各ルールは1回の無効化で高々1度だけ処理する
+        """
+        invalidated = 0
+        pending_facts = list(dict.fromkeys(facts))
+        visited_facts = set(pending_facts)
 
-        # スコアが最も高い事実を返す
-        if fact_scores:
-            next_fact = max(fact_scores.keys(), key=lambda f: fact_scores[f])
-            return next_fact
+        while pending_facts:
+            # この事実を条件とするルールを全て取得
+            fact = pending_facts.pop()
+            for rule_id in self.get_dependent_rules(fact):
+                if rule_id not in self.rules:
+                    continue
+
+                # まだ評価されていないか、失敗していないルールのみ処理
+                current_status = wm.evaluated_rules.get(rule_id, RuleStatus.NOT_EVALUATED)
+                if current_status in [RuleStatus.FIRED, RuleStatus.SKIPPED]:
+                    continue
+
+                # ORグループの他の分岐が残っていれば無効化しない
+                if not self.rule_base.is_falsified_by(rule_id, fact, wm):
+                    continue
+
+                # ルールをスキップ状態にする
+                wm.set_rule_status(rule_id, RuleStatus.SKIPPED)
+                invalidated += 1
+
+                # このルールの結論も連鎖的に無効化
+                for action in self.rules[rule_id].actions:
+                    derived_fact = action["fact"]
+                    # 導出された事実をfalseに設定（既に存在する場合）
+                    if derived_fact in wm.hypotheses:
+                        wm.set_hypothesis(derived_fact, False)
+                        if changed_facts is not None:
+                            changed_facts.add(derived_fact)
+                    # この事実に依存するルールも連鎖的に無効化
+                    if derived_fact not in visited_facts:
+                        visited_facts.add(derived_fact)
+                        pending_facts.append(derived_fact)
+
+        return invalidated
+
+    def get_question_candidates(self, goals: List[str],
+                                wm: WorkingMemory) -> Tuple[int, List[Tuple[int, int]]]:
+        """
+        質問候補の事実のビットマスクと、未評価のゴールごとの (必要な事実のビットマスク, ビザタイプボーナス)
+        """
+        goal_set = self.compile_goal_set(goals)
+        known, skipped = self.rule_base.memory_masks(wm)
+        true = self.rule_base.true_mask(wm)
+
+        # 各ゴールに必要な事実を収集（導出可能な事実も含む、評価済みのゴールは空）
+        # 既に成立したORグループの残りのメンバーは必要な事実に含めない
+        all_needed_facts = 0
+        goal_facts = []
+        for goal, bonus in zip(goal_set.goals, goal_set.visa_type_bonuses):
+            needed = self.get_needed_fact_mask(goal, known, true)
+            if needed:
+                goal_facts.append((needed, bonus))
+                all_needed_facts |= needed
+
+        # 既に質問済みまたはスキップされた事実を除外（既に導出された事実も除外）
+        # ゴール自体も質問候補から除外（ゴールは結論なので質問しない）
+        candidates = all_needed_facts & ~known & ~skipped & ~goal_set.goal_mask
+        return candidates, goal_facts
 
-        return None
+    def get_next_question(self, goals: List[str], wm: WorkingMemory) -> Optional[str]:
+        """
+        次に質問すべき事実を決定（システムイメージ行41-46準拠）
+        導出可能な条件も直接質問する
+        """
+        candidates, goal_facts = self.get_question_candidates(goals, wm)
+
+        # 静的スコア + ビザタイプ優先度（E > L > B）+ 複数ゴールでの共有数 が最大の事実
+        best_fact_id = None
+        best_score = -1
+        while candidates:
+            low = candidates & -candidates
+            candidates ^= low
+
+            visa_bonus = 0
+            shared_count = 0
+            for needed, bonus in goal_facts:
+                if needed & low:
+                    shared_count += 1
+                    if bonus > visa_bonus:
+                        visa_bonus = bonus
+
+            fact_id = low.bit_length() - 1
+            score = self.rule_base.static_question_scores[fact_id] + visa_bonus + shared_count * 5
+            if score > best_score:
+                best_fact_id = fact_id
+                best_score = score
+
+        if best_fact_id is None:
+            return None
+        return self.fact_table.facts[best_fact_id]
 
     def _get_facts_for_goal(self, goal: str, wm: WorkingMemory,
-                           include_derivable: bool = True,
-                           visited: Set[str] = None) -> Set[str]:
+                           include_derivable: bool = True) -> Set[str]:
         """
         ゴール達成に必要な全ての事実を収集
         include_derivable=True の場合、導出可能な事実も含める
         """
-        if visited is None:
-            visited = set()
-
-        if goal in visited:
-            return set()
-
-        visited.add(goal)
-        needed_facts = set()
-
-        # 既に判明している場合はスキップ
         if goal in wm.findings or goal in wm.hypotheses:
-            return needed_facts
-
-        # このゴールを導出できるルールを探す
-        deriving_rule_ids = self.get_deriving_rules(goal)
-
-        if not deriving_rule_ids:
+            return set()
+        if goal not in self.fact_table:
             # 基本事実
-            needed_facts.add(goal)
-            return needed_facts
-
-        # 導出可能な事実の場合
-        if include_derivable:
-            # この事実自体も質問候補に含める（システムイメージ行41-46）
-            needed_facts.add(goal)
-
-        # 最も条件の少ないルールを選択（簡略化）
-        min_rule = min(
-            [self.rules[rid] for rid in deriving_rule_ids if rid in self.rules],
-            key=lambda r: len(r.conditions),
-            default=None
-        )
+            return {goal}
 
-        if min_rule:
-            for cond in min_rule.conditions:
-                cond_fact = cond["fact"]
-                # 再帰的に必要な事実を収集
-                nested_facts = self._get_facts_for_goal(cond_fact, wm, include_derivable, visited)
-                needed_facts.update(nested_facts)
-
-        return needed_facts
+        known, _ = self.rule_base.memory_masks(wm)
+        needed = self.get_needed_fact_mask(goal, known, self.rule_base.true_mask(wm))
+        if not include_derivable:
+            needed &= ~self.rule_base.derivable_mask
+        return set(self.fact_table.facts_of(needed))
 
     def process_answer(self, fact: str, answer: AnswerType, wm: WorkingMemory) -> Dict:
         """
         回答を処理（システムイメージ行56-62準拠）
         「わからない」の場合、詳細質問への分岐を提案
         """
-        result = {
-            "fired_rules": [],
-            "derived_facts": [],
-            "detail_questions_needed": False,
-            "detail_questions": [],
-            "working_memory": {}
-        }
-
+        detail_questions = self.record_answer(fact, answer, wm)
+
+        if detail_questions is not None:
+            # まだ回答を記録しない（詳細質問の結果を待つ）
+            return {
+                "fired_rules": [],
+                "derived_facts": [],
+                "detail_questions_needed": True,
+                "detail_questions": detail_questions,
+                "invalidated_rules": 0,
+                "working_memory": {}
+            }
+
+        return self.settle_answers([(fact, answer)], wm)
+
+    def record_answer(self, fact: str, answer: AnswerType, wm: WorkingMemory) -> Optional[List[str]]:
+        """
+        回答を作業記憶に記録する（連鎖的無効化とルール評価は settle_answers で行う）
+        Returns: 導出可能な事実に「わからない」と回答された場合は詳細質問、それ以外は None
+        """
         is_derivable = self.is_derivable_fact(fact)
 
         if answer == AnswerType.YES:
             # 「はい」の場合
             if is_derivable:
                 # 導出可能な事実を直接確認
-                wm.hypotheses[fact] = True
-                wm.asked_derivable_facts.add(fact)
+                wm.set_hypothesis(fact, True)
+                wm.add_asked_derivable_fact(fact)
                 # 詳細質問（この事実を導出するための基本事実）はスキップ
                 self._skip_detail_questions(fact, wm)
             else:
                 # 基本事実
-                wm.findings[fact] = True
+                wm.set_finding(fact, True)
 
         elif answer == AnswerType.NO:
             # 「いいえ」の場合
             if is_derivable:
-                wm.hypotheses[fact] = False
-                wm.asked_derivable_facts.add(fact)
+                wm.set_hypothesis(fact, False)
+                wm.add_asked_derivable_fact(fact)
             else:
-                wm.findings[fact] = False
-
-            # この事実に依存するルールを連鎖的に無効化（システムイメージ行53-55）
-            self.cascade_invalidate_rules(fact, wm)
+                wm.set_finding(fact, False)
 
         elif answer == AnswerType.UNKNOWN:
             # 「わからない」の場合（システムイメージ行58-60）
             if is_derivable:
                 # 詳細質問が必要
-                detail_questions = self._get_detail_questions(fact, wm)
-                result["detail_questions_needed"] = True
-                result["detail_questions"] = detail_questions
-                # まだ回答を記録しない（詳細質問の結果を待つ）
-                return result
-            else:
-                # 基本事実で「わからない」の場合はfalseとして扱う
-                wm.findings[fact] = False
-                self.cascade_invalidate_rules(fact, wm)
+                return self._get_detail_questions(fact, wm)
+            # 基本事実で「わからない」の場合はfalseとして扱う
+            wm.set_finding(fact, False)
+
+        return None
+
+    def settle_answers(self, answers: List[Tuple[str, AnswerType]], wm: WorkingMemory) -> Dict:
+        """
+        record_answer で記録済みの回答について、連鎖的無効化とルール評価をまとめて1回だけ行う
+        （詳細質問待ちの回答は含めないこと）
+        """
+        # アジェンダ評価用: これらの回答で値が変化した事実
+        changed_facts = {fact for fact, _ in answers}
+
+        # falseになった事実に依存するルールを連鎖的に無効化（システムイメージ行53-55）
+        false_facts = [
+            fact for fact, answer in answers
+            if answer == AnswerType.NO or (answer == AnswerType.UNKNOWN and self.is_basic_fact(fact))
+        ]
+        invalidated_rules = self.cascade_invalidate_facts(false_facts, wm, changed_facts)
 
         # ルールを評価
-        fired_rules = self.evaluate_rules(wm)
-        result["fired_rules"] = fired_rules
-        result["derived_facts"] = list(wm.hypotheses.keys())
-        result["working_memory"] = {
-            "findings": wm.findings,
-            "hypotheses": wm.hypotheses
-        }
+        fired_rules = self.evaluate_rules(wm, changed_facts)
 
-        return result
+        return {
+            "fired_rules": fired_rules,
+            "derived_facts": list(wm.hypotheses.keys()),
+            "detail_questions_needed": False,
+            "detail_questions": [],
+            "invalidated_rules": invalidated_rules,  # 連鎖的に無効化したルール数
+            "working_memory": {
+                "findings": wm.findings,
+                "hypotheses": wm.hypotheses
+            }
+        }
 
     def _skip_detail_questions(self, fact: str, wm: WorkingMemory):
         """
@@ -382,7 +1158,7 @@ class InferenceEngine:
                 cond_fact = cond["fact"]
                 # この条件（基本事実）をスキップ対象に追加
                 if self.is_basic_fact(cond_fact):
-                    wm.skipped_facts.add(cond_fact)
+                    wm.add_skipped_fact(cond_fact)
 
     def _get_detail_questions(self, fact: str, wm: WorkingMemory) -> List[str]:
         """
@@ -404,53 +1180,137 @@ class InferenceEngine:
 
         return detail_questions
 
-    def evaluate_rules(self, wm: WorkingMemory) -> List[int]:
+    def evaluate_rules(self, wm: WorkingMemory,
+                       changed_facts: Optional[Iterable[str]] = None) -> List[int]:
         """
         ルールを評価し、発火可能なルールを実行
         AND条件の最適化を含む（システムイメージ行49-52）
+        changed_facts はアジェンダモードでのみ使用（None の場合は全ルールを対象）
         """
-        fired_rules = []
-
-        for rule_id, rule in self.rules.items():
-            if not rule.flag:
-                continue
+        if self.evaluation_mode == EVALUATION_MODE_AGENDA:
+            return self._evaluate_rules_agenda(wm, changed_facts)
+        return self._evaluate_rules_scan(wm)
 
-            current_status = wm.evaluated_rules.get(rule_id, RuleStatus.NOT_EVALUATED)
+    def _evaluate_rule(self, rule: Rule, wm: WorkingMemory) -> Tuple[Optional[RuleStatus], List[str]]:
+        """
+        1ルールを評価する
+        Returns: (新しい状態（変化なしはNone）, 値が変化した事実)
+        """
+        if not rule.flag:
+            return None, []
+
+        current_status = wm.evaluated_rules.get(rule.id, RuleStatus.NOT_EVALUATED)
+
+        if current_status in [RuleStatus.FIRED, RuleStatus.SKIPPED]:
+            return None, []
+
+        # コンパイル済みの AND-of-OR 条件で判定
+        outcome = self.rule_base.check_rule(rule.id, wm)
+
+        if outcome is True:
+            # 全グループが成立 → 発火
+            derived_facts = rule.fire(wm)
+            wm.set_rule_status(rule.id, RuleStatus.FIRED)
+            wm.add_conflict(rule.id)
+            return RuleStatus.FIRED, derived_facts
+
+        if outcome is False:
+            # いずれかのグループが全てfalse → スキップ（システムイメージ行49-52）
+            wm.set_rule_status(rule.id, RuleStatus.SKIPPED)
+            # このルールの残りの未確認条件はスキップ
+            if isinstance(wm, BitsetWorkingMemory) and wm.fact_table is self.fact_table:
+                newly_skipped = self.condition_masks[rule.id] & ~wm.skipped_mask & ~wm.known_mask
+                wm.add_skipped_mask(newly_skipped)
+                return RuleStatus.SKIPPED, self.fact_table.facts_of(newly_skipped)
+            newly_skipped = []
+            for cond in rule.conditions:
+                cond_fact = cond["fact"]
+                if (cond_fact not in wm.findings and cond_fact not in wm.hypotheses
+                        and cond_fact not in wm.skipped_facts):
+                    wm.add_skipped_fact(cond_fact)
+                    newly_skipped.append(cond_fact)
+            return RuleStatus.SKIPPED, newly_skipped
 
-            if current_status in [RuleStatus.FIRED, RuleStatus.SKIPPED]:
-                continue
+        return None, []
 
-            # 条件チェック
-            all_satisfied, satisfied, unsatisfied = rule.check_conditions(wm)
+    def _evaluate_rules_scan(self, wm: WorkingMemory) -> List[int]:
+        """全ルールを走査し、発火するたびに先頭から走査し直す（従来方式）"""
+        fired_rules = []
 
-            if all_satisfied:
-                # 全条件が満たされた → 発火
-                derived_facts = rule.fire(wm)
-                wm.evaluated_rules[rule_id] = RuleStatus.FIRED
-                fired_rules.append(rule_id)
-                wm.conflict_set.add(rule_id)
+        while True:
+            fired = False
+            for rule in self.rules.values():
+                status, _ = self._evaluate_rule(rule, wm)
+                if status == RuleStatus.FIRED:
+                    # 新たに導出された事実により他のルールも評価可能になる可能性
+                    fired_rules.append(rule.id)
+                    fired = True
+                    break
+            if not fired:
+                return fired_rules
+
+    def _evaluate_rules_agenda(self, wm: WorkingMemory,
+                               changed_facts: Optional[Iterable[str]]) -> List[int]:
+        """
+        アジェンダ方式のルール評価
+        変化した事実に依存するルールのみをキューに積み、変化がなくなるまで反復する。
+        全走査方式と同じ順序（走査順の小さいルールから）で発火・スキップするため、
+        fired_rules と導出事実は全走査方式と一致する。
+        """
+        if changed_facts is None:
+            pending = set(self.rules)
+        else:
+            # 前回評価以降に入力が変化した可能性のあるルール
+            # （スキップされた事実は前回評価の最終走査で後から追加された可能性がある）
+            pending = set(self.rule_base.unconditional_rule_ids)
+            for fact in changed_facts:
+                pending.update(self.get_dependent_rules(fact))
+            for fact in wm.skipped_facts:
+                pending.update(self.get_dependent_rules(fact))
 
-                # 新たに導出された事実により他のルールも評価可能になる可能性
-                newly_fired = self.evaluate_rules(wm)
-                fired_rules.extend(newly_fired)
+        fired_rules = []
+        order = self.rule_base.rule_order
+
+        while pending:
+            # 1回分の走査: 走査順に未処理のルールを取り出す
+            agenda = [(order[rule_id], rule_id) for rule_id in pending if rule_id in order]
+            heapq.heapify(agenda)
+            pending = set()
+            queued = {rule_id for _, rule_id in agenda}
+            fired = False
+
+            while agenda:
+                position, rule_id = heapq.heappop(agenda)
+                queued.discard(rule_id)
+                status, facts = self._evaluate_rule(self.rules[rule_id], wm)
+                if status is None:
+                    continue
+
+                affected = set()
+                for fact in facts:
+                    affected.update(self.get_dependent_rules(fact))
+
+                if status == RuleStatus.FIRED:
+                    # 全走査方式と同様に先頭から走査し直す
+                    fired_rules.append(rule_id)
+                    pending = affected | queued | pending
+                    fired = True
+                    break
+
+                # スキップで変化した事実: この走査の後方のルールは同じ走査で、
+                # 前方のルールは次の走査（あれば）で評価する
+                for dep_id in affected:
+                    if dep_id not in order or dep_id in queued:
+                        continue
+                    if order[dep_id] > position:
+                        heapq.heappush(agenda, (order[dep_id], dep_id))
+                        queued.add(dep_id)
+                    else:
+                        pending.add(dep_id)
+
+            if not fired:
                 break
 
-            elif unsatisfied:
-                # AND条件で少なくとも1つがfalse → スキップ（システムイメージ行49-52）
-                has_definite_false = any(
-                    (fact in wm.findings and not wm.findings[fact]) or
-                    (fact in wm.hypotheses and not wm.hypotheses[fact])
-                    for fact in unsatisfied
-                )
-
-                if has_definite_false:
-                    wm.evaluated_rules[rule_id] = RuleStatus.SKIPPED
-                    # このルールの残りの未確認条件はスキップ
-                    for cond in rule.conditions:
-                        cond_fact = cond["fact"]
-                        if cond_fact not in wm.findings and cond_fact not in wm.hypotheses:
-                            wm.skipped_facts.add(cond_fact)
-
         return fired_rules
 
     def check_goals(self, goals: List[str], wm: WorkingMemory) -> Dict[str, bool]:
@@ -0,0 +1,234 @@
+"""
+質問選択 - 過去の回答分布から、診断完了までの質問数が少なくなる質問を選ぶ
+
+既定の get_next_question はルール優先度・ビザタイプ・共有数の加算スコアで質問を選ぶが、
+これは質問数の最小化を狙ったものではない。ResolutionCountSelector は
+consultation_answers から集計した事実ごとの回答確率を使い、
+回答によって不要になる（答えが確定する）候補の数の期待値が最大の事実を選ぶ。
+ゴールの成否の分布のエントロピーを計算するもの（情報利得）ではなく、
+不要になる質問が多いほど残りの質問数が減るとみなす発見的な方法。
+
+- 「いいえ」: その事実をAND条件とするルールは不成立になり、他の条件は不要になる
+- 「はい」: その事実を含むORグループは成立し、同じグループの他の分岐は不要になる
+- 導出可能な事実は、はい/いいえ のどちらでもそれを導出するための詳細質問が不要になる
+  （「わからない」なら詳細質問に分岐し、何も確定しない）
+
+回答確率は AnswerPriorsRefresher（バックグラウンドスレッド）が一定間隔でのみ集計し直す
+（リクエスト処理では集計しない。初回の集計までは各回答 1/3 として選ぶ）。
+"""
+
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.models import models
+from app.services.inference_engine import FactTable, InferenceEngine, RuleBase, WorkingMemory
+
+QUESTION_SELECTOR_HEURISTIC = "heuristic"  # 既定の加算スコア（get_next_question）
+QUESTION_SELECTOR_RESOLUTION_COUNT = "resolution_count"
+QUESTION_SELECTORS = (QUESTION_SELECTOR_HEURISTIC, QUESTION_SELECTOR_RESOLUTION_COUNT)
+
+DEFAULT_REFRESH_INTERVAL = 300  # 秒
+STALE_CHECK_INTERVAL = 5  # 秒（ルールの変更で作り直した未集計の AnswerPriors を早めに集計するため）
+
+
+class AnswerPriors:
+    """
+    事実ごとの回答確率（consultation_answers の集計、事実ID順）
+    はい/いいえ/わからない をそれぞれ1件ずつ加えて平滑化する（回答のない事実は各 1/3）。
+    """
+
+    def __init__(self, fact_table: FactTable, refresh_interval: float = DEFAULT_REFRESH_INTERVAL):
+        self.fact_table = fact_table
+        self.refresh_interval = refresh_interval
+        self.yes_probabilities: Tuple[float, ...] = (1 / 3,) * len(fact_table)
+        self.unknown_probabilities: Tuple[float, ...] = (1 / 3,) * len(fact_table)
+        self.answer_count = 0
+        self.refreshed_at: Optional[float] = None
+
+    def is_stale(self) -> bool:
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at >= self.refresh_interval
+
+    def refresh(self, db: Session):
+        """回答履歴を集計し直す"""
+        counts: Dict[str, List[int]] = {}  # 事実 → [「はい」の数, 「わからない」の数, 全回答数]
+        rows = db.query(
+            models.ConsultationAnswer.fact_name,
+            models.ConsultationAnswer.answer,
+            func.count(models.ConsultationAnswer.id)
+        ).group_by(models.ConsultationAnswer.fact_name, models.ConsultationAnswer.answer).all()
+
+        answer_count = 0
+        for fact, answer, count in rows:
+            fact_counts = counts.setdefault(fact, [0, 0, 0])
+            answer = str(answer).lower()
+            if answer == "yes":
+                fact_counts[0] += count
+            elif answer == "unknown":
+                fact_counts[1] += count
+            fact_counts[2] += count
+            answer_count += count
+
+        yes_probabilities = []
+        unknown_probabilities = []
+        for fact in self.fact_table.facts:
+            yes, unknown, total = counts.get(fact, (0, 0, 0))
+            yes_probabilities.append((yes + 1) / (total + 3))
+            unknown_probabilities.append((unknown + 1) / (total + 3))
+
+        # 参照側が途中の状態を見ないよう、まとめて差し替える
+        self.yes_probabilities = tuple(yes_probabilities)
+        self.unknown_probabilities = tuple(unknown_probabilities)
+        self.answer_count = answer_count
+        self.refreshed_at = time.monotonic()
+
+    def refresh_if_stale(self, db: Session) -> bool:
+        if not self.is_stale():
+            return False
+        self.refresh(db)
+        return True
+
+
+class AnswerPriorsRefresher:
+    """
+    現在のルールベースの AnswerPriors を古くなったら集計し直すバックグラウンドスレッド
+    （起動直後と、STALE_CHECK_INTERVAL ごとの確認で古ければ集計する）
+    """
+
+    def __init__(self, current: Callable[[], AnswerPriors], session_factory: Callable[[], Session],
+                 check_interval: float = STALE_CHECK_INTERVAL):
+        self.current = current
+        self.session_factory = session_factory
+        self.check_interval = check_interval
+        self.refresh_count = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self) -> bool:
+        """古ければ集計し直す Returns: 集計したか"""
+        priors = self.current()
+        if not priors.is_stale():
+            return False
+        db = self.session_factory()
+        try:
+            priors.refresh(db)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+        self.refresh_count += 1
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                # DBに接続できない間は前回の集計（または一様な確率）を使い続ける
+                pass
+            if self._stop.wait(self.check_interval):
+                return
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="answer-priors-refresher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+class ResolutionCountSelector:
+    """
+    回答で確定する候補数の期待値が最大の質問を選ぶ
+    事実ごとの「回答で不要になる事実」をビットマスクで事前計算しておき、
+    候補を1つずつ、候補集合との論理積のビット数でスコアを求める（推論は試行しない）。
+    """
+
+    def __init__(self, rule_base: RuleBase):
+        self.rule_base = rule_base
+        self.yes_resolve_masks, self.no_resolve_masks = self._build_resolve_masks()
+
+    def _build_resolve_masks(self) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+        """事実ID → (「はい」で不要になる事実, 「いいえ」で不要になる事実) のビットマスク"""
+        rule_base = self.rule_base
+        fact_table = rule_base.fact_table
+        yes_masks = [0] * len(fact_table)
+        no_masks = [0] * len(fact_table)
+
+        for rule_id, groups in rule_base.condition_group_masks.items():
+            conditions = rule_base.condition_masks[rule_id]
+            for group in groups:
+                members = group
+                while members:
+                    low = members & -members
+                    members ^= low
+                    fact_id = low.bit_length() - 1
+                    if group == low:
+                        # AND条件: 「いいえ」でルールが不成立になる
+                        no_masks[fact_id] |= conditions & ~low
+                    else:
+                        # ORグループ: 「はい」でグループが成立する
+                        yes_masks[fact_id] |= group & ~low
+
+        # 導出可能な事実: 直接回答すれば導出のための詳細質問は不要
+        for fact in rule_base.fact_to_deriving_rules:
+            fact_id = fact_table.ids[fact]
+            subtree = rule_base.get_goal_closure(fact) & ~(1 << fact_id)
+            yes_masks[fact_id] |= subtree
+            no_masks[fact_id] |= subtree
+
+        return tuple(yes_masks), tuple(no_masks)
+
+    def select(self, engine: InferenceEngine, goals: List[str], wm: WorkingMemory,
+               priors: AnswerPriors) -> Optional[str]:
+        """
+        次に質問すべき事実（候補は get_next_question と同じ、候補がなければ None）
+        同点の場合は get_next_question の静的スコアが高い事実、さらに同点なら事実ID順
+        """
+        candidates, _ = engine.get_question_candidates(goals, wm)
+        yes_probabilities = priors.yes_probabilities
+        unknown_probabilities = priors.unknown_probabilities
+        derivable_mask = self.rule_base.derivable_mask
+        static_scores = self.rule_base.static_question_scores
+        yes_masks = self.yes_resolve_masks
+        no_masks = self.no_resolve_masks
+
+        best_fact_id = None
+        best_key = None
+        remaining = candidates
+        while remaining:
+            low = remaining & -remaining
+            remaining ^= low
+            fact_id = low.bit_length() - 1
+
+            p_yes = yes_probabilities[fact_id]
+            if low & derivable_mask:
+                # 「わからない」なら何も確定しない
+                p_answered = 1 - unknown_probabilities[fact_id]
+            else:
+                # 基本事実の「わからない」は「いいえ」と同じ
+                p_answered = 1
+            expected_resolved = (
+                p_answered
+                + p_yes * (yes_masks[fact_id] & candidates).bit_count()
+                + (p_answered - p_yes) * (no_masks[fact_id] & candidates).bit_count()
+            )
+            key = (expected_resolved, static_scores[fact_id])
+            if best_key is None or key > best_key:
+                best_fact_id = fact_id
+                best_key = key
+
+        if best_fact_id is None:
+            return None
+        return self.rule_base.fact_table.facts[best_fact_id]
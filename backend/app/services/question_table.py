@@ -0,0 +1,223 @@
+"""
+質問決定表 - ビザタイプの選択ごとに「回答 → 次の質問」の遷移表を事前コンパイルする
+
+ゴールの組み合わせが決まれば、get_next_question が返す質問の列はそれまでの回答だけで決まる。
+そこで推論エンジンの はい/いいえ/わからない の回答木をオフラインでたどり、
+各ノードの次の質問と回答ごとの遷移先を表にしておく（同じ作業記憶に至る回答の列は1ノードにまとめる）。
+サーバーは表を1ステップ進めるだけで次の質問を返せる。
+
+次の場合は表の範囲外として推論エンジンでの計算にフォールバックする:
+- サイズ上限で打ち切られた先のノード
+- 導出可能な事実への「わからない」（詳細質問に分岐する）、提示した質問以外の事実への回答
+- ルールベースが表のコンパイル時から変更された場合（RuleBase.fingerprint で照合）
+
+使い方:
+    python -m app.services.question_table --out ./question_tables [--max-nodes 20000]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import zlib
+from array import array
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.services.inference_engine import (
+    AnswerType, BitsetWorkingMemory, InferenceEngine, Rule, RuleBase, EVALUATION_MODE_AGENDA
+)
+
+FORMAT_VERSION = 4
+TABLE_SUFFIX = ".qtable"
+DEFAULT_MAX_NODES = 20000
+
+# 遷移表の列（1ノードあたり回答の種類数だけ遷移先を持つ）
+ANSWER_CODES = {AnswerType.YES: 0, AnswerType.NO: 1, AnswerType.UNKNOWN: 2}
+OUTSIDE = -1  # 表の範囲外（質問なしのノードでは診断完了）
+
+
+def table_key(goals: Iterable[str]) -> Tuple[str, ...]:
+    """ゴールの組み合わせ → 表の検索キー（次の質問はゴールの並び順によらない）"""
+    return tuple(sorted(goals))
+
+
+class QuestionTable:
+    """
+    コンパイル済みの質問決定表（読み取り専用、全セッションで共有）
+    ノード0が診断開始時の状態。
+    """
+
+    __slots__ = ("fingerprint", "goals", "complete", "facts", "questions", "transitions")
+
+    def __init__(self, fingerprint: str, goals: Tuple[str, ...], facts: List[str],
+                 questions: array, transitions: array, complete: bool):
+        self.fingerprint = fingerprint  # コンパイル時の RuleBase.fingerprint
+        self.goals = goals
+        self.complete = complete  # サイズ上限で打ち切らずに全ノードを収録したか
+        self.facts = facts  # 質問に使う事実の表（questions はこの添字）
+        self.questions = questions  # ノード → 事実の添字（OUTSIDE は診断完了）
+        self.transitions = transitions  # ノード*3 + 回答コード → 遷移先ノード（OUTSIDE は範囲外）
+
+    def __len__(self) -> int:
+        return len(self.questions)
+
+    def question(self, node: int) -> Optional[str]:
+        """ノードで提示する質問（診断完了なら None）"""
+        fact_index = self.questions[node]
+        return None if fact_index == OUTSIDE else self.facts[fact_index]
+
+    def step(self, node: int, fact: str, answer: AnswerType) -> Optional[int]:
+        """ノードの質問に回答した後のノード（表の範囲外なら None）"""
+        fact_index = self.questions[node]
+        answer_code = ANSWER_CODES.get(answer)
+        if fact_index == OUTSIDE or answer_code is None or self.facts[fact_index] != fact:
+            return None
+        child = self.transitions[node * len(ANSWER_CODES) + answer_code]
+        return None if child == OUTSIDE else child
+
+    def dumps(self) -> bytes:
+        """シリアライズ（圧縮JSON）"""
+        payload = {
+            "format": FORMAT_VERSION,
+            "fingerprint": self.fingerprint,
+            "goals": list(self.goals),
+            "complete": self.complete,
+            "facts": self.facts,
+            "questions": self.questions.tolist(),
+            "transitions": self.transitions.tolist()
+        }
+        return zlib.compress(json.dumps(payload, ensure_ascii=False).encode("utf-8"))
+
+    @classmethod
+    def loads(cls, data: bytes) -> "QuestionTable":
+        payload = json.loads(zlib.decompress(data).decode("utf-8"))
+        if payload.get("format") != FORMAT_VERSION:
+            raise ValueError(f"未対応の質問決定表の形式です: {payload.get('format')}")
+        return cls(
+            fingerprint=payload["fingerprint"],
+            goals=tuple(payload["goals"]),
+            facts=payload["facts"],
+            questions=array("i", payload["questions"]),
+            transitions=array("i", payload["transitions"]),
+            complete=payload["complete"]
+        )
+
+
+def _state_key(wm: BitsetWorkingMemory) -> Tuple:
+    """以降の質問と遷移を決める作業記憶の内容（同じキーの状態は1ノードにまとめる）"""
+    return (
+        wm.known_findings, wm.true_findings, wm.known_hypotheses, wm.true_hypotheses,
+        wm.skipped_mask, wm.asked_mask, frozenset(wm.evaluated_rules.items())
+    )
+
+
+def compile_question_table(engine: InferenceEngine, goals: List[str],
+                           max_nodes: int = DEFAULT_MAX_NODES) -> QuestionTable:
+    """
+    回答木を幅優先でたどって質問決定表をコンパイルする
+    ノード数が max_nodes に達したら新しいノードは作らず、その先は範囲外とする
+    （浅い＝どのセッションも通る部分から収録される）。
+    """
+    goals = list(table_key(goals))
+    root = engine.create_working_memory(compact=True)
+    states = {_state_key(root): 0}
+    queue = deque([root])
+    fact_indexes: Dict[str, int] = {}
+    questions = array("i")
+    transitions = array("i")
+    complete = True
+
+    while queue:
+        wm = queue.popleft()
+        fact = engine.get_next_question(goals, wm)
+        if fact is None:
+            questions.append(OUTSIDE)
+            transitions.extend([OUTSIDE] * len(ANSWER_CODES))
+            continue
+        questions.append(fact_indexes.setdefault(fact, len(fact_indexes)))
+
+        for answer in ANSWER_CODES:
+            with wm.journal() as trail:
+                result = engine.process_answer(fact, answer, wm)
+            child = OUTSIDE
+            # 詳細質問への分岐は表に含めない
+            if not result["detail_questions_needed"]:
+                key = _state_key(wm)
+                child = states.get(key, OUTSIDE)
+                if child == OUTSIDE:
+                    if len(states) < max_nodes:
+                        child = states[key] = len(states)
+                        queue.append(BitsetWorkingMemory.from_dict(wm.to_dict(), engine.fact_table))
+                    else:
+                        complete = False
+            wm.rollback(trail)
+            transitions.append(child)
+
+    return QuestionTable(
+        fingerprint=engine.rule_base.fingerprint,
+        goals=tuple(goals),
+        facts=list(fact_indexes),
+        questions=questions,
+        transitions=transitions,
+        complete=complete
+    )
+
+
+def load_question_tables(directory: str, rule_base: RuleBase) -> Dict[Tuple[str, ...], QuestionTable]:
+    """
+    ディレクトリ内の質問決定表を読み込む
+    ルールベースと一致しない（コンパイル後にルールが変更された）表は読み込まない
+    """
+    tables = {}
+    if not directory or not os.path.isdir(directory):
+        return tables
+    for name in sorted(os.listdir(directory)):
+        if not name.endswith(TABLE_SUFFIX):
+            continue
+        with open(os.path.join(directory, name), "rb") as f:
+            try:
+                table = QuestionTable.loads(f.read())
+            except (ValueError, KeyError, zlib.error):
+                continue
+        if table.fingerprint == rule_base.fingerprint:
+            tables[table_key(table.goals)] = table
+    return tables
+
+
+def visa_type_selections(visa_types: Iterable[str]) -> List[Tuple[str, ...]]:
+    """ビザタイプの全ての組み合わせ（空の選択を除く）"""
+    visa_types = list(visa_types)
+    return [
+        selection
+        for size in range(1, len(visa_types) + 1)
+        for selection in itertools.combinations(visa_types, size)
+    ]
+
+
+def main():
+    from app.services.visa_rules import VISA_RULES, VISA_TYPE_GOALS
+
+    parser = argparse.ArgumentParser(description="ビザタイプの選択ごとに質問決定表をコンパイルする")
+    parser.add_argument("--out", required=True, help="出力ディレクトリ（QUESTION_TABLE_DIR に指定する）")
+    parser.add_argument("--max-nodes", type=int, default=DEFAULT_MAX_NODES,
+                        help="1つの表に収録する最大ノード数")
+    args = parser.parse_args()
+
+    rule_base = RuleBase([Rule.from_dict(r) for r in VISA_RULES])
+    engine = InferenceEngine(rule_base, evaluation_mode=EVALUATION_MODE_AGENDA)
+    os.makedirs(args.out, exist_ok=True)
+
+    for selection in visa_type_selections(VISA_TYPE_GOALS):
+        goals = [goal for visa_type in selection for goal in VISA_TYPE_GOALS[visa_type]]
+        table = compile_question_table(engine, goals, max_nodes=args.max_nodes)
+        data = table.dumps()
+        path = os.path.join(args.out, "+".join(selection) + TABLE_SUFFIX)
+        with open(path, "wb") as f:
+            f.write(data)
+        print(f"{'+'.join(selection)}: {len(table)} ノード"
+              f"{'' if table.complete else '（上限で打ち切り）'} {len(data)} bytes")
+
+
+if __name__ == "__main__":
+    main()
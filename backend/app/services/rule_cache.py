@@ -0,0 +1,113 @@
+"""
+ルール定義のレスポンスキャッシュ - GET /api/rules・/api/admin/rules・ルール単体の本文を作り置きする
+
+ルール定義は管理画面での編集時にしか変わらないため、ルールベースの版ごとに
+JSON の本文（無圧縮・gzip・brotli）とIDからの索引をまとめたスナップショットを1度だけ作り、
+読み取りは作り置いたバイト列をそのまま返す。
+- ETag は本文の内容のハッシュによる強いETag（圧縮方式ごとに別の値）。
+  内容から決まるため、ワーカーやプロセスの再起動をまたいでも同じ値になる。
+- スナップショットはルールベースの版ごとの RuleSet が持つ（rulebase_store）。
+  ルールを変更すると新しい RuleSet に差し替わり、次の読み取りで作り直される。
+
+brotli パッケージがない場合は gzip と無圧縮だけを返す。
+"""
+
+import gzip
+import hashlib
+import json
+from typing import Dict, List, Optional
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import brotli
+except ImportError:  # brotli がなければ br は返さない
+    brotli = None
+
+IDENTITY = "identity"
+GZIP = "gzip"
+BROTLI = "br"
+MIN_COMPRESS_SIZE = 500  # これより小さい本文は圧縮しない（GZipMiddleware の既定と同じ）
+
+
+def encode_json(content) -> bytes:
+    """FastAPI の JSONResponse と同じ形式でJSONにする"""
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class EncodedBody:
+    """1つのレスポンス本文（圧縮方式ごとのバイト列と強いETag）"""
+
+    __slots__ = ("variants", "etags")
+
+    def __init__(self, resource: str, body: bytes):
+        digest = hashlib.sha256(body).hexdigest()[:16]
+        self.variants: Dict[str, bytes] = {IDENTITY: body}
+        if len(body) >= MIN_COMPRESS_SIZE:
+            self.variants[GZIP] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants[BROTLI] = brotli.compress(body, quality=11)
+        self.etags: Dict[str, str] = {
+            encoding: f'"{resource}-{digest}"' if encoding == IDENTITY else f'"{resource}-{digest}-{encoding}"'
+            for encoding in self.variants
+        }
+
+
+class RuleSnapshot:
+    """ある版のルール定義から作った本文と索引（作った後は変更しない）"""
+
+    def __init__(self, rules: List[Dict], version: int):
+        self.version = version
+        self.rules = EncodedBody("rules", encode_json(rules))
+        self.admin_rules = EncodedBody("admin-rules", encode_json({"rules": rules, "count": len(rules)}))
+        # ルールID → ルール単体の本文
+        self.by_id: Dict[int, EncodedBody] = {
+            rule["id"]: EncodedBody(f"rule-{rule['id']}", encode_json(rule)) for rule in rules
+        }
+
+
+def choose_encoding(accept_encoding: Optional[str], available) -> str:
+    """Accept-Encoding の q 値が最も大きい圧縮方式（同じなら br、gzip の順。どれもなければ無圧縮）"""
+    if not accept_encoding:
+        return IDENTITY
+    qualities: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[name.strip().lower()] = quality
+    best, best_quality = IDENTITY, 0.0
+    for encoding in (BROTLI, GZIP):
+        if encoding not in available:
+            continue
+        quality = qualities.get(encoding, qualities.get("*", 0.0))
+        if quality > best_quality:
+            best, best_quality = encoding, quality
+    return best
+
+
+def cached_response(request: Request, body: EncodedBody) -> Response:
+    """
+    作り置いた本文を返す（If-None-Match がいずれかの圧縮方式のETagと一致すれば 304）
+    """
+    headers = {"Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    encoding = choose_encoding(request.headers.get("accept-encoding"), body.variants)
+    etag = body.etags[encoding]
+    headers["ETag"] = etag
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        if "*" in tags or not tags.isdisjoint(body.etags.values()):
+            return Response(status_code=304, headers=headers)
+
+    if encoding != IDENTITY:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body.variants[encoding], media_type="application/json", headers=headers)
+
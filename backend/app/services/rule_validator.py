@@ -3,7 +3,11 @@
 システムイメージ.txt 行117-120準拠
 """
 
-from typing import List, Dict, Set, Tuple
+import hashlib
+import json
+import threading
+from collections import OrderedDict, deque
+from typing import Callable, Iterable, List, Dict, Optional, Set, Tuple, Union
 from app.services.inference_engine import Rule
 
 class RuleValidator:
@@ -131,67 +135,20 @@ class RuleValidator:
     def detect_circular_references(self) -> List[Dict]:
         """
         循環参照を検出
-        A→B→C→Aのような依存関係のループを検出
+        A→B→C→Aのような依存関係のループを、事実→ルール→事実のグラフの強連結成分として全て検出
+        （O(ルール数 + 条件数 + 結論数)）。結果はルールの並びによらず、ルールID順に並ぶ
         """
-        circular_refs = []
-
-        def find_cycle(fact: str, visited: Set[str], path: List[str]) -> List[str]:
-            """DFSで循環を検出"""
-            if fact in visited:
-                # 循環を検出
-                cycle_start = path.index(fact)
-                return path[cycle_start:]
-
-            visited.add(fact)
-            path.append(fact)
-
-            # この事実を条件とするルールを探索
-            if fact in self.fact_to_dependent_rules:
-                for rule_id in self.fact_to_dependent_rules[fact]:
-                    if rule_id not in self.rules:
-                        continue
-
-                    rule = self.rules[rule_id]
-                    # このルールの結論を探索
-                    for action in rule.actions:
-                        next_fact = action["fact"]
-                        cycle = find_cycle(next_fact, visited.copy(), path.copy())
-                        if cycle:
-                            return cycle
-
-            return []
-
-        # 全ての事実について循環をチェック
-        checked_facts = set()
-        for fact in self.fact_to_deriving_rules.keys():
-            if fact in checked_facts:
-                continue
-
-            cycle = find_cycle(fact, set(), [])
-            if cycle:
-                # 循環に関与するルールを特定
-                involved_rules = []
-                for i in range(len(cycle)):
-                    current_fact = cycle[i]
-                    next_fact = cycle[(i + 1) % len(cycle)]
-
-                    # current_factを条件とし、next_factを導出するルールを探す
-                    if next_fact in self.fact_to_deriving_rules:
-                        for rule_id in self.fact_to_deriving_rules[next_fact]:
-                            rule = self.rules[rule_id]
-                            if any(c["fact"] == current_fact for c in rule.conditions):
-                                involved_rules.append(rule_id)
-
-                circular_refs.append({
-                    "type": "circular_reference",
-                    "severity": "high",
-                    "cycle": cycle,
-                    "involved_rules": involved_rules,
-                    "message": f"循環参照を検出: {' → '.join(cycle)} → {cycle[0]}"
-                })
-
-                checked_facts.update(cycle)
-
+        def successors(node: Node) -> Iterable[Node]:
+            if isinstance(node, str):
+                return self.fact_to_dependent_rules.get(node, ())
+            return (action["fact"] for action in self.rules[node].actions)
+
+        components = strongly_connected_components(self.rules, successors)
+        circular_refs = [
+            circular_reference(component, self.rules, lambda fact: self.fact_to_dependent_rules.get(fact, ()))
+            for component in components
+        ]
+        circular_refs.sort(key=lambda issue: issue["involved_rules"][0])
         return circular_refs
 
     def detect_orphaned_facts(self) -> List[Dict]:
@@ -261,9 +218,459 @@ class RuleValidator:
 
     def _is_validation_passed(self, results: Dict) -> bool:
         """検証結果に重大なエラーがないかチェック"""
-        # 高重要度のエラーがあれば失敗
-        for category, issues in results.items():
-            for issue in issues:
-                if issue.get("severity") == "high":
-                    return False
-        return True
+        return is_validation_passed(results)
+
+
+def is_validation_passed(results: Dict) -> bool:
+    """検証結果に重大なエラーがないかチェック"""
+    # 高重要度のエラーがあれば失敗
+    for category, issues in results.items():
+        for issue in issues:
+            if issue.get("severity") == "high":
+                return False
+    return True
+
+
+# ===== 循環参照（事実→ルール→事実のグラフの強連結成分） =====
+# 節点は事実（str）とルールID（int）。事実 → それを条件とするルール → そのルールの結論の事実 の辺をたどる。
+# 2節点以上の強連結成分が循環（事実とルールを交互にたどるため、1節点の成分は循環しない）。
+
+Node = Union[str, int]
+
+
+def strongly_connected_components(roots: Iterable[Node],
+                                  successors: Callable[[Node], Iterable[Node]]) -> List[List[Node]]:
+    """
+    Tarjan の強連結成分分解（再帰を使わない）。roots から到達できる節点のうち、2節点以上の成分だけを返す
+    計算量は O(節点数 + 辺数)。
+    """
+    index: Dict[Node, int] = {}
+    low: Dict[Node, int] = {}
+    stack: List[Node] = []
+    on_stack: Set[Node] = set()
+    components: List[List[Node]] = []
+
+    for root in roots:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(successors(root)))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = low[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(successors(child))))
+                    break
+                if child in on_stack and index[child] < low[node]:
+                    low[node] = index[child]
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if low[node] < low[parent]:
+                        low[parent] = low[node]
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    if len(component) > 1:
+                        components.append(component)
+    return components
+
+
+def circular_reference(component: Iterable[Node], rules: Dict[int, Rule],
+                       dependent_rules: Callable[[str], Iterable[int]]) -> Dict:
+    """
+    循環する成分の検出結果
+    - facts / involved_rules: 成分の全ての事実・ルール（ルールはID順）
+    - cycle: 成分の最もIDの小さいルールを通る最短の循環（そのルールの結論 → ... → 条件。条件 → 結論 で閉じる）
+    ルールの追加順によらず同じ結果になるよう、事実を条件とするルールもID順にたどる。
+    """
+    members = set(component)
+    involved_rules = sorted(node for node in members if not isinstance(node, str))
+    facts = sorted(node for node in members if isinstance(node, str))
+    first_rule = rules[involved_rules[0]]
+    targets = {cond["fact"] for cond in first_rule.conditions if cond["fact"] in members}
+
+    parents: Dict[str, Optional[str]] = {}
+    queue = deque()
+    for action in first_rule.actions:
+        if action["fact"] in members and action["fact"] not in parents:
+            parents[action["fact"]] = None
+            queue.append(action["fact"])
+    cycle: List[str] = []
+    while queue:
+        fact = queue.popleft()
+        if fact in targets:
+            while fact is not None:
+                cycle.append(fact)
+                fact = parents[fact]
+            cycle.reverse()
+            break
+        for rule_id in sorted(dependent_rules(fact)):
+            if rule_id not in members:
+                continue
+            for action in rules[rule_id].actions:
+                next_fact = action["fact"]
+                if next_fact in members and next_fact not in parents:
+                    parents[next_fact] = fact
+                    queue.append(next_fact)
+
+    message = f"循環参照を検出: {' → '.join(cycle)} → {cycle[0]}"
+    if len(facts) > len(cycle):
+        message += f"（ほかに{len(facts) - len(cycle)}個の事実が同じ循環に含まれます）"
+    return {
+        "type": "circular_reference",
+        "severity": "high",
+        "cycle": cycle,
+        "facts": facts,
+        "involved_rules": involved_rules,
+        "message": message
+    }
+
+
+class IncrementalRuleValidator:
+    """
+    索引と検証結果を保持し、ルールの追加・変更・削除のたびに影響する範囲だけを検証し直す整合性チェック
+    - 矛盾: 変更したルールの結論の事実
+    - 到達不可能: 変更したルールと、その結論の事実を条件とするルール
+    - 孤立した事実: 変更したルールの条件・結論の事実
+    - 循環参照: 変更前のルールを含んでいた強連結成分と、変更後のルールを含む強連結成分
+    全体の結果はルールベースの内容のハッシュ（ルールごとのハッシュのXOR）ごとにメモ化するため、
+    結果のルールの並びは変更の順序によらずルールID順にする（同じ内容なら同じ結果）。
+    ID順のルールで作った RuleValidator と同じ結果になる（矛盾・孤立した事実の並び順は異なる場合がある）。
+    """
+
+    MEMO_SIZE = 64
+
+    def __init__(self, rules: Iterable[Rule] = ()):
+        self._lock = threading.RLock()
+        self._memo: "OrderedDict[int, Dict[str, List[Dict]]]" = OrderedDict()
+        self.version: Optional[int] = None  # sync で合わせたルールベースの版
+        self._reset(rules)
+
+    # ===== 状態の構築 =====
+    def _reset(self, rules: Iterable[Rule]):
+        self.rules: Dict[int, Rule] = {}
+        self._digests: Dict[int, int] = {}
+        self.content_hash = 0
+        self._deriving: Dict[str, Dict[int, None]] = {}  # 事実 → 導出するルールID（順序付き集合）
+        self._dependent: Dict[str, Dict[int, None]] = {}  # 事実 → 条件とするルールID
+        for rule in rules:
+            self._index(rule)
+        self._contradictions: Dict[str, List[Dict]] = {}
+        self._unreachable: Dict[int, Dict] = {}
+        self._orphaned: Dict[str, Dict] = {}
+        for fact in self._deriving:
+            self._recheck_fact(fact)
+        for rule_id in self.rules:
+            self._recheck_rule(rule_id)
+        # 循環する強連結成分（成分ID → 節点）と、節点 → 成分ID
+        self._components: Dict[int, List[Node]] = {}
+        self._component_of: Dict[Node, int] = {}
+        self._cycle_issues: Dict[int, Dict] = {}  # 成分ID → 検出結果（成分が変わるまで使い回す）
+        self._next_component_id = 0
+        for component in strongly_connected_components(list(self.rules), self._successors):
+            self._add_component(component)
+
+    @staticmethod
+    def rule_digest(rule: Rule) -> int:
+        """ルールの内容のハッシュ（128ビット）"""
+        payload = json.dumps(
+            [rule.id, rule.name, rule.visa_type, rule.rule_type, rule.conditions, rule.actions, rule.flag],
+            ensure_ascii=False, sort_keys=True, default=str
+        )
+        return int.from_bytes(hashlib.sha256(payload.encode("utf-8")).digest()[:16], "big")
+
+    def _index(self, rule: Rule):
+        self.rules[rule.id] = rule
+        digest = self.rule_digest(rule)
+        self._digests[rule.id] = digest
+        self.content_hash ^= digest
+        for action in rule.actions:
+            self._deriving.setdefault(action["fact"], {})[rule.id] = None
+        for cond in rule.conditions:
+            self._dependent.setdefault(cond["fact"], {})[rule.id] = None
+
+    def _unindex(self, rule: Rule):
+        del self.rules[rule.id]
+        self.content_hash ^= self._digests.pop(rule.id)
+        for index, items in ((self._deriving, rule.actions), (self._dependent, rule.conditions)):
+            for item in items:
+                rule_ids = index.get(item["fact"])
+                if rule_ids is not None:
+                    rule_ids.pop(rule.id, None)
+                    if not rule_ids:
+                        del index[item["fact"]]
+
+    @staticmethod
+    def _ordered(rule_ids) -> List[int]:
+        return sorted(rule_ids)
+
+    # ===== 事実・ルール単位の検証（RuleValidator の各チェックと同じ判定） =====
+    def _recheck_fact(self, fact: str):
+        """事実ごとの検証（矛盾・孤立した事実）をやり直す"""
+        deriving = self._ordered(self._deriving.get(fact, ()))
+
+        contradictions = []
+        # 同じ条件を持つルールどうしだけを比べる（組の順序は RuleValidator と同じ）
+        groups: Dict[frozenset, List[int]] = {}
+        positions: Dict[int, Tuple[List[int], int]] = {}
+        for rule_id in deriving:
+            group = groups.setdefault(frozenset(c["fact"] for c in self.rules[rule_id].conditions), [])
+            positions[rule_id] = (group, len(group))
+            group.append(rule_id)
+        for rule_id1 in deriving:
+            group, position = positions[rule_id1]
+            if len(group) < 2:
+                continue
+            action1 = next((a for a in self.rules[rule_id1].actions if a["fact"] == fact), None)
+            for rule_id2 in group[position + 1:]:
+                action2 = next((a for a in self.rules[rule_id2].actions if a["fact"] == fact), None)
+                if action1 and action2 and action1.get("value", True) != action2.get("value", True):
+                    contradictions.append({
+                        "type": "contradiction",
+                        "severity": "high",
+                        "rule_ids": [rule_id1, rule_id2],
+                        "fact": fact,
+                        "message": f"ルール{rule_id1}と{rule_id2}が同じ条件で'{fact}'に異なる値を設定しています"
+                    })
+        if contradictions:
+            self._contradictions[fact] = contradictions
+        else:
+            self._contradictions.pop(fact, None)
+
+        if deriving and not self._dependent.get(fact):
+            self._orphaned[fact] = {
+                "type": "orphaned_fact",
+                "severity": "low",
+                "fact": fact,
+                "deriving_rules": deriving,
+                "message": f"事実'{fact}'は導出されますが、どのルールの条件でも使用されていません"
+            }
+        else:
+            self._orphaned.pop(fact, None)
+
+    def _recheck_rule(self, rule_id: int):
+        """ルールの到達可能性をやり直す"""
+        rule = self.rules.get(rule_id)
+        impossible_conditions = []
+        if rule is not None:
+            for cond in rule.conditions:
+                deriving = self._deriving.get(cond["fact"])
+                if deriving and all(not self.rules[rid].flag for rid in deriving):
+                    impossible_conditions.append(cond["fact"])
+        if impossible_conditions:
+            self._unreachable[rule_id] = {
+                "type": "unreachable",
+                "severity": "medium",
+                "rule_id": rule_id,
+                "rule_name": rule.name,
+                "impossible_conditions": impossible_conditions,
+                "message": f"ルール{rule_id}({rule.name})は到達不可能です。条件{impossible_conditions}を満たせません"
+            }
+        else:
+            self._unreachable.pop(rule_id, None)
+
+    # ===== 循環参照 =====
+    def _successors(self, node: Node) -> Iterable[Node]:
+        if isinstance(node, str):
+            return self._dependent.get(node, ())
+        return (action["fact"] for action in self.rules[node].actions)
+
+    def _predecessors(self, node: Node) -> Iterable[Node]:
+        if isinstance(node, str):
+            return self._deriving.get(node, ())
+        return (cond["fact"] for cond in self.rules[node].conditions)
+
+    def _add_component(self, component: Iterable[Node]):
+        component_id = self._next_component_id
+        self._next_component_id += 1
+        self._components[component_id] = list(component)
+        for node in self._components[component_id]:
+            self._component_of[node] = component_id
+
+    def _drop_component(self, component_id: int) -> List[Node]:
+        component = self._components.pop(component_id)
+        self._cycle_issues.pop(component_id, None)
+        for node in component:
+            del self._component_of[node]
+        return component
+
+    def _component_through(self, rule_id: int) -> Set[Node]:
+        """ルールを含む強連結成分（ルールへ戻れる節点を後ろ向きにたどり、その中だけを前向きにたどる）"""
+        reaches_rule: Set[Node] = {rule_id}
+        queue = deque([rule_id])
+        while queue:
+            for node in self._predecessors(queue.popleft()):
+                if node not in reaches_rule:
+                    reaches_rule.add(node)
+                    queue.append(node)
+        component: Set[Node] = {rule_id}
+        queue = deque([rule_id])
+        while queue:
+            for node in self._successors(queue.popleft()):
+                if node in reaches_rule and node not in component:
+                    component.add(node)
+                    queue.append(node)
+        return component
+
+    def _recheck_cycles(self, rule_id: int, rule: Optional[Rule]):
+        """
+        - 変更前のルールを含んでいた成分は、ルールを除いた節点だけで分解し直す（他の成分は変わらない）
+        - 変更後のルールを含む成分を求め、それに含まれる既存の成分と置き換える
+        """
+        component_id = self._component_of.get(rule_id)
+        if component_id is not None:
+            members = set(self._drop_component(component_id))
+            members.discard(rule_id)
+            for component in strongly_connected_components(
+                [node for node in members if not isinstance(node, str)],
+                lambda node: (child for child in self._successors(node) if child in members)
+            ):
+                self._add_component(component)
+        if rule is not None and rule.conditions and rule.actions:
+            component = self._component_through(rule_id)
+            if len(component) > 1:
+                for merged in {self._component_of[node] for node in component if node in self._component_of}:
+                    self._drop_component(merged)
+                self._add_component(component)
+
+    def _circular_references(self) -> List[Dict]:
+        issues = []
+        for component_id, component in self._components.items():
+            issue = self._cycle_issues.get(component_id)
+            if issue is None:
+                issue = self._cycle_issues[component_id] = circular_reference(
+                    component, self.rules, lambda fact: self._dependent.get(fact, ())
+                )
+            issues.append(issue)
+        issues.sort(key=lambda issue: issue["involved_rules"][0])
+        return issues
+
+    # ===== 変更 =====
+    def _apply(self, rule_id: int, rule: Optional[Rule]):
+        """ルールを追加・変更（rule=None なら削除）し、影響する範囲の結果を検証し直す"""
+        old_rule = self.rules.get(rule_id)
+        if old_rule is None and rule is None:
+            return
+        action_facts: Set[str] = set()
+        condition_facts: Set[str] = set()
+        for changed in (old_rule, rule):
+            if changed is not None:
+                action_facts.update(action["fact"] for action in changed.actions)
+                condition_facts.update(cond["fact"] for cond in changed.conditions)
+
+        if old_rule is not None:
+            self._unindex(old_rule)
+        if rule is not None:
+            self._index(rule)
+
+        for fact in action_facts | condition_facts:
+            self._recheck_fact(fact)
+        # 結論の事実の導出ルール（有効・無効）が変わると、それを条件とするルールの到達可能性が変わる
+        rule_ids = {rule_id}
+        for fact in action_facts:
+            rule_ids.update(self._dependent.get(fact, ()))
+        for affected in rule_ids:
+            self._recheck_rule(affected)
+        self._recheck_cycles(rule_id, rule)
+
+    def apply(self, rule_id: int, rule: Optional[Rule]):
+        """ルールの変更を反映する（rule=None なら削除）"""
+        with self._lock:
+            self._apply(rule_id, rule)
+
+    def apply_change(self, rule_id: int, rule: Optional[Rule], version: int):
+        """
+        確定したルールの変更を反映し、版を進める（rule=None なら削除）
+        前回合わせた版からこの変更だけで version に進んだ場合に限る。それ以外は次の sync で全体を比べる
+        """
+        with self._lock:
+            if self.version is not None and version == self.version + 1:
+                self._apply(rule_id, rule)
+                self.version = version
+
+    def sync(self, rules: Iterable[Rule], version: Optional[int] = None):
+        """
+        ルールベース全体に合わせる（前回と異なるルールだけを反映する）
+        version を渡すと、前回と同じ版なら何もしない
+        """
+        with self._lock:
+            if version is not None and version == self.version:
+                return
+            rules = {rule.id: rule for rule in rules}
+            changed = [rule for rule_id, rule in rules.items() if self.rules.get(rule_id) != rule]
+            removed = [rule_id for rule_id in self.rules if rule_id not in rules]
+            if len(changed) + len(removed) > max(len(rules) // 4, 16):
+                self._reset(rules.values())
+            else:
+                for rule_id in removed:
+                    self._apply(rule_id, None)
+                for rule in changed:
+                    self._apply(rule.id, rule)
+            self.version = version
+
+    # ===== 結果 =====
+    def _results(self) -> Dict[str, List[Dict]]:
+        results = self._memo.get(self.content_hash)
+        if results is None:
+            results = {
+                "contradictions": [issue for issues in self._contradictions.values() for issue in issues],
+                "unreachable_rules": [self._unreachable[rule_id] for rule_id in self._ordered(self._unreachable)],
+                "circular_references": self._circular_references(),
+                "orphaned_facts": list(self._orphaned.values())
+            }
+            self._remember(self.content_hash, results)
+        else:
+            self._memo.move_to_end(self.content_hash)
+        return results
+
+    def _remember(self, content_hash: int, results: Dict[str, List[Dict]]):
+        self._memo[content_hash] = results
+        while len(self._memo) > self.MEMO_SIZE:
+            self._memo.popitem(last=False)
+
+    def validate_all(self) -> Dict[str, List[Dict]]:
+        """現在のルールベースの検証結果（RuleValidator.validate_all と同じ形）"""
+        with self._lock:
+            return self._results()
+
+    def validate_change(self, rule_id: int, rule: Optional[Rule]) -> Dict[str, List[Dict]]:
+        """
+        ルールを追加・変更（rule=None なら削除）した場合の全体の検証結果
+        保持している状態は変えない（変更を反映して結果を取り、元に戻す）
+        """
+        with self._lock:
+            old_rule = self.rules.get(rule_id)
+            content_hash = self.content_hash ^ self._digests.get(rule_id, 0)
+            if rule is not None:
+                content_hash ^= self.rule_digest(rule)
+            results = self._memo.get(content_hash)
+            if results is not None:
+                self._memo.move_to_end(content_hash)
+                return results
+
+            self._apply(rule_id, rule)
+            try:
+                results = self._results()
+            finally:
+                self._apply(rule_id, old_rule)
+            return results
+
+    def test_rule_modification(self, modified_rule: Rule) -> Dict:
+        """ルール変更のテスト実行（RuleValidator.test_rule_modification と同じ形）"""
+        validation_results = self.validate_change(modified_rule.id, modified_rule)
+        return {
+            "is_valid": is_validation_passed(validation_results),
+            "validation_results": validation_results
+        }
@@ -0,0 +1,313 @@
+"""
+DBのルールベース - rules テーブルのルール定義を不変のスナップショット（RuleSet）にして全セッションで共有する
+
+- ルールの変更（管理API）は rules テーブルの更新と、ルールベースの版（rulebase_versions の1行）の
+  繰り上げを1トランザクションで行う
+- 各ワーカーは一定間隔で版だけを読み（主キーで1行）、変わっていればルール定義を読み直して
+  新しい RuleSet を作り、参照を差し替える（コピーオンライト。読み取り側はロックを取らない）
+- 診断セッションは開始時の RuleSet を持ち続ける（session["rule_set"]）。
+  途中でルールが変わっても、そのセッションは開始時のルールで診断を続ける
+- 古い RuleSet はどのセッションからも参照されなくなればガベージコレクションで回収される。
+  トークン・共有ストアのセッションは参照を持たないため、直近 retain 版までは残しておく
+  （それより古い版のセッションはこれまでどおり 409 になる）
+- rules テーブルが空なら VISA_RULES を初期データとして入れる
+"""
+
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.models import models
+from app.services.inference_engine import InferenceEngine
+from app.services.rule_cache import RuleSnapshot
+from app.services.session_token import (
+    DEFAULT_TOKEN_TTL, FINGERPRINT_SIZE, InvalidSessionToken, SessionCodec, SessionTokenMismatch, SignedTokens
+)
+
+DEFAULT_POLL_INTERVAL = 5  # 秒（0 はポーリングしない）
+DEFAULT_RETAIN = 8  # 参照がなくても残しておく直近の版の数（トークン・共有ストアのセッション用。メモリ上のセッションには不要）
+RULEBASE_VERSION_ID = 1  # rulebase_versions の唯一の行
+
+_rules = models.Rule.__table__
+_versions = models.RuleBaseVersion.__table__
+
+# ルール定義の辞書の項目（VISA_RULES と同じ順序）
+RULE_FIELDS = ("id", "name", "visa_type", "rule_type", "conditions", "actions", "flag", "priority",
+               "description", "version")
+# 管理APIで変更できる項目
+EDITABLE_FIELDS = ("name", "visa_type", "rule_type", "conditions", "actions", "flag", "priority", "description")
+
+
+# ===== DB =====
+def _rule_dict(row) -> Dict:
+    return {field: getattr(row, field) for field in RULE_FIELDS}
+
+
+def read_rulebase_version(db: Session) -> int:
+    """ルールベースの版（行がなければ 0）"""
+    return db.execute(
+        select(_versions.c.version).where(_versions.c.id == RULEBASE_VERSION_ID)
+    ).scalar() or 0
+
+
+def load_rules(db: Session) -> Tuple[int, List[Dict]]:
+    """Returns: (ルールベースの版, ルール定義（ID順）)（1トランザクションで読む）"""
+    version = read_rulebase_version(db)
+    rows = db.execute(select(*(_rules.c[field] for field in RULE_FIELDS)).order_by(_rules.c.id)).all()
+    db.commit()
+    return version, [_rule_dict(row) for row in rows]
+
+
+def bump_rulebase_version(db: Session) -> int:
+    """ルールベースの版を1つ進める（コミットは呼び出し側） Returns: 新しい版"""
+    version = db.execute(
+        update(_versions).where(_versions.c.id == RULEBASE_VERSION_ID)
+        .values(version=_versions.c.version + 1).returning(_versions.c.version)
+    ).scalar()
+    if version is None:
+        version = 1
+        db.execute(insert(_versions).values(id=RULEBASE_VERSION_ID, version=version))
+    return version
+
+
+def seed_rules(db: Session, rules: Iterable[Dict]) -> bool:
+    """
+    rules テーブルが空なら初期データを入れる（複数のワーカーが同時に入れようとした場合は1つだけが成功する）
+    Returns: 入れたか
+    """
+    if db.execute(select(func.count()).select_from(_rules)).scalar():
+        return False
+    try:
+        db.execute(insert(_rules), [
+            dict({field: rule.get(field) for field in RULE_FIELDS}, version=rule.get("version", 1))
+            for rule in rules
+        ])
+        bump_rulebase_version(db)
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return False
+    return True
+
+
+def insert_rule(db: Session, rule: Dict) -> Dict:
+    """ルールを追加する（IDは最大のID + 1、コミットは呼び出し側）"""
+    rule_id = (db.execute(select(func.max(_rules.c.id))).scalar() or 0) + 1
+    values = {field: rule.get(field) for field in EDITABLE_FIELDS}
+    row = db.execute(
+        insert(_rules).values(dict(values, id=rule_id, version=1))
+        .returning(*(_rules.c[field] for field in RULE_FIELDS))
+    ).one()
+    bump_rulebase_version(db)
+    return _rule_dict(row)
+
+
+def update_rule_row(db: Session, rule_id: int, changes: Dict,
+                    expected_version: Optional[int] = None) -> Optional[Dict]:
+    """
+    ルールを更新し、ルールの版を1つ進める（コミットは呼び出し側）
+    expected_version を渡すと、DB上の版が一致する場合だけ更新する（楽観的ロック）
+    Returns: 更新後のルール（ルールがない・版が一致しない場合は None）
+    """
+    condition = _rules.c.id == rule_id
+    if expected_version is not None:
+        condition = condition & (_rules.c.version == expected_version)
+    values = {field: value for field, value in changes.items() if field in EDITABLE_FIELDS}
+    row = db.execute(
+        update(_rules).where(condition).values(dict(values, version=_rules.c.version + 1))
+        .returning(*(_rules.c[field] for field in RULE_FIELDS))
+    ).first()
+    if row is None:
+        return None
+    bump_rulebase_version(db)
+    return _rule_dict(row)
+
+
+def delete_rule_row(db: Session, rule_id: int) -> Optional[Dict]:
+    """ルールを削除する（コミットは呼び出し側） Returns: 削除したルール（なければ None）"""
+    row = db.execute(
+        _rules.delete().where(_rules.c.id == rule_id).returning(*(_rules.c[field] for field in RULE_FIELDS))
+    ).first()
+    if row is None:
+        return None
+    bump_rulebase_version(db)
+    return _rule_dict(row)
+
+
+# ===== スナップショット =====
+class RuleSet:
+    """
+    ある版のルール定義から作った推論用の一式（不変。作った後は変更しない）
+    ルール定義の辞書も共有するため、変更するときは写しを作ること。
+    """
+
+    __slots__ = (
+        "version", "rules", "by_id", "engine", "rule_base", "question_tables",
+        "resolution_count_selector", "answer_priors", "session_codec", "key", "_responses", "__weakref__",
+    )
+
+    def __init__(self, version: int, rules: List[Dict], engine: InferenceEngine, question_tables: Dict,
+                 resolution_count_selector, answer_priors):
+        self.version = version
+        self.rules: Tuple[Dict, ...] = tuple(rules)
+        self.by_id: Dict[int, Dict] = {rule["id"]: rule for rule in self.rules}
+        self.engine = engine
+        self.rule_base = engine.rule_base
+        self.question_tables = question_tables
+        self.resolution_count_selector = resolution_count_selector
+        self.answer_priors = answer_priors
+        self.session_codec = SessionCodec(self.rule_base)
+        # トークン・共有ストアのヘッダーに入る fingerprint（復元時にこの RuleSet を探す）
+        self.key = self.session_codec.header[1:]
+        self._responses: Optional[RuleSnapshot] = None
+
+    @property
+    def responses(self) -> RuleSnapshot:
+        """ルール定義のレスポンス本文（初回に作る）"""
+        responses = self._responses
+        if responses is None:
+            responses = self._responses = RuleSnapshot(list(self.rules), self.version)
+        return responses
+
+
+class RuleBaseRegistry:
+    """
+    現在の RuleSet と、セッションが参照している古い RuleSet
+    current の読み取りはロックを取らない（差し替えは参照の代入1回）。
+    """
+
+    def __init__(self, session_factory: Callable[[], Session], build: Callable[[int, List[Dict]], RuleSet],
+                 poll_interval: float = DEFAULT_POLL_INTERVAL, retain: int = DEFAULT_RETAIN,
+                 seed: Iterable[Dict] = ()):
+        self.session_factory = session_factory
+        self.build = build
+        self.poll_interval = poll_interval
+        self.seed = list(seed)
+        self.current: Optional[RuleSet] = None
+        self.reload_count = 0
+        self._by_key: "weakref.WeakValueDictionary[bytes, RuleSet]" = weakref.WeakValueDictionary()
+        self._recent: deque = deque(maxlen=retain)  # 参照がなくても残しておく直近の RuleSet
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _read(self, operation: Callable, *args):
+        db = self.session_factory()
+        try:
+            return operation(db, *args)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def load(self) -> RuleSet:
+        """初回の読み込み（rules テーブルが空なら初期データを入れる）"""
+        if self.seed:
+            self._read(seed_rules, self.seed)
+        self.reload()
+        return self.current
+
+    def reload(self) -> bool:
+        """
+        ルール定義を読み直し、版が進んでいれば新しい RuleSet に差し替える
+        Returns: 差し替えたか
+        """
+        with self._reload_lock:
+            version, rules = self._read(load_rules)
+            current = self.current
+            if current is not None and version <= current.version:
+                return False
+            rule_set = self.build(version, rules)
+            self._by_key[rule_set.key] = rule_set
+            self._recent.append(rule_set)
+            self.current = rule_set
+            self.reload_count += 1
+            return True
+
+    def refresh(self) -> bool:
+        """版だけを読み、変わっていれば読み直す Returns: 差し替えたか"""
+        current = self.current
+        if current is not None and self._read(read_rulebase_version) == current.version:
+            return False
+        return self.reload()
+
+    def find(self, key: bytes) -> Optional[RuleSet]:
+        """fingerprint（トークン・共有ストアのヘッダー）に一致する RuleSet（回収済みなら None）"""
+        current = self.current
+        if current is not None and current.key == key:
+            return current
+        return self._by_key.get(key)
+
+    def stats(self) -> Dict:
+        current = self.current
+        return {
+            "version": current.version if current else None,
+            "fingerprint": current.rule_base.fingerprint if current else None,
+            "rule_count": len(current.rules) if current else 0,
+            "live_versions": sorted(rule_set.version for rule_set in list(self._by_key.values())),
+            "reload_count": self.reload_count,
+            "poll_interval": self.poll_interval
+        }
+
+    # ===== 版のポーリング =====
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception:
+                # DBに接続できない間は今の RuleSet を使い続ける
+                continue
+
+    def start(self):
+        if self._thread is not None or self.poll_interval <= 0:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="rulebase-poller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+
+# ===== セッションの保存形式 =====
+class RuleSetSessionCodec:
+    """
+    セッションを開始時の RuleSet の SessionCodec で詰め、
+    復元時はヘッダーの fingerprint に一致する RuleSet で戻す（session["rule_set"] も付け直す）
+    """
+
+    def __init__(self, registry: RuleBaseRegistry):
+        self.registry = registry
+
+    def pack(self, session_id: str, session: Dict) -> bytes:
+        return session["rule_set"].session_codec.pack(session_id, session)
+
+    def unpack(self, data: bytes) -> Tuple[str, Dict]:
+        if len(data) < 1 + FINGERPRINT_SIZE:
+            raise InvalidSessionToken("トークンの形式が不正です")
+        rule_set = self.registry.find(bytes(data[1:1 + FINGERPRINT_SIZE]))
+        if rule_set is None:
+            raise SessionTokenMismatch("ルールが更新されたため、このセッションは継続できません")
+        session_id, session = rule_set.session_codec.unpack(data)
+        session["rule_set"] = rule_set
+        return session_id, session
+
+
+class RuleSetTokenCodec(SignedTokens, RuleSetSessionCodec):
+    """RuleSetSessionCodec の署名付きトークン版"""
+
+    def __init__(self, registry: RuleBaseRegistry, secret: bytes, ttl: int = DEFAULT_TOKEN_TTL,
+                 clock: Callable[[], float] = time.time):
+        super().__init__(registry)
+        self._init_signing(secret, ttl, clock)
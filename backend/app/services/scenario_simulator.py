@@ -0,0 +1,324 @@
+"""
+シナリオシミュレーター - 推論エンジンの回答木を網羅的にたどり、回答の列と診断結果の関係を集計する
+
+ゴールの組み合わせについて、はい/いいえ/わからない の全ての回答の列を推論エンジンで実行し、
+- 質問数（経路長）のヒストグラムと最長経路
+- ゴールごとの到達経路数、到達したゴールの組み合わせごとの経路数
+- ルールごとの発火経路数
+を出力する。導出可能な事実への「わからない」は API と同じく最初の詳細質問に進む。
+
+同じ状態から先の回答木は同じになるため、状態ごとに部分木の集計をメモ化する。
+状態は以降の質問と推論に影響する部分（未評価のルール、その条件とゴールの真偽、質問候補になりうる事実）だけで比較する。
+上位の状態を展開して得た部分木をプロセスプールに分配し、結果を合成する。
+
+使い方:
+    python -m app.services.scenario_simulator --visa-types E B L [--workers 4] [--json]
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from app.services.inference_engine import (
+    AnswerType, BitsetWorkingMemory, InferenceEngine, Rule, RuleBase, RuleStatus, EVALUATION_MODE_AGENDA
+)
+
+ANSWERS = (AnswerType.YES, AnswerType.NO, AnswerType.UNKNOWN)
+
+
+@dataclass
+class ScenarioStats:
+    """ある状態から診断完了までの全経路の集計"""
+    paths: int = 0
+    length_histogram: Dict[int, int] = field(default_factory=dict)  # 質問数 → 経路数
+    goal_paths: Dict[str, int] = field(default_factory=dict)  # ゴール → 到達する経路数
+    outcome_paths: Dict[Tuple[str, ...], int] = field(default_factory=dict)  # 到達ゴールの組み合わせ → 経路数
+    rule_fire_paths: Dict[int, int] = field(default_factory=dict)  # ルールID → 発火する経路数
+    longest_path: Tuple[Tuple[str, str], ...] = ()  # 最長経路の (質問, 回答)
+
+    @classmethod
+    def leaf(cls, achieved_goals: Tuple[str, ...]) -> "ScenarioStats":
+        """診断完了の状態（質問0件の経路が1本）"""
+        return cls(
+            paths=1,
+            length_histogram={0: 1},
+            goal_paths={goal: 1 for goal in achieved_goals},
+            outcome_paths={achieved_goals: 1}
+        )
+
+    def add_branch(self, fact: str, answer: AnswerType, child: "ScenarioStats", fired_rules: List[int]):
+        """この状態で fact に answer と回答した先の部分木を加える"""
+        self.paths += child.paths
+        for length, count in child.length_histogram.items():
+            self.length_histogram[length + 1] = self.length_histogram.get(length + 1, 0) + count
+        for goal, count in child.goal_paths.items():
+            self.goal_paths[goal] = self.goal_paths.get(goal, 0) + count
+        for outcome, count in child.outcome_paths.items():
+            self.outcome_paths[outcome] = self.outcome_paths.get(outcome, 0) + count
+        for rule_id, count in child.rule_fire_paths.items():
+            self.rule_fire_paths[rule_id] = self.rule_fire_paths.get(rule_id, 0) + count
+        # この回答で発火したルールは、この先の全経路で発火している
+        for rule_id in fired_rules:
+            self.rule_fire_paths[rule_id] = self.rule_fire_paths.get(rule_id, 0) + child.paths
+        if not self.longest_path or len(child.longest_path) + 1 > len(self.longest_path):
+            self.longest_path = ((fact, answer.value),) + child.longest_path
+
+    def to_dict(self) -> Dict:
+        return {
+            "paths": self.paths,
+            "max_questions": max(self.length_histogram, default=0),
+            "length_histogram": {str(length): self.length_histogram[length]
+                                 for length in sorted(self.length_histogram)},
+            "goal_paths": self.goal_paths,
+            "outcome_paths": [
+                {"goals": list(outcome), "paths": count}
+                for outcome, count in sorted(self.outcome_paths.items(), key=lambda item: -item[1])
+            ],
+            "rule_fire_paths": {str(rule_id): self.rule_fire_paths[rule_id]
+                                for rule_id in sorted(self.rule_fire_paths)},
+            "longest_path": [{"fact": fact, "answer": answer} for fact, answer in self.longest_path]
+        }
+
+
+class ScenarioSimulator:
+    """1プロセス分のシミュレーター（状態ごとに部分木の集計をメモ化する）"""
+
+    def __init__(self, engine: InferenceEngine, goals: List[str]):
+        self.engine = engine
+        self.goals = list(goals)
+        self.memo: Dict[Tuple, ScenarioStats] = {}
+
+        rule_base = engine.rule_base
+        fact_table = rule_base.fact_table
+        self._goal_bits = [(goal, fact_table.bit(goal)) for goal in self.goals]
+        self._goal_mask = fact_table.mask_of(self.goals)
+        # 導出可能な事実 → 全ての導出ルールの条件事実（詳細質問の候補）
+        self._detail_masks = {
+            fact_table.ids[fact]: fact_table.mask_of(
+                cond["fact"] for rule_id in rule_ids for cond in rule_base.rules[rule_id].conditions
+            )
+            for fact, rule_ids in rule_base.fact_to_deriving_rules.items()
+        }
+        # ルール → (ルール番号のビット, 条件と結論の事実)
+        self._rule_masks = [
+            (rule_id, 1 << i, rule_base.condition_masks[rule_id]
+             | fact_table.mask_of(action["fact"] for action in rule.actions))
+            for i, (rule_id, rule) in enumerate(rule_base.rules.items())
+            if rule.flag
+        ]
+
+    def state_key(self, wm: BitsetWorkingMemory, forced: Optional[str]) -> Tuple:
+        """
+        以降の回答木を決める状態のキー
+        発火・スキップ済みのルールは以降変化しない。事実の真偽は未評価のルールとゴールにだけ、
+        判明済みかどうかはそれに加えて以降の質問候補にだけ影響するため、それ以外はキーから除く。
+        """
+        statuses = wm.evaluated_rules
+        live_rules = 0
+        valued = self._goal_mask  # 真偽が以降に影響する事実（未評価のルールの条件と結論、ゴール）
+        for rule_id, bit, mask in self._rule_masks:
+            status = statuses.get(rule_id)
+            if status is not RuleStatus.FIRED and status is not RuleStatus.SKIPPED:
+                live_rules |= bit
+                valued |= mask
+
+        # 判明済みかどうかが以降に影響する事実（質問候補と詳細質問の候補）
+        # 判明済みの事実が増えると必要な事実は減る一方なので、今の必要な事実の外は以降も質問されない
+        # ORグループのメンバーの真偽は、成立済みのグループを必要な事実から除くためにも使う
+        known = wm.known_mask
+        true = wm.true_mask
+        needed = 0
+        for goal, bit in self._goal_bits:
+            if not bit & known:
+                needed |= self.engine.get_needed_fact_mask(goal, known, true)
+        relevant = valued | needed
+        derivable = needed & self.engine.rule_base.derivable_mask
+        while derivable:
+            low = derivable & -derivable
+            derivable ^= low
+            relevant |= self._detail_masks[low.bit_length() - 1]
+        valued |= self.engine.rule_base.or_member_mask
+
+        return (
+            forced, live_rules,
+            wm.known_findings & relevant, wm.true_findings & valued,
+            wm.known_hypotheses & relevant, wm.true_hypotheses & valued,
+            wm.skipped_mask & relevant
+        )
+
+    def next_question(self, wm: BitsetWorkingMemory, forced: Optional[str]) -> Optional[str]:
+        return forced if forced is not None else self.engine.get_next_question(self.goals, wm)
+
+    def achieved_goals(self, wm: BitsetWorkingMemory) -> Tuple[str, ...]:
+        return tuple(goal for goal, achieved in self.engine.check_goals(self.goals, wm).items() if achieved)
+
+    def answer(self, wm: BitsetWorkingMemory, fact: str,
+               answer: AnswerType) -> Tuple[Optional[str], List[int], bool]:
+        """
+        回答を処理する（API と同じく、詳細質問が必要なら次は最初の詳細質問）
+        Returns: (次の詳細質問, 発火したルール, 経路の終わりか)
+        詳細質問が残っていない導出可能な事実への「わからない」は、API でも次の質問がなくなるため経路の終わりとする
+        """
+        result = self.engine.process_answer(fact, answer, wm)
+        if result["detail_questions_needed"]:
+            if not result["detail_questions"]:
+                return None, [], True
+            return result["detail_questions"][0], [], False
+        return None, result["fired_rules"], False
+
+    def explore(self, wm: BitsetWorkingMemory, forced: Optional[str] = None) -> ScenarioStats:
+        """wm から診断完了までの全経路を集計する（wm は呼び出し前の状態に戻る）"""
+        key = self.state_key(wm, forced)
+        stats = self.memo.get(key)
+        if stats is not None:
+            return stats
+
+        fact = self.next_question(wm, forced)
+        if fact is None:
+            stats = ScenarioStats.leaf(self.achieved_goals(wm))
+        else:
+            stats = ScenarioStats()
+            for answer in ANSWERS:
+                with wm.journal() as trail:
+                    child_forced, fired_rules, stopped = self.answer(wm, fact, answer)
+                if stopped:
+                    child = ScenarioStats.leaf(self.achieved_goals(wm))
+                else:
+                    child = self.explore(wm, child_forced)
+                wm.rollback(trail)
+                stats.add_branch(fact, answer, child, fired_rules)
+
+        self.memo[key] = stats
+        return stats
+
+    def frontier(self, wm: BitsetWorkingMemory, min_size: int) -> List[Tuple[Tuple, Dict, Optional[str]]]:
+        """
+        上位の状態を幅優先で展開し、未展開の状態が min_size 以上になった段の状態を返す
+        Returns: [(状態のキー, 作業記憶の辞書, 詳細質問), ...]（診断完了の状態は含めない）
+        """
+        level = [(self.state_key(wm, None), wm.to_dict(), None)]
+        while level and len(level) < min_size:
+            next_level = {}
+            for _, data, forced in level:
+                state = BitsetWorkingMemory.from_dict(data, self.engine.fact_table)
+                fact = self.next_question(state, forced)
+                if fact is None:
+                    continue
+                for answer in ANSWERS:
+                    with state.journal() as trail:
+                        child_forced, _, stopped = self.answer(state, fact, answer)
+                    key = self.state_key(state, child_forced)
+                    if not stopped and key not in next_level:
+                        next_level[key] = (key, state.to_dict(), child_forced)
+                    state.rollback(trail)
+            level = list(next_level.values())
+        return level
+
+
+def build_engine(rules: List[Dict]) -> InferenceEngine:
+    return InferenceEngine(RuleBase([Rule.from_dict(r) for r in rules]),
+                           evaluation_mode=EVALUATION_MODE_AGENDA)
+
+
+# ワーカープロセスごとのシミュレーター（メモはプロセス内の部分木の間で共有する）
+_worker_simulator: Optional[ScenarioSimulator] = None
+
+
+def _init_worker(rules: List[Dict], goals: List[str]):
+    global _worker_simulator
+    _worker_simulator = ScenarioSimulator(build_engine(rules), goals)
+
+
+def _explore_subtree(task: Tuple[Dict, Optional[str]]) -> Tuple[ScenarioStats, int]:
+    """部分木を集計する Returns: (集計, この部分木で新たにメモ化した状態数)"""
+    data, forced = task
+    wm = BitsetWorkingMemory.from_dict(data, _worker_simulator.engine.fact_table)
+    memo_size = len(_worker_simulator.memo)
+    stats = _worker_simulator.explore(wm, forced)
+    return stats, len(_worker_simulator.memo) - memo_size
+
+
+def simulate(rules: List[Dict], goals: List[str], workers: Optional[int] = None) -> Tuple[ScenarioStats, int]:
+    """
+    回答木を網羅的に集計する
+    workers が2以上なら上位の状態を展開し、部分木をプロセスプールで並列に集計する。
+    Returns: (診断開始時からの集計, メモ化した状態数（ワーカー間で重複した状態は重複して数える）)
+    """
+    workers = workers or os.cpu_count() or 1
+    simulator = ScenarioSimulator(build_engine(rules), goals)
+    root = simulator.engine.create_working_memory(compact=True)
+
+    state_count = 0
+    if workers > 1:
+        # ワーカー間の負荷が偏らないよう、ワーカー数より十分多い部分木に分ける
+        frontier = simulator.frontier(root, min_size=workers * 8)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(rules, goals)) as pool:
+            subtrees = pool.map(_explore_subtree, [(data, forced) for _, data, forced in frontier])
+            for (key, _, _), (stats, subtree_states) in zip(frontier, subtrees):
+                simulator.memo[key] = stats
+                state_count += subtree_states - 1  # 部分木の根は上位部分で数える
+
+    # 上位部分を集計（部分木はメモ済みの結果を使う）
+    stats = simulator.explore(root)
+    return stats, state_count + len(simulator.memo)
+
+
+def format_report(goals: List[str], stats: ScenarioStats, state_count: int) -> str:
+    """集計結果をテキストで整形する"""
+    lines = [
+        f"ゴール: {', '.join(goals)}",
+        f"経路数: {stats.paths}（メモ化した状態数: {state_count}）",
+        f"最大質問数: {max(stats.length_histogram, default=0)}",
+        "",
+        "質問数のヒストグラム:"
+    ]
+    peak = max(stats.length_histogram.values(), default=1)
+    for length in sorted(stats.length_histogram):
+        count = stats.length_histogram[length]
+        lines.append(f"  {length:3d} {count:>12d} {'#' * max(1, round(40 * count / peak))}")
+
+    lines += ["", "ゴールへの到達:"]
+    for goal in goals:
+        count = stats.goal_paths.get(goal, 0)
+        lines.append(f"  {goal}: {count} 経路（{100 * count / stats.paths:.1f}%）"
+                     f"{'' if count else ' ※到達不能'}")
+
+    lines += ["", "到達したゴールの組み合わせ:"]
+    for outcome, count in sorted(stats.outcome_paths.items(), key=lambda item: -item[1]):
+        lines.append(f"  {count:>12d}  {', '.join(outcome) or '（なし）'}")
+
+    lines += ["", "ルールごとの発火経路数:"]
+    for rule_id in sorted(stats.rule_fire_paths):
+        lines.append(f"  ルール{rule_id}: {stats.rule_fire_paths[rule_id]}")
+
+    lines += ["", "最長経路:"]
+    for i, (fact, answer) in enumerate(stats.longest_path, 1):
+        lines.append(f"  {i:3d}. {fact} → {answer}")
+    return "\n".join(lines)
+
+
+def main():
+    from app.services.visa_rules import VISA_RULES, VISA_TYPE_GOALS
+
+    parser = argparse.ArgumentParser(description="推論エンジンの回答木を網羅的に集計する")
+    parser.add_argument("--visa-types", nargs="+", default=["E", "B", "L"], choices=list(VISA_TYPE_GOALS),
+                        help="診断対象のビザタイプ")
+    parser.add_argument("--workers", type=int, default=None, help="ワーカープロセス数（既定: CPU数）")
+    parser.add_argument("--json", action="store_true", help="JSONで出力する")
+    args = parser.parse_args()
+
+    goals = [goal for visa_type in args.visa_types for goal in VISA_TYPE_GOALS[visa_type]]
+    stats, state_count = simulate(VISA_RULES, goals, workers=args.workers)
+
+    if args.json:
+        print(json.dumps(dict(stats.to_dict(), goals=goals, states=state_count), ensure_ascii=False, indent=2))
+    else:
+        print(format_report(goals, stats, state_count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+セッション状態の差分 - 回答・戻るごとに変化したルール状態と作業記憶だけをクライアントに返す
+
+セッションは状態の版（state_version）を持ち、回答・一括回答・戻るのたびに1つ進める。
+各ステップの差分は、そのステップの作業記憶の差分記録（journal のトレイル）から作る。
+差分は直近 DEFAULT_STATE_LOG_SIZE 件までセッションの変更履歴（state_log）に残す。
+変更履歴は、クライアントが初めて状態を求めた時（include_state・?since=・WebSocket）に作る。
+それまでは差分を作らず、版だけを進める。
+クライアントは最後に受け取った版を送り、その版より後の差分が変更履歴にあれば
+それをまとめた差分を、なければ（取りこぼしが多い・トークンから復元したセッション等）全体を受け取る（再同期）。
+
+差分・全体は同じ形:
+    version: 適用後の版
+    full: True なら全体（クライアントは状態を置き換える）、False なら直前の版からの差分
+    rule_statuses: {ルールID: 状態}（未評価に戻ったルールは not_evaluated）
+    findings / hypotheses: 追加・変更された事実
+    removed_findings / removed_hypotheses: 取り消された事実
+      （複数ステップをまとめた差分では、途中で追加されて取り消された事実も含む。クライアントは無視してよい）
+    conflict_set: 発火したルール（変化した場合のみ、全体では常に）
+"""
+
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from app.services.inference_engine import RuleStatus, _MISSING, _PRESENT
+
+NOT_EVALUATED = RuleStatus.NOT_EVALUATED.value
+DEFAULT_STATE_LOG_SIZE = 64  # セッションごとに残すステップの差分の数
+_STATE_NAMES = ("findings", "hypotheses", "evaluated_rules", "conflict_set")  # 差分に含めるトレイルの項目
+
+
+def capture_state(wm) -> Dict:
+    """全体を返すための作業記憶の写し（ルール状態は評価済みのものだけ）"""
+    return {
+        "findings": dict(wm.findings),
+        "hypotheses": dict(wm.hypotheses),
+        "rule_statuses": {rule_id: status.value for rule_id, status in wm.evaluated_rules.items()},
+        "conflict_set": sorted(wm.conflict_set)
+    }
+
+
+def trail_delta(trails: Iterable[List[Tuple]], wm, version: int) -> Dict:
+    """
+    ステップのトレイル（記録順）と現在の作業記憶から、ステップ前との差分を作る
+    項目ごとに最初に記録された旧値がステップ前の値。途中で変わって元に戻った項目は含めない。
+    """
+    before = {name: {} for name in _STATE_NAMES}
+    for trail in trails:
+        for name, key, old in trail:
+            values = before.get(name)
+            if values is not None and key not in values:
+                values[key] = old
+
+    delta = {"version": version, "full": False, "rule_statuses": {}, "conflict_set": None}
+    for name in ("findings", "hypotheses"):
+        current = getattr(wm, name)
+        changed = delta[name] = {}
+        removed = delta["removed_" + name] = []
+        for fact, old in before[name].items():
+            if fact in current:
+                value = current[fact]
+                if old is _MISSING or old != value:
+                    changed[fact] = value
+            elif old is not _MISSING:
+                removed.append(fact)
+
+    evaluated_rules = wm.evaluated_rules
+    for rule_id, old in before["evaluated_rules"].items():
+        status = evaluated_rules.get(rule_id)
+        if (None if old is _MISSING else old) != status:
+            delta["rule_statuses"][rule_id] = NOT_EVALUATED if status is None else status.value
+
+    conflict_set = wm.conflict_set
+    if any((old is _PRESENT) != (rule_id in conflict_set) for rule_id, old in before["conflict_set"].items()):
+        delta["conflict_set"] = sorted(conflict_set)
+    return delta
+
+
+def full_state(state: Dict, rule_ids: Iterable[int], version: int) -> Dict:
+    """写しの全体（未評価のルールも含める）"""
+    return {
+        "version": version,
+        "full": True,
+        "rule_statuses": {rule_id: state["rule_statuses"].get(rule_id, NOT_EVALUATED) for rule_id in rule_ids},
+        "findings": state["findings"],
+        "hypotheses": state["hypotheses"],
+        "removed_findings": [],
+        "removed_hypotheses": [],
+        "conflict_set": state["conflict_set"]
+    }
+
+
+def record_state_step(session: Dict, trails: Optional[Iterable[List[Tuple]]], wm):
+    """
+    状態の版を進め、変更履歴があればこのステップの差分を残す
+    trails が None（作業記憶を作り直した等、差分記録がない）なら変更履歴を空にし、以前の版からは全体を返す。
+    （変更履歴はトークン・共有ストアには含めない。復元したセッションでは空から始まる）
+    """
+    version = session["state_version"] = session.get("state_version", 0) + 1
+    log = session.get("state_log")
+    if log is None:
+        return
+    if trails is None:
+        log.clear()
+    else:
+        log.append(trail_delta(trails, wm, version))
+
+
+def _merge_deltas(deltas: Iterable[Dict], version: int) -> Dict:
+    """連続する差分を1つにまとめる（後の差分を優先）"""
+    merged = {
+        "version": version, "full": False, "rule_statuses": {}, "findings": {}, "hypotheses": {},
+        "removed_findings": [], "removed_hypotheses": [], "conflict_set": None
+    }
+    removed = {"findings": {}, "hypotheses": {}}  # 順序を保った集合
+    for delta in deltas:
+        merged["rule_statuses"].update(delta["rule_statuses"])
+        for name in ("findings", "hypotheses"):
+            for fact, value in delta[name].items():
+                merged[name][fact] = value
+                removed[name].pop(fact, None)
+            for fact in delta["removed_" + name]:
+                merged[name].pop(fact, None)
+                removed[name][fact] = True
+        if delta["conflict_set"] is not None:
+            merged["conflict_set"] = delta["conflict_set"]
+    merged["removed_findings"] = list(removed["findings"])
+    merged["removed_hypotheses"] = list(removed["hypotheses"])
+    return merged
+
+
+def changes_since(session: Dict, since: Optional[int], rule_ids: Iterable[int],
+                  log_size: int = DEFAULT_STATE_LOG_SIZE) -> Dict:
+    """
+    クライアントが持っている版（since）より後の変更
+    変更履歴で足りない場合（since が None・古すぎる・未来の版）は全体を返す。
+    変更履歴がまだなければ作り、以降のステップの差分を残す。
+    """
+    version = session.get("state_version", 0)
+    log = session.get("state_log")
+    if log is None:
+        log = session["state_log"] = deque(maxlen=log_size)
+    if since is not None and 0 <= since <= version:
+        if since == version:
+            return _merge_deltas((), version)
+        if log and log[0]["version"] <= since + 1:
+            return _merge_deltas((delta for delta in log if delta["version"] > since), version)
+    return full_state(capture_state(session["wm"]), rule_ids, version)
@@ -0,0 +1,553 @@
+"""
+セッションストア - 診断セッション（作業記憶・ゴール・回答履歴）の保存先を差し替え可能にする
+
+- MemorySessionStore: プロセス内の辞書（従来どおり、単一ワーカー用）
+- SqliteSessionStore: SQLiteファイル（同じホストの複数ワーカーで共有）
+- KeyValueSessionStore: ネットワークのキーバリューストア（Redis 等、複数インスタンスで共有）
+
+共有するストアは SessionCodec の形式（事実ID・圧縮）で保存し、セッションを書き込むたびに版数を進める。
+CachedSessionStore はワーカーごとに最近使ったセッションを保持する LRU キャッシュで、
+書き込みは常に共有ストアへ書き通す。読み込みは版数だけを照合し、一致すれば復元せずにキャッシュを使う
+（他のワーカーが更新したセッションは版数が変わるため読み直す）。
+
+保存したセッションには回答ごとの差分（trail）を含めないため、
+共有ストアから読み直したセッションの「戻る」は回答履歴の再適用で行う。
+
+MemorySessionStore は最終アクセスからの経過時間（idle_ttl）とセッション数の上限（max_sessions）で
+古いセッションを追い出す。追い出したセッションIDは drain_evicted() で取り出し、
+SessionSweeper（app.services.session_sweeper）がDBのセッションを abandoned にする。
+共有するストアも idle_ttl で期限切れにする（SQLite は最終アクセス時刻の列と sweep、
+キーバリューストアはキーの有効期限（Redis の EX）。キーバリューストアの期限切れは
+ストアが消すため drain_evicted() には現れない）。
+"""
+
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+from enum import Enum
+from typing import Callable, Dict, List, Optional, Tuple
+
+from app.services.inference_engine import FactTable
+from app.services.session_token import SessionCodec
+
+# セッションストアの種類
+SESSION_STORE_MEMORY = "memory"
+SESSION_STORE_SQLITE = "sqlite"
+SESSION_STORE_REDIS = "redis"
+SESSION_STORES = (SESSION_STORE_MEMORY, SESSION_STORE_SQLITE, SESSION_STORE_REDIS)
+
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_IDLE_TTL = 7200  # 秒
+DEFAULT_MAX_SESSIONS = 10000
+
+# セッションのうち全セッションで共有するもの（メモリの概算に含めない）
+_SHARED_SESSION_KEYS = ("question_table", "rule_set")
+
+
+def estimate_session_bytes(session: Dict) -> int:
+    """
+    セッションが保持するメモリの概算（sys.getsizeof の合計）
+    全セッションで共有する質問決定表・事実表・列挙値は含めない。
+    """
+    seen = set()
+    total = 0
+    stack = [session]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (Enum, FactTable)):
+            continue
+        seen.add(id(obj))
+        total += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            for key, value in obj.items():
+                if key not in _SHARED_SESSION_KEYS:
+                    stack.append(key)
+                    stack.append(value)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, "__dict__"):
+            stack.append(vars(obj))
+        elif hasattr(obj, "__slots__"):
+            stack.extend(getattr(obj, name, None) for name in obj.__slots__)
+    return total
+
+
+class SessionStore:
+    """セッションの保存先（セッションIDごとにセッションの辞書を保持する）"""
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def put(self, session_id: str, session: Dict):
+        raise NotImplementedError
+
+    def delete(self, session_id: str):
+        raise NotImplementedError
+
+    def sweep(self) -> int:
+        """期限切れのセッションを追い出す Returns: 追い出したセッション数"""
+        return 0
+
+    def drain_evicted(self) -> List[str]:
+        """前回の呼び出し以降に追い出したセッションID（取り出すと空になる）"""
+        return []
+
+    def stats(self) -> Dict[str, int]:
+        """このワーカーが保持しているセッション数とメモリの概算（バイト）"""
+        return {"sessions": 0, "bytes": 0}
+
+    def __getitem__(self, session_id: str) -> Dict:
+        session = self.get(session_id)
+        if session is None:
+            raise KeyError(session_id)
+        return session
+
+    def __contains__(self, session_id: str) -> bool:
+        return self.get(session_id) is not None
+
+
+class MemorySessionStore(SessionStore):
+    """
+    プロセス内の辞書に保持する（セッションの辞書をそのまま持つため put は参照の登録のみ）
+    辞書は最終アクセス順に並べ、idle_ttl 秒アクセスのないセッションと
+    max_sessions を超えた分の最も古いセッションを追い出す（0 は無制限）。
+    """
+
+    def __init__(self, idle_ttl: float = 0, max_sessions: int = 0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.idle_ttl = idle_ttl
+        self.max_sessions = max_sessions
+        self.clock = clock
+        self.sessions: "OrderedDict[str, Dict]" = OrderedDict()  # 最終アクセスの古い順
+        self._accessed: Dict[str, float] = {}  # セッションID → 最終アクセス時刻
+        self._sizes: Dict[str, Optional[int]] = {}  # セッションID → メモリの概算（None は未計算）
+        self._evicted: List[str] = []
+        self._lock = threading.Lock()
+
+    def _evict(self, session_id: str):
+        del self.sessions[session_id]
+        del self._accessed[session_id]
+        del self._sizes[session_id]
+        self._evicted.append(session_id)
+
+    def _is_expired(self, session_id: str, now: float) -> bool:
+        return bool(self.idle_ttl) and now - self._accessed[session_id] > self.idle_ttl
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        now = self.clock()
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return None
+            if self._is_expired(session_id, now):
+                self._evict(session_id)
+                return None
+            self.sessions.move_to_end(session_id)
+            self._accessed[session_id] = now
+            return session
+
+    def put(self, session_id: str, session: Dict):
+        now = self.clock()
+        with self._lock:
+            self.sessions[session_id] = session
+            self.sessions.move_to_end(session_id)
+            self._accessed[session_id] = now
+            self._sizes[session_id] = None  # 回答で増えるため次の集計時に計算し直す
+            while self.max_sessions and len(self.sessions) > self.max_sessions:
+                self._evict(next(iter(self.sessions)))
+
+    def delete(self, session_id: str):
+        with self._lock:
+            if session_id in self.sessions:
+                del self.sessions[session_id]
+                del self._accessed[session_id]
+                del self._sizes[session_id]
+
+    def sweep(self) -> int:
+        """最終アクセスの古い順に、期限切れのセッションを追い出す"""
+        if not self.idle_ttl:
+            return 0
+        now = self.clock()
+        count = 0
+        with self._lock:
+            while self.sessions:
+                session_id = next(iter(self.sessions))
+                if not self._is_expired(session_id, now):
+                    break
+                self._evict(session_id)
+                count += 1
+        return count
+
+    def drain_evicted(self) -> List[str]:
+        with self._lock:
+            evicted, self._evicted = self._evicted, []
+        return evicted
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            pending = [(session_id, self.sessions[session_id])
+                       for session_id, size in self._sizes.items() if size is None]
+        for session_id, session in pending:
+            size = estimate_session_bytes(session)
+            with self._lock:
+                if session_id in self._sizes:
+                    self._sizes[session_id] = size
+        with self._lock:
+            return {
+                "sessions": len(self.sessions),
+                "bytes": sum(size or 0 for size in self._sizes.values())
+            }
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+
+class SharedSessionStore(SessionStore):
+    """
+    複数のワーカーで共有するストアの基底クラス
+    セッションは SessionCodec でバイト列にし、書き込みのたびに増える版数とともに保存する。
+    派生クラスは _read / _read_version / _write / _remove を実装する。
+    """
+
+    def __init__(self, codec: SessionCodec, idle_ttl: float = 0):
+        self.codec = codec
+        self.idle_ttl = idle_ttl  # 最終アクセスからこの秒数で期限切れ（0 は無制限）
+
+    def _read(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        raise NotImplementedError
+
+    def _read_version(self, session_id: str) -> Optional[int]:
+        raise NotImplementedError
+
+    def _write(self, session_id: str, data: bytes) -> int:
+        """保存して新しい版数を返す"""
+        raise NotImplementedError
+
+    def _remove(self, session_id: str):
+        raise NotImplementedError
+
+    def version(self, session_id: str) -> Optional[int]:
+        """保存されているセッションの版数（なければ None）"""
+        return self._read_version(session_id)
+
+    def load(self, session_id: str) -> Optional[Tuple[int, Dict]]:
+        """Returns: (版数, セッションの辞書) またはセッションがなければ None"""
+        stored = self._read(session_id)
+        if stored is None:
+            return None
+        version, data = stored
+        _, session = self.codec.unpack(data)
+        return version, session
+
+    def save(self, session_id: str, session: Dict) -> int:
+        """保存して新しい版数を返す"""
+        return self._write(session_id, self.codec.pack(session_id, session))
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        loaded = self.load(session_id)
+        return None if loaded is None else loaded[1]
+
+    def put(self, session_id: str, session: Dict):
+        self.save(session_id, session)
+
+    def delete(self, session_id: str):
+        self._remove(session_id)
+
+
+class SqliteSessionStore(SharedSessionStore):
+    """
+    SQLiteファイルに保存する（WALモード、同じホストの複数ワーカー・プロセスで共有できる）
+    読み書きのたびに最終アクセス時刻（last_access、複数プロセスで比べるため壁時計）を更新し、
+    idle_ttl を過ぎたセッションは読まない。行の削除は sweep で行う。
+    """
+
+    def __init__(self, path: str, codec: SessionCodec, idle_ttl: float = 0,
+                 clock: Callable[[], float] = time.time):
+        super().__init__(codec, idle_ttl)
+        self.path = path
+        self.clock = clock
+        self._evicted: List[str] = []
+        self._lock = threading.Lock()  # 接続はワーカー内のスレッドで共有する
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_store ("
+            "session_id TEXT PRIMARY KEY, version INTEGER NOT NULL, data BLOB NOT NULL, "
+            "last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS session_store_last_access ON session_store (last_access)")
+
+    def _cutoff(self, now: float) -> float:
+        """これより前に最終アクセスしたセッションは期限切れ"""
+        return now - self.idle_ttl if self.idle_ttl else float("-inf")
+
+    def _touch(self, session_id: str, columns: str) -> Optional[Tuple]:
+        """期限内のセッションの最終アクセス時刻を更新し、columns を返す（期限切れ・なければ None）"""
+        now = self.clock()
+        with self._lock:
+            return self._conn.execute(
+                f"UPDATE session_store SET last_access = ? WHERE session_id = ? AND last_access >= ? "
+                f"RETURNING {columns}",
+                (now, session_id, self._cutoff(now))
+            ).fetchone()
+
+    def _read(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        row = self._touch(session_id, "version, data")
+        return None if row is None else (row[0], bytes(row[1]))
+
+    def _read_version(self, session_id: str) -> Optional[int]:
+        row = self._touch(session_id, "version")
+        return None if row is None else row[0]
+
+    def _write(self, session_id: str, data: bytes) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "INSERT INTO session_store (session_id, version, data, last_access) VALUES (?, 1, ?, ?) "
+                "ON CONFLICT(session_id) DO UPDATE SET version = version + 1, data = excluded.data, "
+                "last_access = excluded.last_access "
+                "RETURNING version",
+                (session_id, data, self.clock())
+            ).fetchone()
+        return row[0]
+
+    def _remove(self, session_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM session_store WHERE session_id = ?", (session_id,))
+
+    def sweep(self) -> int:
+        """
+        期限切れの行を削除する
+        複数のワーカーが同時に掃除しても、削除した行は削除したワーカーだけが drain_evicted() で返す
+        """
+        if not self.idle_ttl:
+            return 0
+        with self._lock:
+            rows = self._conn.execute(
+                "DELETE FROM session_store WHERE last_access < ? RETURNING session_id",
+                (self._cutoff(self.clock()),)
+            ).fetchall()
+            self._evicted.extend(row[0] for row in rows)
+        return len(rows)
+
+    def drain_evicted(self) -> List[str]:
+        with self._lock:
+            evicted, self._evicted = self._evicted, []
+        return evicted
+
+
+class KeyValueSessionStore(SharedSessionStore):
+    """
+    キーバリューストアに保存する
+    client は redis.Redis と同じ get / set / incr / delete / getex / expire を持つオブジェクト
+    （テストや単一プロセスでの確認には LocalKeyValueClient を使える）。
+    セッションは "<prefix><ID>"、版数は "<prefix><ID>:version" に保存する。
+    idle_ttl を指定すると両方のキーに有効期限を付け、読み書きのたびに延ばす。
+    """
+
+    def __init__(self, client, codec: SessionCodec, prefix: str = "visa-session:", idle_ttl: float = 0):
+        super().__init__(codec, idle_ttl)
+        self.client = client
+        self.prefix = prefix
+        self._ttl = max(1, int(idle_ttl)) if idle_ttl else None  # EX は整数の秒数
+
+    def _get_version(self, session_id: str) -> Optional[bytes]:
+        """版数を読む（有効期限があれば、版数とセッションの両方の期限を延ばす）"""
+        data_key, version_key = self._keys(session_id)
+        if self._ttl is None:
+            return self.client.get(version_key)
+        version = self.client.getex(version_key, ex=self._ttl)
+        if version is not None:
+            self.client.expire(data_key, self._ttl)
+        return version
+
+    def _keys(self, session_id: str) -> Tuple[str, str]:
+        key = self.prefix + session_id
+        return key, key + ":version"
+
+    def _read(self, session_id: str) -> Optional[Tuple[int, bytes]]:
+        data_key, _ = self._keys(session_id)
+        # 版数を先に読む（間に更新されても、読んだ版数より新しいデータを返すだけで古くはならない）
+        version = self._get_version(session_id)
+        data = self.client.get(data_key)
+        if version is None or data is None:
+            return None
+        return int(version), data
+
+    def _read_version(self, session_id: str) -> Optional[int]:
+        version = self._get_version(session_id)
+        return None if version is None else int(version)
+
+    def _write(self, session_id: str, data: bytes) -> int:
+        data_key, version_key = self._keys(session_id)
+        # データを書いてから版数を進める（新しい版数を読んだワーカーは必ず新しいデータを読む）
+        self.client.set(data_key, data, ex=self._ttl)
+        version = int(self.client.incr(version_key))
+        if self._ttl is not None:
+            self.client.expire(version_key, self._ttl)
+        return version
+
+    def _remove(self, session_id: str):
+        self.client.delete(*self._keys(session_id))
+
+
+class LocalKeyValueClient:
+    """プロセス内で redis.Redis の get / set / incr / delete / getex / expire を代替する（テスト用）"""
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.data: Dict[str, bytes] = {}
+        self.expires: Dict[str, float] = {}  # キー → 有効期限の時刻
+        self.clock = clock
+        self._lock = threading.Lock()
+
+    def _expire_if_due(self, key: str):
+        deadline = self.expires.get(key)
+        if deadline is not None and self.clock() >= deadline:
+            self.data.pop(key, None)
+            del self.expires[key]
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            self._expire_if_due(key)
+            return self.data.get(key)
+
+    def set(self, key: str, value, ex: Optional[int] = None):
+        with self._lock:
+            self.data[key] = value if isinstance(value, bytes) else str(value).encode("utf-8")
+            if ex is None:
+                self.expires.pop(key, None)
+            else:
+                self.expires[key] = self.clock() + ex
+        return True
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            self._expire_if_due(key)
+            value = int(self.data.get(key, b"0")) + 1
+            self.data[key] = str(value).encode("utf-8")
+        return value
+
+    def delete(self, *keys: str) -> int:
+        with self._lock:
+            for key in keys:
+                self._expire_if_due(key)
+                self.expires.pop(key, None)
+            return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def getex(self, key: str, ex: Optional[int] = None) -> Optional[bytes]:
+        with self._lock:
+            self._expire_if_due(key)
+            value = self.data.get(key)
+            if value is not None and ex is not None:
+                self.expires[key] = self.clock() + ex
+            return value
+
+    def expire(self, key: str, seconds: int) -> bool:
+        with self._lock:
+            self._expire_if_due(key)
+            if key not in self.data:
+                return False
+            self.expires[key] = self.clock() + seconds
+            return True
+
+
+class CachedSessionStore(SessionStore):
+    """
+    共有ストアの前に置くワーカーごとの LRU キャッシュ（書き込みは共有ストアへ書き通す）
+    キャッシュしたセッションは共有ストアの版数が変わっていなければそのまま使う。
+    get はキャッシュしている辞書そのものを返し、呼び出し側はそれを書き換えてから put する。
+    put の書き込みに失敗すると、書き換え済みの辞書が古い版数のままキャッシュに残るため、
+    その場合はキャッシュから外して次の get で共有ストアから読み直す。
+    """
+
+    def __init__(self, backend: SharedSessionStore, max_sessions: int = DEFAULT_CACHE_SIZE):
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self._cache: "OrderedDict[str, Tuple[int, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _remember(self, session_id: str, version: int, session: Dict):
+        with self._lock:
+            self._cache[session_id] = (version, session)
+            self._cache.move_to_end(session_id)
+            while len(self._cache) > self.max_sessions:
+                self._cache.popitem(last=False)
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        version = self.backend.version(session_id)
+        with self._lock:
+            cached = self._cache.get(session_id)
+            if version is None:
+                self._cache.pop(session_id, None)
+                return None
+            if cached is not None and cached[0] == version:
+                self._cache.move_to_end(session_id)
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+
+        loaded = self.backend.load(session_id)
+        if loaded is None:
+            return None
+        self._remember(session_id, *loaded)
+        return loaded[1]
+
+    def put(self, session_id: str, session: Dict):
+        try:
+            version = self.backend.save(session_id, session)
+        except Exception:
+            with self._lock:
+                self._cache.pop(session_id, None)
+            raise
+        self._remember(session_id, version, session)
+
+    def delete(self, session_id: str):
+        with self._lock:
+            self._cache.pop(session_id, None)
+        self.backend.delete(session_id)
+
+    def sweep(self) -> int:
+        """共有ストアの期限切れを追い出す（キャッシュ側は次の get の版数の照合で外れる）"""
+        return self.backend.sweep()
+
+    def drain_evicted(self) -> List[str]:
+        evicted = self.backend.drain_evicted()
+        if evicted:
+            with self._lock:
+                for session_id in evicted:
+                    self._cache.pop(session_id, None)
+        return evicted
+
+    def stats(self) -> Dict[str, int]:
+        """キャッシュしているセッション（共有ストア側のセッションは含めない）"""
+        with self._lock:
+            cached = [session for _, session in self._cache.values()]
+        return {"sessions": len(cached), "bytes": sum(estimate_session_bytes(session) for session in cached)}
+
+
+def create_session_store(kind: str, codec: SessionCodec, location: str = "",
+                         cache_size: int = DEFAULT_CACHE_SIZE, idle_ttl: float = DEFAULT_IDLE_TTL,
+                         max_sessions: int = DEFAULT_MAX_SESSIONS) -> SessionStore:
+    """
+    設定からセッションストアを作る
+    location は sqlite ではファイルのパス、redis では接続URL
+    idle_ttl は全てのストア、max_sessions は memory のみ（sqlite・redis のキャッシュは cache_size で制限される）
+    """
+    if kind == SESSION_STORE_MEMORY:
+        return MemorySessionStore(idle_ttl=idle_ttl, max_sessions=max_sessions)
+    if kind == SESSION_STORE_SQLITE:
+        backend = SqliteSessionStore(location or "./visa_sessions.db", codec, idle_ttl=idle_ttl)
+    elif kind == SESSION_STORE_REDIS:
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("SESSION_STORE=redis には redis パッケージが必要です")
+        backend = KeyValueSessionStore(redis.Redis.from_url(location or "redis://localhost:6379/0"), codec,
+                                       idle_ttl=idle_ttl)
+    else:
+        raise ValueError(f"不正なセッションストアです: {kind}")
+    return CachedSessionStore(backend, max_sessions=cache_size)
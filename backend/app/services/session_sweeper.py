@@ -0,0 +1,93 @@
+"""
+セッションの掃除 - セッションストアから追い出した診断セッションをDB上で abandoned にする
+
+一定間隔で期限切れのセッションを追い出し（SessionStore.sweep）、
+追い出したセッション（期限切れ・上限超過）のうち進行中のものをまとめて abandoned に更新する。
+リクエスト処理とは別のデーモンスレッドで動かす。
+"""
+
+import threading
+from typing import Callable, List, Optional
+
+from sqlalchemy.orm import Session
+
+from app.models import models
+from app.services.session_store import SessionStore
+
+DEFAULT_SWEEP_INTERVAL = 60  # 秒
+UPDATE_BATCH_SIZE = 500  # 1回の UPDATE で更新するセッション数（IN句の大きさ）
+
+
+def mark_sessions_abandoned(db: Session, session_ids: List[str]) -> int:
+    """進行中のセッションを abandoned にする Returns: 更新した行数"""
+    updated = 0
+    for start in range(0, len(session_ids), UPDATE_BATCH_SIZE):
+        chunk = session_ids[start:start + UPDATE_BATCH_SIZE]
+        updated += db.query(models.ConsultationSession).filter(
+            models.ConsultationSession.session_id.in_(chunk),
+            models.ConsultationSession.status == "in_progress"
+        ).update({"status": "abandoned"}, synchronize_session=False)
+    db.commit()
+    return updated
+
+
+class SessionSweeper:
+    """セッションストアの掃除を一定間隔で行うバックグラウンドスレッド"""
+
+    def __init__(self, store: SessionStore, session_factory: Callable[[], Session],
+                 interval: float = DEFAULT_SWEEP_INTERVAL):
+        self.store = store
+        self.session_factory = session_factory
+        self.interval = interval
+        self.evicted_total = 0  # 追い出したセッション数の累計
+        self.abandoned_total = 0  # DB上で abandoned にしたセッション数の累計
+        self._pending: List[str] = []  # DBの更新に失敗し、次回に持ち越すセッションID
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self) -> int:
+        """
+        1回分の掃除を行う
+        Returns: abandoned にしたセッション数
+        """
+        self.store.sweep()
+        evicted = self.store.drain_evicted()
+        self.evicted_total += len(evicted)
+        session_ids = self._pending + evicted
+        if not session_ids:
+            return 0
+
+        db = self.session_factory()
+        try:
+            updated = mark_sessions_abandoned(db, session_ids)
+        except Exception:
+            db.rollback()
+            self._pending = session_ids
+            raise
+        finally:
+            db.close()
+        self._pending = []
+        self.abandoned_total += updated
+        return updated
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception:
+                # DBに接続できない間も掃除を止めない（追い出したIDは次回に持ち越す）
+                continue
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="session-sweeper", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
@@ -0,0 +1,358 @@
+"""
+セッショントークン - 診断セッションの状態を署名付きの文字列にしてクライアントに持たせる
+
+ステートレスモードではサーバーはセッションを保持せず、作業記憶・ゴール・回答履歴を
+リクエストとレスポンスでやり取りするトークンに詰める。どのワーカー・インスタンスでも
+トークンからセッションを復元できるため、複数ワーカー・複数インスタンスで運用できる。
+
+- 事実とルールは FactTable の内部ID・ルールベース上の位置で表し、整数は可変長で詰める
+- 本体は deflate で圧縮し、HMAC-SHA256（先頭16バイト）で改ざんを検出する
+- 事実IDはルールベースに依存するため、RuleBase.fingerprint の先頭4バイトで照合する
+- 発行時刻と有効期限（UNIX時刻の秒）も署名に含め、期限切れのトークンは受け付けない
+  （応答のたびに発行し直すため、期限は最後のステップから数える）
+
+トークンの構成（URLセーフBase64、パディングなし）:
+    形式バージョン(1) | fingerprint(4) | 圧縮した本体 | 発行時刻(4) | 有効期限(4) | 署名(16)
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import time
+import uuid
+import zlib
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from app.services.inference_engine import AnswerType, BitsetWorkingMemory, RuleBase, RuleStatus
+from app.services.question_selector import QUESTION_SELECTORS
+
+# セッションの保持方式
+SESSION_MODE_MEMORY = "memory"  # サーバーのメモリに保持（既定）
+SESSION_MODE_TOKEN = "token"  # 署名付きトークンでクライアントに持たせる（サーバーは保持しない）
+SESSION_MODES = (SESSION_MODE_MEMORY, SESSION_MODE_TOKEN)
+
+FORMAT_VERSION = 1
+FINGERPRINT_SIZE = 4
+TIMESTAMP_SIZE = 4
+SIGNATURE_SIZE = 16
+DEFAULT_TOKEN_TTL = 7200  # 秒
+CLOCK_SKEW = 60  # 発行時刻が未来でも受け付ける秒数（サーバー間の時計のずれ）
+
+_ANSWER_TYPES = list(AnswerType)
+_RULE_STATUSES = list(RuleStatus)
+
+# 回答履歴の各回答が一括回答のどこにあたるか
+_SINGLE_ANSWER = 0  # 1件ずつの回答
+_BATCH_START = 1  # 一括回答の先頭
+_BATCH_CONTINUE = 2  # 直前と同じ一括回答
+
+
+class InvalidSessionToken(ValueError):
+    """署名・形式が不正なトークン"""
+
+
+class SessionTokenMismatch(InvalidSessionToken):
+    """ルールベースが発行時から変更されたトークン（事実IDの対応が変わっている）"""
+
+
+class SessionTokenExpired(InvalidSessionToken):
+    """有効期限が切れたトークン"""
+
+
+def _write_uint(out: bytearray, value: int):
+    """非負整数を可変長（7ビットずつ、LEB128）で書き込む"""
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+class _Reader:
+    """_write_uint 等で書き込んだ本体を先頭から読む"""
+
+    __slots__ = ("data", "pos")
+
+    def __init__(self, data: bytes):
+        self.data = data
+        self.pos = 0
+
+    def uint(self) -> int:
+        value = shift = 0
+        while True:
+            if self.pos >= len(self.data):
+                raise InvalidSessionToken("トークンの本体が途中で終わっています")
+            byte = self.data[self.pos]
+            self.pos += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value
+            shift += 7
+
+    def bytes(self, size: int) -> bytes:
+        if self.pos + size > len(self.data):
+            raise InvalidSessionToken("トークンの本体が途中で終わっています")
+        chunk = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return chunk
+
+
+class SessionCodec:
+    """
+    セッションの辞書（main.py のセッションと同じ形）とバイト列を相互に変換する（署名なし）
+    question_table は含めない（復元側でゴールから引き直す）。
+    セッションストア（app.services.session_store）の保存形式としても使う。
+    """
+
+    def __init__(self, rule_base: RuleBase):
+        self.rule_base = rule_base
+        self.fact_table = rule_base.fact_table
+        self.header = bytes([FORMAT_VERSION]) + bytes.fromhex(rule_base.fingerprint)[:FINGERPRINT_SIZE]
+        self.rule_ids = list(rule_base.rules)
+        self.rule_indexes = {rule_id: i for i, rule_id in enumerate(self.rule_ids)}
+
+    # ===== 事実・ルールの符号化 =====
+    def _write_fact(self, out: bytearray, fact: str):
+        """事実表の事実は ID+1、事実表にない事実は 0 と名前（UTF-8）"""
+        fact_id = self.fact_table.ids.get(fact)
+        if fact_id is not None:
+            _write_uint(out, fact_id + 1)
+            return
+        name = fact.encode("utf-8")
+        _write_uint(out, 0)
+        _write_uint(out, len(name))
+        out += name
+
+    def _read_fact(self, reader: _Reader) -> str:
+        code = reader.uint()
+        if code == 0:
+            return reader.bytes(reader.uint()).decode("utf-8")
+        if code > len(self.fact_table):
+            raise InvalidSessionToken("事実IDが範囲外です")
+        return self.fact_table.facts[code - 1]
+
+    def _rule_mask(self, rule_ids: Iterable[int]) -> int:
+        mask = 0
+        for rule_id in rule_ids:
+            mask |= 1 << self.rule_indexes[rule_id]
+        return mask
+
+    def _rules_of(self, mask: int) -> List[int]:
+        if mask >> len(self.rule_ids):
+            raise InvalidSessionToken("ルールの位置が範囲外です")
+        return [rule_id for i, rule_id in enumerate(self.rule_ids) if mask >> i & 1]
+
+    # ===== 作業記憶 =====
+    def _write_working_memory(self, out: bytearray, wm: BitsetWorkingMemory):
+        for mask in (wm.known_findings, wm.true_findings, wm.known_hypotheses,
+                     wm.true_hypotheses, wm.skipped_mask, wm.asked_mask):
+            _write_uint(out, mask)
+        _write_uint(out, self._rule_mask(wm.conflict_set))
+        # ルール評価状態は状態ごとにルールのビットマスクで持つ
+        for status in _RULE_STATUSES:
+            _write_uint(out, self._rule_mask(
+                rule_id for rule_id, rule_status in wm.evaluated_rules.items() if rule_status is status
+            ))
+        # 事実表にない事実（通常は空）
+        extra = b""
+        if wm.extra:
+            extra = json.dumps(
+                {name: values if isinstance(values, dict) else sorted(values)
+                 for name, values in wm.extra.items() if values},
+                ensure_ascii=False, separators=(",", ":")
+            ).encode("utf-8")
+        _write_uint(out, len(extra))
+        out += extra
+
+    def _read_working_memory(self, reader: _Reader) -> BitsetWorkingMemory:
+        wm = BitsetWorkingMemory(self.fact_table)
+        (wm.known_findings, wm.true_findings, wm.known_hypotheses,
+         wm.true_hypotheses, wm.skipped_mask, wm.asked_mask) = (reader.uint() for _ in range(6))
+        if (wm.known_mask | wm.skipped_mask | wm.asked_mask) >> len(self.fact_table):
+            raise InvalidSessionToken("事実IDが範囲外です")
+        wm.conflict_set = set(self._rules_of(reader.uint()))
+        evaluated_rules = {}
+        for status in _RULE_STATUSES:
+            for rule_id in self._rules_of(reader.uint()):
+                evaluated_rules[rule_id] = status
+        # ルールベース上の順に並べる
+        wm.evaluated_rules = {rule_id: evaluated_rules[rule_id]
+                              for rule_id in self.rule_ids if rule_id in evaluated_rules}
+        extra_size = reader.uint()
+        if extra_size:
+            extra = json.loads(reader.bytes(extra_size).decode("utf-8"))
+            wm.extra = {name: values if isinstance(values, dict) else set(values)
+                        for name, values in extra.items()}
+        return wm
+
+    def _write_fact_order(self, out: bytearray, wm: BitsetWorkingMemory):
+        """findings / hypotheses の挿入順（マスクには順序がないため、事実の並びとして別に持つ）"""
+        for name in ("findings", "hypotheses"):
+            facts = list(getattr(wm, name))
+            _write_uint(out, len(facts))
+            for fact in facts:
+                self._write_fact(out, fact)
+
+    def _read_fact_order(self, reader: _Reader, wm: BitsetWorkingMemory):
+        for name in ("findings", "hypotheses"):
+            view = getattr(wm, name)
+            facts = [self._read_fact(reader) for _ in range(reader.uint())]
+            if len(facts) != len(view) or not all(fact in view for fact in facts):
+                raise InvalidSessionToken("事実の並びが作業記憶と一致しません")
+            wm.order[name] = dict.fromkeys(facts)
+
+    # ===== 回答履歴 =====
+    def _write_answer_history(self, out: bytearray, answer_history: List[Dict]):
+        _write_uint(out, len(answer_history))
+        previous_batch = None
+        for entry in answer_history:
+            batch_id = entry.get("batch_id")
+            if batch_id is None:
+                position = _SINGLE_ANSWER
+            elif batch_id == previous_batch:
+                position = _BATCH_CONTINUE
+            else:
+                position = _BATCH_START
+            previous_batch = batch_id
+            answer_code = _ANSWER_TYPES.index(AnswerType(entry["answer"].lower()))
+            _write_uint(out, answer_code * 3 + position)
+            self._write_fact(out, entry["fact"])
+
+    def _read_answer_history(self, reader: _Reader) -> List[Dict]:
+        answer_history = []
+        batch_id = None
+        for i in range(reader.uint()):
+            code = reader.uint()
+            answer_code, position = divmod(code, 3)
+            if answer_code >= len(_ANSWER_TYPES):
+                raise InvalidSessionToken("回答の種類が不正です")
+            if position == _SINGLE_ANSWER:
+                batch_id = None
+            elif position == _BATCH_START or batch_id is None:
+                batch_id = i  # 一括回答の先頭の位置
+            answer_history.append({
+                "fact": self._read_fact(reader),
+                "answer": _ANSWER_TYPES[answer_code].value,
+                "batch_id": batch_id
+            })
+        return answer_history
+
+    # ===== セッション =====
+    def pack(self, session_id: str, session: Dict) -> bytes:
+        """セッションをバイト列にする（作業記憶は BitsetWorkingMemory であること）"""
+        body = bytearray(uuid.UUID(session_id).bytes)
+        _write_uint(body, len(session["goals"]))
+        for goal in session["goals"]:
+            self._write_fact(body, goal)
+        _write_uint(body, QUESTION_SELECTORS.index(session["question_selector"]))
+        node = session.get("question_node")
+        _write_uint(body, 0 if node is None else node + 1)
+        self._write_working_memory(body, session["wm"])
+        self._write_answer_history(body, session["answer_history"])
+        _write_uint(body, session.get("state_version", 0))
+        self._write_fact_order(body, session["wm"])
+
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15)
+        return self.header + compressor.compress(bytes(body)) + compressor.flush()
+
+    def unpack(self, data: bytes) -> Tuple[str, Dict]:
+        """
+        バイト列からセッションを復元する
+        Returns: (セッションID, セッションの辞書（question_table を除く）)
+        Raises: InvalidSessionToken（形式が不正）/ SessionTokenMismatch（ルールベースが変更された）
+        """
+        if len(data) < len(self.header):
+            raise InvalidSessionToken("トークンの形式が不正です")
+        if data[0] != FORMAT_VERSION:
+            raise InvalidSessionToken(f"未対応のトークンの形式です: {data[0]}")
+        if data[1:len(self.header)] != self.header[1:]:
+            raise SessionTokenMismatch("ルールが更新されたため、このセッションは継続できません")
+
+        try:
+            body = zlib.decompress(data[len(self.header):], -15)
+        except zlib.error:
+            raise InvalidSessionToken("トークンの本体を展開できません")
+        reader = _Reader(body)
+        session_id = str(uuid.UUID(bytes=reader.bytes(16)))
+        goals = [self._read_fact(reader) for _ in range(reader.uint())]
+        selector_index = reader.uint()
+        if selector_index >= len(QUESTION_SELECTORS):
+            raise InvalidSessionToken("質問選択方式が不正です")
+        node = reader.uint()
+        session = {
+            "goals": goals,
+            "question_selector": QUESTION_SELECTORS[selector_index],
+            "question_node": None if node == 0 else node - 1,
+            "wm": self._read_working_memory(reader),
+            "answer_history": self._read_answer_history(reader)
+        }
+        session["state_version"] = reader.uint()
+        self._read_fact_order(reader, session["wm"])
+        return session_id, session
+
+
+class SignedTokens:
+    """
+    pack したバイト列に発行時刻・有効期限と署名を付けてトークン（URLセーフBase64）にし、
+    署名と期限を確かめて unpack する（pack / unpack を持つクラスと組み合わせる）
+    """
+
+    secret: bytes
+    ttl: int
+    clock: Callable[[], float]
+
+    def _init_signing(self, secret: bytes, ttl: int, clock: Callable[[], float]):
+        if not secret:
+            raise ValueError("セッショントークンの署名鍵が空です")
+        if ttl <= 0:
+            raise ValueError("セッショントークンの有効期限は1秒以上にしてください")
+        self.secret = secret
+        self.ttl = ttl
+        self.clock = clock
+
+    def _sign(self, data: bytes) -> bytes:
+        return hmac.new(self.secret, data, hashlib.sha256).digest()[:SIGNATURE_SIZE]
+
+    def encode(self, session_id: str, session: Dict) -> str:
+        """セッションをトークンにする（発行時刻から ttl 秒有効）"""
+        issued_at = int(self.clock())
+        data = self.pack(session_id, session) + issued_at.to_bytes(TIMESTAMP_SIZE, "big") \
+            + (issued_at + self.ttl).to_bytes(TIMESTAMP_SIZE, "big")
+        return base64.urlsafe_b64encode(data + self._sign(data)).rstrip(b"=").decode("ascii")
+
+    def decode(self, token: str) -> Tuple[str, Dict]:
+        """
+        トークンからセッションを復元する
+        有効期限は、トークンに書かれた期限と、発行時刻から現在の ttl 秒の早い方
+        （ttl を短くすると発行済みのトークンにも効く）
+        Raises: InvalidSessionToken（署名・形式が不正）/ SessionTokenExpired（期限切れ）/
+                SessionTokenMismatch（ルールベースが変更された）
+        """
+        try:
+            raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        except (ValueError, TypeError):
+            raise InvalidSessionToken("トークンの形式が不正です")
+        if len(raw) < 2 * TIMESTAMP_SIZE + SIGNATURE_SIZE:
+            raise InvalidSessionToken("トークンの形式が不正です")
+        signed, signature = raw[:-SIGNATURE_SIZE], raw[-SIGNATURE_SIZE:]
+        if not hmac.compare_digest(signature, self._sign(signed)):
+            raise InvalidSessionToken("トークンの署名が一致しません")
+
+        data, times = signed[:-2 * TIMESTAMP_SIZE], signed[-2 * TIMESTAMP_SIZE:]
+        issued_at = int.from_bytes(times[:TIMESTAMP_SIZE], "big")
+        expires_at = int.from_bytes(times[TIMESTAMP_SIZE:], "big")
+        now = self.clock()
+        if issued_at > now + CLOCK_SKEW:
+            raise InvalidSessionToken("トークンの発行時刻が不正です")
+        if now > min(expires_at, issued_at + self.ttl):
+            raise SessionTokenExpired("セッショントークンの有効期限が切れています")
+        return self.unpack(data)
+
+
+class SessionTokenCodec(SignedTokens, SessionCodec):
+    """セッションと署名付きトークン（URLセーフBase64）を相互に変換する"""
+
+    def __init__(self, rule_base: RuleBase, secret: bytes, ttl: int = DEFAULT_TOKEN_TTL,
+                 clock: Callable[[], float] = time.time):
+        super().__init__(rule_base)
+        self._init_signing(secret, ttl, clock)
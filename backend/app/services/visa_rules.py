@@ -527,3 +527,13 @@ VISA_GOALS = [
     "J-1ビザの申請ができます",
     "B-1 in lieu of H3ビザの申請ができます"
 ]
+
+# ビザタイプ → 診断ゴール（診断開始時の visa_types の選択肢）
+VISA_TYPE_GOALS = {
+    "E": ["Eビザでの申請ができます"],
+    "L": ["Blanket Lビザでの申請ができます", "Lビザ（Individual）での申請ができます"],
+    "B": ["Bビザの申請ができます", "契約書に基づくBビザの申請ができます",
+          "B-1 in lieu of H-1Bビザの申請ができます", "B-1 in lieu of H3ビザの申請ができます"],
+    "H-1B": ["H-1Bビザでの申請ができます"],
+    "J-1": ["J-1ビザの申請ができます"]
+}
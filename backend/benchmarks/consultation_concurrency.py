@@ -0,0 +1,157 @@
+"""
+診断APIの同時実行ベンチマーク - 同期DB（スレッドプール）と非同期DB（DATABASE_ASYNC=true）の比較
+
+DATABASE_ASYNC を切り替えて uvicorn（1ワーカー）を起動し、同時に診断する利用者を模擬して
+開始から診断完了まで（ランダムに はい/いいえ/わからない で回答）を繰り返す。
+各方式のスループット（リクエスト/秒）と応答時間（p50/p95/p99）を表示する。
+
+使い方（backend ディレクトリで実行、httpx が必要）:
+    python -m benchmarks.consultation_concurrency --users 500 --duration 30
+    DATABASE_URL=postgresql://... python -m benchmarks.consultation_concurrency --modes async
+
+DATABASE_URL を指定しない場合は一時ディレクトリの SQLite ファイルを使う。
+"""
+
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ANSWERS = ["yes", "no", "unknown"]
+ANSWER_WEIGHTS = [0.45, 0.45, 0.1]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values: List[float], ratio: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * ratio))]
+
+
+async def _wait_ready(client: httpx.AsyncClient, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get("/health")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("サーバーが起動しませんでした")
+
+
+async def _simulated_user(client: httpx.AsyncClient, rng: random.Random, deadline: float,
+                          latencies: List[float], stats: Dict[str, int]):
+    """診断の開始から完了までを締め切りまで繰り返す利用者"""
+
+    async def post(path: str, payload: Dict) -> Dict:
+        started = time.perf_counter()
+        response = await client.post(path, json=payload)
+        latencies.append(time.perf_counter() - started)
+        if response.status_code != 200:
+            stats["errors"] += 1
+            raise RuntimeError(f"{path}: {response.status_code}")
+        return response.json()
+
+    while time.monotonic() < deadline:
+        try:
+            data = await post("/api/consultation/start", {"visa_types": ["E", "B", "L"]})
+            session_id, question = data["session_id"], data["next_question"]
+            while question is not None and time.monotonic() < deadline:
+                data = await post("/api/consultation/answer", {
+                    "session_id": session_id,
+                    "fact": question,
+                    "answer": rng.choices(ANSWERS, ANSWER_WEIGHTS)[0]
+                })
+                question = data["next_question"]
+            if question is None:
+                stats["completed"] += 1
+        except (RuntimeError, httpx.HTTPError):
+            await asyncio.sleep(0.1)
+
+
+async def _drive(port: int, users: int, duration: float, seed: int) -> Dict:
+    limits = httpx.Limits(max_connections=users, max_keepalive_connections=users)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+        await _wait_ready(client)
+        latencies: List[float] = []
+        stats = {"completed": 0, "errors": 0}
+        started = time.monotonic()
+        deadline = started + duration
+        await asyncio.gather(*(
+            _simulated_user(client, random.Random(seed + i), deadline, latencies, stats)
+            for i in range(users)
+        ))
+        elapsed = time.monotonic() - started
+    return {
+        "requests": len(latencies),
+        "throughput": len(latencies) / elapsed,
+        "p50": _percentile(latencies, 0.50),
+        "p95": _percentile(latencies, 0.95),
+        "p99": _percentile(latencies, 0.99),
+        **stats
+    }
+
+
+@contextlib.contextmanager
+def running_server(**env_overrides):
+    """uvicorn（1ワーカー）を起動し、(ポート番号, プロセス) を返す（環境変数は現在の環境に上書きする）"""
+    port = _free_port()
+    env = dict(os.environ, PYTHONPATH=BACKEND_DIR, **env_overrides)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1",
+         "--port", str(port), "--log-level", "warning", "--no-access-log"],
+        cwd=BACKEND_DIR, env=env
+    )
+    try:
+        yield port, server
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def run_mode(mode: str, args, database_url: str) -> Dict:
+    """DATABASE_ASYNC を切り替えてサーバーを起動し、負荷をかける"""
+    database_async = "true" if mode == "async" else "false"
+    with running_server(DATABASE_URL=database_url, DATABASE_ASYNC=database_async) as (port, _):
+        return asyncio.run(_drive(port, args.users, args.duration, args.seed))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="診断APIの同期DB・非同期DBのスループット比較")
+    parser.add_argument("--users", type=int, default=500, help="同時に診断する利用者数")
+    parser.add_argument("--duration", type=float, default=30, help="計測時間（秒）")
+    parser.add_argument("--modes", nargs="+", choices=["sync", "async"], default=["sync", "async"])
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"同時利用者: {args.users}  計測時間: {args.duration:.0f}秒")
+        print(f"{'方式':<6} {'リクエスト':>10} {'req/s':>9} {'p50(ms)':>9} {'p95(ms)':>9} "
+              f"{'p99(ms)':>9} {'完了':>7} {'エラー':>7}")
+        for mode in args.modes:
+            database_url = os.getenv("DATABASE_URL") or f"sqlite:///{os.path.join(workdir, mode + '.db')}"
+            result = run_mode(mode, args, database_url)
+            print(f"{mode:<6} {result['requests']:>10} {result['throughput']:>9.1f} "
+                  f"{result['p50'] * 1000:>9.1f} {result['p95'] * 1000:>9.1f} {result['p99'] * 1000:>9.1f} "
+                  f"{result['completed']:>7} {result['errors']:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""
+診断のトランスポート比較ベンチマーク - REST と WebSocket（/ws/consultation）の1ワーカーあたりのステップ数/秒
+
+同時に診断する利用者を模擬し、開始から診断完了まで回答を繰り返す（1回答 = 1ステップ）。
+各ステップでルール状態・作業記憶も受け取る前提で、次の方式を比べる:
+- rest-poll: 回答 + GET /rules + GET /working-memory（差分レスポンス以前のフロントエンドと同じ3往復）
+- rest: 回答のみ（include_state で差分を受け取る、1往復）
+- ws: WebSocket で回答を送り、差分を含むメッセージを受け取る（1フレームずつ）
+ステップ数/秒に加え、サーバープロセスの1ステップあたりのCPU時間も表示する（Linux のみ）。
+クライアントも同じマシンで動くため、CPUコアが少ない環境ではステップ数/秒にクライアントの負荷も含まれる。
+
+使い方（backend ディレクトリで実行、httpx と websockets が必要）:
+    python -m benchmarks.consultation_websocket --users 50 --duration 20
+    CONSULTATION_PERSISTENCE=write_behind python -m benchmarks.consultation_websocket
+
+DB保存の待ち時間を除いてトランスポートの差だけを見る場合は CONSULTATION_PERSISTENCE=write_behind を指定する。
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+import httpx
+import websockets
+
+from benchmarks.consultation_concurrency import (
+    ANSWER_WEIGHTS, ANSWERS, _percentile, _wait_ready, running_server
+)
+
+MODES = ("rest-poll", "rest", "ws")
+VISA_TYPES = ["E", "B", "L"]
+
+
+async def _rest_user(client: httpx.AsyncClient, poll: bool, rng: random.Random, deadline: float,
+                     latencies: List[float], stats: Dict[str, int]):
+    while time.monotonic() < deadline:
+        response = await client.post("/api/consultation/start", json={
+            "visa_types": VISA_TYPES, "include_state": not poll
+        })
+        if response.status_code != 200:
+            stats["errors"] += 1
+            continue
+        data = response.json()
+        session_id, question = data["session_id"], data["next_question"]
+        version = data["state"]["version"] if data.get("state") else None
+        while question is not None and time.monotonic() < deadline:
+            started = time.perf_counter()
+            response = await client.post("/api/consultation/answer", json={
+                "session_id": session_id, "fact": question, "answer": rng.choices(ANSWERS, ANSWER_WEIGHTS)[0],
+                "include_state": not poll, "state_version": version
+            })
+            if poll:
+                await asyncio.gather(
+                    client.get(f"/api/consultation/{session_id}/rules"),
+                    client.get(f"/api/consultation/{session_id}/working-memory")
+                )
+            latencies.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                stats["errors"] += 1
+                break
+            data = response.json()
+            question = data["next_question"]
+            version = data["state"]["version"] if data.get("state") else None
+            stats["steps"] += 1
+        if question is None:
+            stats["completed"] += 1
+
+
+async def _ws_user(url: str, rng: random.Random, deadline: float,
+                   latencies: List[float], stats: Dict[str, int]):
+    async with websockets.connect(url, max_size=None) as ws:
+        while time.monotonic() < deadline:
+            await ws.send(json.dumps({"type": "start", "visa_types": VISA_TYPES}))
+            message = json.loads(await ws.recv())
+            if message["type"] != "session":
+                stats["errors"] += 1
+                continue
+            question = message["next_question"]
+            while question is not None and time.monotonic() < deadline:
+                started = time.perf_counter()
+                await ws.send(json.dumps({
+                    "type": "answer", "fact": question, "answer": rng.choices(ANSWERS, ANSWER_WEIGHTS)[0]
+                }, ensure_ascii=False))
+                message = json.loads(await ws.recv())
+                latencies.append(time.perf_counter() - started)
+                if message["type"] != "step":
+                    stats["errors"] += 1
+                    break
+                question = message["next_question"]
+                stats["steps"] += 1
+            if question is None:
+                stats["completed"] += 1
+
+
+def _cpu_seconds(pid: int) -> Optional[float]:
+    """プロセスのCPU時間（user + system）"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def _drive(mode: str, port: int, pid: int, users: int, duration: float, seed: int) -> Dict:
+    latencies: List[float] = []
+    stats = {"steps": 0, "completed": 0, "errors": 0}
+    limits = httpx.Limits(max_connections=users * 2, max_keepalive_connections=users * 2)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60) as client:
+        await _wait_ready(client)
+        cpu_started = _cpu_seconds(pid)
+        started = time.monotonic()
+        deadline = started + duration
+        if mode == "ws":
+            url = f"ws://127.0.0.1:{port}/ws/consultation"
+            users_coroutines = (_ws_user(url, random.Random(seed + i), deadline, latencies, stats)
+                                for i in range(users))
+        else:
+            users_coroutines = (_rest_user(client, mode == "rest-poll", random.Random(seed + i), deadline,
+                                           latencies, stats)
+                                for i in range(users))
+        await asyncio.gather(*users_coroutines)
+        elapsed = time.monotonic() - started
+        cpu_used = _cpu_seconds(pid)
+    cpu_per_step = None
+    if cpu_started is not None and cpu_used is not None and stats["steps"]:
+        cpu_per_step = (cpu_used - cpu_started) / stats["steps"]
+    return dict(stats, steps_per_second=stats["steps"] / elapsed, cpu_per_step=cpu_per_step,
+                p50=_percentile(latencies, 0.50), p95=_percentile(latencies, 0.95))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="診断の REST と WebSocket のステップ数/秒の比較")
+    parser.add_argument("--users", type=int, default=50, help="同時に診断する利用者数")
+    parser.add_argument("--duration", type=float, default=20, help="計測時間（秒）")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        print(f"同時利用者: {args.users}  計測時間: {args.duration:.0f}秒  "
+              f"保存方式: {os.getenv('CONSULTATION_PERSISTENCE', 'immediate')}")
+        print(f"{'方式':<10} {'ステップ':>8} {'steps/s':>9} {'CPU(ms)':>9} {'p50(ms)':>9} {'p95(ms)':>9} "
+              f"{'完了':>6} {'エラー':>6}")
+        for mode in args.modes:
+            database_url = os.getenv("DATABASE_URL") or f"sqlite:///{os.path.join(workdir, mode + '.db')}"
+            with running_server(DATABASE_URL=database_url) as (port, server):
+                result = asyncio.run(_drive(mode, port, server.pid, args.users, args.duration, args.seed))
+            cpu = f"{result['cpu_per_step'] * 1000:.2f}" if result["cpu_per_step"] is not None else "-"
+            print(f"{mode:<10} {result['steps']:>8} {result['steps_per_second']:>9.1f} {cpu:>9} "
+                  f"{result['p50'] * 1000:>9.1f} {result['p95'] * 1000:>9.1f} "
+                  f"{result['completed']:>6} {result['errors']:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+循環参照検出のベンチマーク - RuleValidator.detect_circular_references（強連結成分）の実行時間
+
+辺の数（条件 + 結論）が --edges 程度の合成したルールベースで循環参照を検出する。
+- dag: 層ごとに、前の層の事実2つ → 次の層の事実1つ のルール（共通の部分目標が多く、循環はない）
+- random: ランダムな事実2つ → 事実1つ のルール（大きな循環がいくつもできる）
+- ring: 事実を1列につなぎ、最後の事実から最初の事実へ戻るルール（全体で1つの長い循環）
+あわせて IncrementalRuleValidator の構築時間と、ルール1件の変更の検証時間も表示する。
+
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.cycle_detection --edges 100000
+"""
+
+import argparse
+import random
+import time
+from typing import Callable, Dict, List
+
+from app.services.inference_engine import Rule
+from app.services.rule_validator import IncrementalRuleValidator, RuleValidator
+
+EDGES_PER_RULE = 3  # 条件2つ + 結論1つ（ring は条件1つ + 結論1つ）
+
+
+def _rule(rule_id: int, conditions: List[str], fact: str) -> Rule:
+    return Rule(
+        id=rule_id, name=f"rule-{rule_id}", visa_type="V", rule_type="#n",
+        conditions=[{"fact": cond} for cond in conditions], actions=[{"fact": fact, "value": True}], flag=True
+    )
+
+
+def layered_dag(edges: int, rng: random.Random, width: int = 200) -> List[Rule]:
+    rules = []
+    for i in range(edges // EDGES_PER_RULE):
+        layer = i // width
+        conditions = [f"fact_{layer}_{j}" for j in rng.sample(range(width), 2)]
+        rules.append(_rule(i + 1, conditions, f"fact_{layer + 1}_{rng.randrange(width)}"))
+    return rules
+
+
+def random_graph(edges: int, rng: random.Random) -> List[Rule]:
+    count = edges // EDGES_PER_RULE
+    facts = [f"fact_{i}" for i in range(count)]
+    return [_rule(i + 1, rng.sample(facts, 2), rng.choice(facts)) for i in range(count)]
+
+
+def ring(edges: int, rng: random.Random) -> List[Rule]:
+    count = edges // 2
+    return [_rule(i + 1, [f"fact_{i}"], f"fact_{(i + 1) % count}") for i in range(count)]
+
+
+GRAPHS: Dict[str, Callable[[int, random.Random], List[Rule]]] = {
+    "dag": layered_dag,
+    "random": random_graph,
+    "ring": ring,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="循環参照検出（強連結成分）の実行時間")
+    parser.add_argument("--edges", type=int, default=100000, help="辺の数（条件 + 結論）")
+    parser.add_argument("--graphs", nargs="+", choices=list(GRAPHS), default=list(GRAPHS))
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'グラフ':<8} {'ルール':>8} {'辺':>8} {'循環':>6} {'最大の循環(事実)':>16} "
+          f"{'検出(ms)':>10} {'差分構築(ms)':>12} {'変更(ms)':>10}")
+    for name in args.graphs:
+        rng = random.Random(args.seed)
+        rules = GRAPHS[name](args.edges, rng)
+        edges = sum(len(rule.conditions) + len(rule.actions) for rule in rules)
+
+        started = time.perf_counter()
+        cycles = RuleValidator(rules).detect_circular_references()
+        detect = time.perf_counter() - started
+
+        started = time.perf_counter()
+        validator = IncrementalRuleValidator(rules)
+        build = time.perf_counter() - started
+
+        # ランダムなルールの条件を別のルールの結論に付け替える
+        rule = rng.choice(rules)
+        edited = Rule(id=rule.id, name=rule.name, visa_type=rule.visa_type, rule_type=rule.rule_type,
+                      conditions=[{"fact": rng.choice(rules).actions[0]["fact"]}], actions=rule.actions, flag=True)
+        started = time.perf_counter()
+        validator.validate_change(edited.id, edited)
+        edit = time.perf_counter() - started
+
+        largest = max((len(cycle["facts"]) for cycle in cycles), default=0)
+        print(f"{name:<8} {len(rules):>8} {edges:>8} {len(cycles):>6} {largest:>16} "
+              f"{detect * 1000:>10.1f} {build * 1000:>12.1f} {edit * 1000:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
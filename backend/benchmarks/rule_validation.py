@@ -0,0 +1,97 @@
+"""
+ルール整合性チェックのベンチマーク - ルール1件の変更の検証時間（全体の再検証と差分検証の比較）
+
+合成したルールベース（ビザの系統ごとに 基本事実 → 中間の事実 → 判定 の3層、系統をまたぐ共通の事実あり）で、
+ランダムに選んだルールの変更（条件の追加・結論の値の反転・有効/無効の切り替え）を検証する。
+- full: 変更後のルールベースで RuleValidator を作り直して validate_all（これまでの管理APIと同じ）
+- incremental: IncrementalRuleValidator.validate_change（影響する範囲だけを検証し直す）
+
+使い方（backend ディレクトリで実行）:
+    python -m benchmarks.rule_validation --rules 10000 --edits 200
+"""
+
+import argparse
+import random
+import time
+from typing import List
+
+from app.services.inference_engine import Rule
+from app.services.rule_validator import IncrementalRuleValidator, RuleValidator
+
+from benchmarks.consultation_concurrency import _percentile
+
+RULES_PER_FAMILY = 10
+SHARED_FACTS = 50
+
+
+def synthetic_rules(count: int, rng: random.Random) -> List[Rule]:
+    """系統ごとに 基本事実×2〜3 → 中間の事実（5ルール）、中間の事実×2 → 判定（5ルール）のルールベース"""
+    rules = []
+    for family in range(count // RULES_PER_FAMILY):
+        basics = [f"basic_{family}_{i}" for i in range(10)]
+        intermediates = [f"mid_{family}_{i}" for i in range(5)]
+        for fact in intermediates:
+            conditions = rng.sample(basics, rng.randint(2, 3))
+            if rng.random() < 0.3:
+                conditions.append(f"shared_{rng.randrange(SHARED_FACTS)}")
+            rules.append(_rule(len(rules) + 1, family, conditions, fact, True))
+        for i in range(5):
+            rules.append(_rule(len(rules) + 1, family, rng.sample(intermediates, 2), f"goal_{family}", i % 2 == 0))
+    return rules
+
+
+def _rule(rule_id: int, family: int, conditions: List[str], fact: str, value) -> Rule:
+    return Rule(
+        id=rule_id, name=f"rule-{rule_id}", visa_type=f"V{family}", rule_type="#n",
+        conditions=[{"fact": cond} for cond in conditions], actions=[{"fact": fact, "value": value}], flag=True
+    )
+
+
+def edited_rule(rule: Rule, rules: List[Rule], rng: random.Random) -> Rule:
+    """ランダムな変更（別のルールの条件を付け足す・結論の値を変える・有効/無効を切り替える）"""
+    choice = rng.randrange(3)
+    conditions, actions, flag = list(rule.conditions), [dict(action) for action in rule.actions], rule.flag
+    if choice == 0:
+        conditions.append(rng.choice(rng.choice(rules).conditions))
+    elif choice == 1:
+        actions[0]["value"] = not actions[0].get("value", True)
+    else:
+        flag = not flag
+    return Rule(id=rule.id, name=rule.name, visa_type=rule.visa_type, rule_type=rule.rule_type,
+                conditions=conditions, actions=actions, flag=flag)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ルール1件の変更の検証時間（全体の再検証と差分検証）")
+    parser.add_argument("--rules", type=int, default=10000, help="ルール数")
+    parser.add_argument("--edits", type=int, default=200, help="検証する変更の数（差分検証）")
+    parser.add_argument("--full-edits", type=int, default=5, help="検証する変更の数（全体の再検証）")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    rules = synthetic_rules(args.rules, rng)
+    edits = [edited_rule(rule, rules, rng) for rule in rng.choices(rules, k=max(args.edits, args.full_edits))]
+    print(f"ルール数: {len(rules)}")
+
+    started = time.perf_counter()
+    validator = IncrementalRuleValidator(rules)
+    print(f"差分検証の構築: {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    print(f"{'方式':<12} {'変更':>6} {'p50(ms)':>10} {'p95(ms)':>10} {'max(ms)':>10}")
+    by_id = {rule.id: rule for rule in rules}
+    for mode, count in (("full", args.full_edits), ("incremental", args.edits)):
+        timings = []
+        for edit in edits[:count]:
+            started = time.perf_counter()
+            if mode == "full":
+                RuleValidator(list({**by_id, edit.id: edit}.values())).validate_all()
+            else:
+                validator.validate_change(edit.id, edit)
+            timings.append(time.perf_counter() - started)
+        print(f"{mode:<12} {count:>6} {_percentile(timings, 0.5) * 1000:>10.2f} "
+              f"{_percentile(timings, 0.95) * 1000:>10.2f} {max(timings) * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+テスト共通の設定
+app.main を読み込む前に、DB を一時ディレクトリの SQLite ファイルに向ける
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+_DB_DIR = tempfile.mkdtemp(prefix="visa-expert-test-")
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_DB_DIR, 'test.db')}"
+os.environ.pop("QUESTION_TABLE_DIR", None)
+
+from app.services.inference_engine import InferenceEngine, Rule  # noqa: E402
+from app.services.visa_rules import VISA_RULES  # noqa: E402
+
+
+def working_memory_state(wm) -> dict:
+    """作業記憶の比較用の辞書（集合は順序を持たないため並べ替える）"""
+    state = wm.to_dict()
+    state["skipped_facts"] = sorted(state["skipped_facts"])
+    state["asked_derivable_facts"] = sorted(state["asked_derivable_facts"])
+    state["findings"] = list(state["findings"].items())
+    state["hypotheses"] = list(state["hypotheses"].items())
+    return state
+
+
+@pytest.fixture(scope="session")
+def visa_rules():
+    return [Rule.from_dict(rule) for rule in VISA_RULES]
+
+
+@pytest.fixture(scope="session")
+def engine(visa_rules):
+    return InferenceEngine(visa_rules)
+
+
+@pytest.fixture(scope="session")
+def client():
+    from fastapi.testclient import TestClient
+    from app.main import app
+    with TestClient(app) as test_client:
+        yield test_client
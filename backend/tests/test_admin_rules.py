@@ -0,0 +1,53 @@
+"""
+管理APIのルール作成のテスト - 整合性チェックがDBの振ったルールIDで行われる
+"""
+
+from app.database.config import SessionLocal
+from app.services.rulebase_store import insert_rule
+
+BASE_RULE = {
+    "name": "テスト用ルール",
+    "visa_type": "E",
+    "rule_type": "#n",
+    "conditions": [{"fact": "テスト用の条件", "operator": "AND"}],
+    "actions": [{"fact": "テスト用の結論", "value": True}],
+    "flag": True,
+    "priority": 5,
+}
+# BASE_RULE と同じ条件で結論の値が異なる（矛盾する）ルール
+CONTRADICTING_RULE = dict(BASE_RULE, name="矛盾するルール", actions=[{"fact": "テスト用の結論", "value": False}])
+
+
+def insert_elsewhere(rule: dict) -> dict:
+    """別のワーカーが追加したルール（このワーカーのルールベースにはまだ読み込んでいない）"""
+    db = SessionLocal()
+    try:
+        row = insert_rule(db, rule)
+        db.commit()
+        return row
+    finally:
+        db.close()
+
+
+def test_create_rule_validates_with_assigned_id(client):
+    base = client.post("/api/admin/rules", json=BASE_RULE).json()["rule"]
+    other = insert_elsewhere(dict(BASE_RULE, name="別のワーカーのルール", conditions=[{"fact": "別の条件"}]))
+
+    response = client.post("/api/admin/rules", json=CONTRADICTING_RULE)
+    assert response.status_code == 200, response.text
+    created = response.json()["rule"]
+    assert created["id"] == other["id"] + 1
+
+    contradictions = response.json()["validation"]["contradictions"]
+    assert [issue["rule_ids"] for issue in contradictions if issue["fact"] == "テスト用の結論"] == \
+        [[base["id"], created["id"]]]
+
+    # 次の管理APIの呼び出しでルールベースに合わせた状態も、実際のIDで持つ
+    assert client.get("/api/admin/rules/validation/check").status_code == 200
+    validator = client.app.state.rule_validator
+    assert validator.rules[created["id"]].name == CONTRADICTING_RULE["name"]
+    assert validator.rules[other["id"]].name == "別のワーカーのルール"
+
+    for rule_id in (created["id"], other["id"], base["id"]):
+        assert client.delete(f"/api/admin/rules/{rule_id}").status_code == 200
+        assert rule_id not in validator.rules
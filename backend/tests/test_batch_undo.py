@@ -0,0 +1,45 @@
+"""
+一括回答の途中までの「戻る」のテスト
+一括回答の一部を取り消した作業記憶が、残った回答だけを一括回答し直した作業記憶と一致することを確かめる
+"""
+
+import random
+
+import pytest
+
+
+def start(client, visa_types):
+    response = client.post("/api/consultation/start", json={"visa_types": visa_types})
+    assert response.status_code == 200, response.text
+    return response.json()["session_id"]
+
+
+def working_memory(client, session_id):
+    response = client.get(f"/api/consultation/{session_id}/working-memory")
+    assert response.status_code == 200, response.text
+    return response.json()
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_partial_batch_undo_matches_replay(client, engine, seed):
+    """一括回答の途中まで戻した作業記憶は、残った回答だけを一括回答した作業記憶と一致する"""
+    rng = random.Random(seed)
+    basic_facts = [fact for fact in engine.fact_table.facts if engine.is_basic_fact(fact)]
+    answers = [{"fact": fact, "answer": rng.choice(["yes", "no", "unknown"])}
+               for fact in rng.sample(basic_facts, 8)]
+
+    session_id = start(client, ["E", "B", "L"])
+    response = client.post("/api/consultation/answers:batch", json={"session_id": session_id, "answers": answers})
+    assert response.status_code == 200, response.text
+
+    kept = rng.randint(0, len(answers) - 1)
+    for _ in range(len(answers) - kept):
+        response = client.post("/api/consultation/undo", json={"session_id": session_id})
+        assert response.status_code == 200, response.text
+
+    replayed = start(client, ["E", "B", "L"])
+    if kept:
+        response = client.post("/api/consultation/answers:batch",
+                               json={"session_id": replayed, "answers": answers[:kept]})
+        assert response.status_code == 200, response.text
+    assert working_memory(client, session_id) == working_memory(client, replayed)
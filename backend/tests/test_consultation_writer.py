@@ -0,0 +1,91 @@
+"""
+遅延書き込み（write-behind）のテスト
+- やり直しても保存できないバッチは1件ずつ保存し直し、不正な保存内容（と同じセッションのそれ以降）だけを捨てる
+- 作成を保存できなかったセッションへの保存内容はエラーにする
+- on_full=drop でもセッション作成は捨てずに待つ
+"""
+
+import asyncio
+import uuid
+
+import pytest
+from sqlalchemy import select
+
+from app.database.config import Base, SessionLocal, engine as db_engine
+from app.models import models
+from app.services.consultation_writer import DURABILITY_NONE, ON_FULL_DROP, WriteBehindPersistence
+
+BAD_MEMORY = {"no_such_column": 1}  # 存在しない列の更新（この保存内容だけが失敗する）
+
+
+@pytest.fixture(scope="module", autouse=True)
+def tables():
+    Base.metadata.create_all(bind=db_engine)
+
+
+def saved_answers(session_id):
+    with SessionLocal() as db:
+        session = db.execute(
+            select(models.ConsultationSession).where(models.ConsultationSession.session_id == session_id)
+        ).scalar_one_or_none()
+        if session is None:
+            return None
+        return [answer.fact_name for answer in sorted(session.answers, key=lambda answer: answer.question_order)]
+
+
+def test_failed_event_is_isolated():
+    writer = WriteBehindPersistence(SessionLocal, durability=DURABILITY_NONE, max_retries=0)
+    good, bad = str(uuid.uuid4()), str(uuid.uuid4())
+
+    async def enqueue():
+        for session_id in (good, bad):
+            await writer.create_session(session_id, ["E"])
+        await writer.save_answers(good, [("事実1", "yes")], {})
+        await writer.save_answers(bad, [("事実1", "yes")], {})
+        await writer.save_answers(bad, [("事実2", "yes")], BAD_MEMORY)
+        await writer.save_answers(good, [("事実2", "no")], {})
+        await writer.save_answers(bad, [("事実3", "yes")], {})
+
+    asyncio.run(enqueue())
+    writer.write_pending()
+
+    assert saved_answers(good) == ["事実1", "事実2"]
+    # 不正な保存内容と、同じセッションのそれ以降の保存内容だけを捨てる
+    assert saved_answers(bad) == ["事実1"]
+    assert writer.failed_events == 2
+    assert writer.written_events == 5
+
+
+def test_events_for_unsaved_session_fail():
+    writer = WriteBehindPersistence(SessionLocal, durability=DURABILITY_NONE, max_retries=0)
+    session_id = str(uuid.uuid4())
+
+    asyncio.run(writer.create_session(session_id, [object()]))  # JSON にできない
+    writer.write_pending()
+    assert writer.failed_events == 1 and writer.stats()["unsaved_sessions"] == 1
+
+    asyncio.run(writer.save_answers(session_id, [("事実1", "yes")], {}))
+    writer.write_pending()
+    assert writer.failed_events == 2
+    assert saved_answers(session_id) is None
+
+
+def test_drop_waits_for_session_create():
+    writer = WriteBehindPersistence(SessionLocal, queue_size=1, durability=DURABILITY_NONE, on_full=ON_FULL_DROP)
+    session_id = str(uuid.uuid4())
+
+    async def scenario():
+        await writer.save_answers(session_id, [("事実1", "yes")], {})  # キューが一杯になる
+        await writer.save_answers(session_id, [("事実2", "yes")], {})
+        assert writer.dropped_events == 1
+
+        create = asyncio.ensure_future(writer.create_session(session_id, ["E"]))
+        await asyncio.sleep(0.05)
+        assert not create.done()
+        await asyncio.get_running_loop().run_in_executor(None, writer.write_pending)
+        await asyncio.wait_for(create, 1)
+
+    asyncio.run(scenario())
+    writer.write_pending()
+    assert writer.dropped_events == 1
+    assert saved_answers(session_id) == []
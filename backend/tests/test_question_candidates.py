@@ -0,0 +1,47 @@
+"""
+質問候補のテスト - 成立済みのORグループの残りのメンバーは質問しない
+"""
+
+import pytest
+
+from app.services.inference_engine import AnswerType, InferenceEngine, Rule
+
+GOAL = "ゴール"
+
+
+@pytest.fixture
+def mixed_engine():
+    """A AND (B OR C) → ゴール、B は D から導出できる"""
+    return InferenceEngine([
+        Rule(id=1, name=GOAL, visa_type="V", rule_type="#i", flag=True,
+             conditions=[{"fact": "A"}, {"fact": "B", "operator": "OR"}, {"fact": "C", "operator": "OR"}],
+             actions=[{"fact": GOAL, "value": True}]),
+        Rule(id=2, name="B", visa_type="V", rule_type="#n", flag=True,
+             conditions=[{"fact": "D"}], actions=[{"fact": "B", "value": True}]),
+    ])
+
+
+def candidates(engine, wm):
+    return set(engine.fact_table.facts_of(engine.get_question_candidates([GOAL], wm)[0]))
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_satisfied_or_group_is_pruned(mixed_engine, compact):
+    wm = mixed_engine.create_working_memory(compact=compact)
+    assert candidates(mixed_engine, wm) == {"A", "B", "C", "D"}
+
+    mixed_engine.process_answer("C", AnswerType.YES, wm)
+    assert candidates(mixed_engine, wm) == {"A"}
+    assert mixed_engine.get_next_question([GOAL], wm) == "A"
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_false_member_keeps_siblings(mixed_engine, compact):
+    wm = mixed_engine.create_working_memory(compact=compact)
+    mixed_engine.process_answer("C", AnswerType.NO, wm)
+    assert candidates(mixed_engine, wm) == {"A", "B", "D"}
+
+    # 導出した事実で成立した場合も同じ
+    mixed_engine.process_answer("D", AnswerType.YES, wm)
+    assert wm.hypotheses.get("B") is True
+    assert candidates(mixed_engine, wm) == {"A"}
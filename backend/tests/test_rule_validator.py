@@ -0,0 +1,122 @@
+"""
+IncrementalRuleValidator のテスト
+ランダムなルールの追加・変更・削除（削除したルールの追加し直しを含む）のたびに、
+ID順のルールで作り直した RuleValidator の結果と一致することを確かめる
+"""
+
+import json
+import random
+
+import pytest
+
+from app.services.inference_engine import Rule
+from app.services.rule_validator import IncrementalRuleValidator, RuleValidator
+
+FACTS = [f"fact_{i}" for i in range(14)]
+
+
+def random_rule(rule_id: int, rng: random.Random) -> Rule:
+    """少ない事実で作るため、矛盾・循環・到達不可能・孤立した事実がどれも起きる"""
+    return Rule(
+        id=rule_id, name=f"rule-{rule_id}", visa_type="V", rule_type="#n",
+        conditions=[{"fact": fact} for fact in rng.sample(FACTS, rng.randint(1, 3))],
+        actions=[{"fact": rng.choice(FACTS), "value": rng.random() < 0.7}],
+        flag=rng.random() < 0.85
+    )
+
+
+def full_results(rules: dict) -> dict:
+    return RuleValidator([rules[rule_id] for rule_id in sorted(rules)]).validate_all()
+
+
+def canonical(results: dict) -> dict:
+    """矛盾・孤立した事実は並び順が決まっていないため、内容の集合として比べる"""
+    results = dict(results)
+    for category in ("contradictions", "orphaned_facts"):
+        results[category] = sorted(json.dumps(issue, ensure_ascii=False, sort_keys=True)
+                                   for issue in results[category])
+    return results
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_matches_full_validation(seed):
+    rng = random.Random(seed)
+    rules = {rule_id: random_rule(rule_id, rng) for rule_id in range(1, 25)}
+    validator = IncrementalRuleValidator(rules[rule_id] for rule_id in rng.sample(sorted(rules), len(rules)))
+    removed = {}
+    next_id = len(rules) + 1
+
+    for _ in range(150):
+        choice = rng.random()
+        if choice < 0.15 and removed:
+            # 削除したルールを同じIDで追加し直す
+            rule = removed.pop(rng.choice(sorted(removed)))
+            rule_id = rule.id
+        elif choice < 0.3 and len(rules) > 1:
+            rule_id, rule = rng.choice(sorted(rules)), None
+        elif choice < 0.4:
+            rule_id, rule = next_id, random_rule(next_id, rng)
+            next_id += 1
+        else:
+            rule_id = rng.choice(sorted(rules))
+            rule = random_rule(rule_id, rng)
+
+        edited = dict(rules)
+        if rule is None:
+            removed[rule_id] = edited.pop(rule_id)
+        else:
+            edited[rule_id] = rule
+        expected = full_results(edited)
+
+        # 検証だけでは保持している状態を変えない
+        before = validator.validate_all()
+        assert canonical(validator.validate_change(rule_id, rule)) == canonical(expected)
+        assert validator.validate_all() == before
+
+        validator.apply(rule_id, rule)
+        rules = edited
+        results = validator.validate_all()
+        assert canonical(results) == canonical(expected)
+        # 循環参照は並び順・代表の循環まで一致する
+        assert results["circular_references"] == expected["circular_references"]
+        assert results["unreachable_rules"] == expected["unreachable_rules"]
+
+
+def test_results_do_not_depend_on_edit_history():
+    """同じ内容のルールベースなら、変更の順序によらず同じ結果になる"""
+    rng = random.Random(42)
+    rules = [random_rule(rule_id, rng) for rule_id in range(1, 40)]
+    validator = IncrementalRuleValidator(rules)
+    before = validator.validate_all()
+
+    for rule in rng.sample(rules, 15):
+        validator.apply(rule.id, None)
+    for rule in rng.sample(rules, len(rules)):
+        validator.apply(rule.id, rule)
+
+    assert validator.validate_all() == before
+    assert before == IncrementalRuleValidator(reversed(rules)).validate_all()
+
+
+def test_sync_follows_rule_base():
+    rng = random.Random(7)
+    rules = {rule_id: random_rule(rule_id, rng) for rule_id in range(1, 30)}
+    validator = IncrementalRuleValidator()
+    validator.sync(rules.values(), version=1)
+    assert canonical(validator.validate_all()) == canonical(full_results(rules))
+
+    for rule_id in rng.sample(sorted(rules), 5):
+        rules[rule_id] = random_rule(rule_id, rng)
+    del rules[rng.choice(sorted(rules))]
+    validator.sync(rules.values(), version=2)
+    assert validator.version == 2
+    assert canonical(validator.validate_all()) == canonical(full_results(rules))
+
+    # 版が1つ進んだ変更だけを反映する（飛んだ版は次の sync で合わせる）
+    rule_id = max(rules) + 1
+    rules[rule_id] = random_rule(rule_id, rng)
+    validator.apply_change(rule_id, rules[rule_id], 3)
+    assert validator.version == 3
+    assert canonical(validator.validate_all()) == canonical(full_results(rules))
+    validator.apply_change(rule_id, None, 5)
+    assert validator.version == 3 and rule_id in validator.rules
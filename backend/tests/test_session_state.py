@@ -0,0 +1,102 @@
+"""
+セッション状態の差分のテスト
+- 回答・一括回答・戻るの差分を順に適用した状態が、サーバーの全体と一致する
+- 変更履歴は、クライアントが状態を求めるまで作らない
+"""
+
+import random
+
+import pytest
+
+from app.services.inference_engine import AnswerType
+from app.services.session_state import capture_state, trail_delta
+from app.services.visa_rules import VISA_GOALS
+
+
+def apply_state(client_state, state):
+    """クライアント側で差分（または全体）を適用する"""
+    if state["full"]:
+        return {key: state[key] for key in ("version", "rule_statuses", "findings", "hypotheses", "conflict_set")}
+    client_state = dict(client_state, version=state["version"])
+    for name in ("findings", "hypotheses"):
+        values = dict(client_state[name], **state[name])
+        for fact in state["removed_" + name]:
+            values.pop(fact, None)
+        client_state[name] = values
+    client_state["rule_statuses"] = dict(client_state["rule_statuses"], **state["rule_statuses"])
+    if state["conflict_set"] is not None:
+        client_state["conflict_set"] = state["conflict_set"]
+    return client_state
+
+
+def full_state(client, session_id):
+    response = client.get(f"/api/consultation/{session_id}/state")
+    assert response.status_code == 200, response.text
+    return apply_state(None, response.json())
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_deltas_match_full_state(client, engine, seed):
+    rng = random.Random(seed)
+    basic_facts = [fact for fact in engine.fact_table.facts if engine.is_basic_fact(fact)]
+    response = client.post("/api/consultation/start", json={"visa_types": ["E", "B", "L"], "include_state": True})
+    assert response.status_code == 200, response.text
+    session_id, next_question = response.json()["session_id"], response.json()["next_question"]
+    client_state = apply_state(None, response.json()["state"])
+
+    for _ in range(15):
+        body = {"session_id": session_id, "include_state": True, "state_version": client_state["version"]}
+        kind = rng.random()
+        if kind < 0.25:
+            response = client.post("/api/consultation/undo", json=body)
+        elif kind < 0.4:
+            answers = [{"fact": fact, "answer": rng.choice(["yes", "no", "unknown"])}
+                       for fact in rng.sample(basic_facts, 3)]
+            response = client.post("/api/consultation/answers:batch", json=dict(body, answers=answers))
+        elif next_question is not None:
+            response = client.post("/api/consultation/answer", json=dict(
+                body, fact=next_question, answer=rng.choice(["yes", "no", "unknown"])
+            ))
+        else:
+            continue
+        assert response.status_code == 200, response.text
+        state = response.json()["state"]
+        assert not state["full"]
+        next_question = response.json()["next_question"]
+        client_state = apply_state(client_state, state)
+        assert client_state == full_state(client, session_id)
+
+
+def test_trail_delta_ignores_reverted_changes(engine):
+    """ステップ内で変わって元に戻った項目は差分に含めない"""
+    wm = engine.create_working_memory(compact=True)
+    fact = engine.get_next_question(VISA_GOALS, wm)
+    before = capture_state(wm)
+    with wm.journal() as trail:
+        engine.process_answer(fact, AnswerType.YES, wm)
+    with wm.journal() as undo_trail:
+        wm.rollback(trail)
+
+    assert capture_state(wm) == before
+    delta = trail_delta([trail, undo_trail], wm, 1)
+    assert delta["rule_statuses"] == {} and delta["findings"] == {} and delta["removed_findings"] == []
+    assert delta["hypotheses"] == {} and delta["removed_hypotheses"] == [] and delta["conflict_set"] is None
+
+
+def test_state_log_created_on_demand(client):
+    from app.main import sessions
+
+    response = client.post("/api/consultation/start", json={"visa_types": ["E"]})
+    session_id, next_question = response.json()["session_id"], response.json()["next_question"]
+    response = client.post("/api/consultation/answer",
+                           json={"session_id": session_id, "fact": next_question, "answer": "yes"})
+    assert response.status_code == 200, response.text
+    assert "state_log" not in sessions.get(session_id)
+
+    # 変更履歴を作る前の版からは全体、以降は差分
+    response = client.get(f"/api/consultation/{session_id}/state", params={"since": 0})
+    assert response.json()["full"] and response.json()["version"] == 1
+    next_question = client.post("/api/consultation/undo", json={"session_id": session_id}).json()["next_question"]
+    response = client.get(f"/api/consultation/{session_id}/state", params={"since": 1})
+    assert not response.json()["full"] and response.json()["version"] == 2
+    assert next_question in response.json()["removed_findings"]
@@ -0,0 +1,83 @@
+"""
+共有セッションストアのテスト
+- 最終アクセスからの期限切れ（SQLite の last_access と sweep、キーバリューストアの有効期限）
+- 書き通しに失敗したセッションをキャッシュに残さない
+"""
+
+import pytest
+
+from app.services.inference_engine import RuleBase
+from app.services.question_selector import QUESTION_SELECTOR_HEURISTIC
+from app.services.session_store import (
+    CachedSessionStore, KeyValueSessionStore, LocalKeyValueClient, SqliteSessionStore
+)
+from app.services.session_token import SessionCodec
+
+SESSION_ID = "00000000-0000-0000-0000-000000000001"
+IDLE_TTL = 100
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+@pytest.fixture(params=["sqlite", "kv"])
+def backend(request, tmp_path, clock, visa_rules):
+    codec = SessionCodec(RuleBase(visa_rules))
+    if request.param == "sqlite":
+        return SqliteSessionStore(str(tmp_path / "sessions.db"), codec, idle_ttl=IDLE_TTL, clock=clock)
+    return KeyValueSessionStore(LocalKeyValueClient(clock), codec, idle_ttl=IDLE_TTL)
+
+
+def new_session(engine):
+    return {
+        "goals": ["Eビザでの申請ができます"],
+        "question_selector": QUESTION_SELECTOR_HEURISTIC,
+        "question_node": None,
+        "wm": engine.create_working_memory(compact=True),
+        "answer_history": [],
+    }
+
+
+def test_idle_sessions_expire(backend, clock, engine):
+    store = CachedSessionStore(backend)
+    store.put(SESSION_ID, new_session(engine))
+
+    # 読むたびに期限が延びる
+    for _ in range(3):
+        clock.now += IDLE_TTL * 0.6
+        assert store.get(SESSION_ID) is not None
+    clock.now += IDLE_TTL + 1
+    assert store.get(SESSION_ID) is None
+
+    store.sweep()
+    expected = [SESSION_ID] if isinstance(backend, SqliteSessionStore) else []
+    assert store.drain_evicted() == expected
+    assert store.drain_evicted() == []
+
+
+def test_failed_write_is_not_cached(backend, engine, monkeypatch):
+    store = CachedSessionStore(backend)
+    store.put(SESSION_ID, new_session(engine))
+    session = store.get(SESSION_ID)
+
+    def fail(*args):
+        raise RuntimeError("ストアに書き込めません")
+
+    monkeypatch.setattr(backend, "_write", fail)
+    session["answer_history"].append({"fact": "申請者と会社の国籍が同じです", "answer": "yes", "batch_id": None})
+    with pytest.raises(RuntimeError):
+        store.put(SESSION_ID, session)
+    monkeypatch.undo()
+
+    assert store.get(SESSION_ID)["answer_history"] == []
+
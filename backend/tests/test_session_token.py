@@ -0,0 +1,158 @@
+"""
+セッショントークンのテスト
+- 符号化して復元したセッションが元と一致する
+- 改ざん・別の署名鍵・ルールベースの変更を検出する
+- 有効期限が切れたトークン・発行時刻が未来のトークンを受け付けない
+"""
+
+import base64
+import random
+import uuid
+
+import pytest
+
+from app.services.inference_engine import AnswerType, RuleBase
+from app.services.question_selector import QUESTION_SELECTORS
+from app.services.session_token import (
+    CLOCK_SKEW, InvalidSessionToken, SessionTokenCodec, SessionTokenExpired, SessionTokenMismatch
+)
+
+from conftest import working_memory_state
+
+GOALS = ["Eビザでの申請ができます", "Bビザの申請ができます"]
+SECRET = b"test-secret"
+NOW = 1_800_000_000
+
+
+class FakeClock:
+    def __init__(self, now: float = NOW):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture(scope="module")
+def codec(visa_rules):
+    return SessionTokenCodec(RuleBase(visa_rules), SECRET)
+
+
+def build_session(engine, seed):
+    """回答を進めたセッション（一括回答・事実表にない事実・詳細質問待ちを含む）"""
+    rng = random.Random(seed)
+    wm = engine.create_working_memory(compact=True)
+    answer_history = []
+    for i in range(rng.randint(1, 12)):
+        fact = engine.get_next_question(GOALS, wm)
+        if fact is None:
+            break
+        answer = rng.choice([AnswerType.YES, AnswerType.NO, AnswerType.UNKNOWN])
+        engine.process_answer(fact, answer, wm)
+        batch_id = None if rng.random() < 0.7 else len(answer_history) - len(answer_history) % 3
+        answer_history.append({"fact": fact, "answer": answer.value, "batch_id": batch_id})
+    # 事実表にない事実（APIから直接回答された事実）
+    engine.process_answer("ルールにない事実", AnswerType.YES, wm)
+    answer_history.append({"fact": "ルールにない事実", "answer": "yes", "batch_id": None})
+    return {
+        "goals": list(GOALS),
+        "question_selector": rng.choice(QUESTION_SELECTORS),
+        "question_node": rng.choice([None, rng.randrange(100)]),
+        "wm": wm,
+        "answer_history": answer_history,
+        "state_version": rng.randrange(1000),
+    }
+
+
+def raw_bytes(token: str) -> bytes:
+    return base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+
+
+def to_token(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def normalized_history(answer_history):
+    """一括回答の ID は復元時に先頭の位置で振り直すため、一括回答かどうかと直前と同じ一括回答かどうかを比べる"""
+    return [(entry["fact"], entry["answer"], entry["batch_id"] is None,
+             i > 0 and entry["batch_id"] is not None and answer_history[i - 1]["batch_id"] == entry["batch_id"])
+            for i, entry in enumerate(answer_history)]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_round_trip(engine, codec, seed):
+    session = build_session(engine, seed)
+    session_id = str(uuid.uuid4())
+
+    decoded_id, decoded = codec.decode(codec.encode(session_id, session))
+
+    assert decoded_id == session_id
+    for key in ("goals", "question_selector", "question_node", "state_version"):
+        assert decoded[key] == session[key]
+    assert normalized_history(decoded["answer_history"]) == normalized_history(session["answer_history"])
+    # findings / hypotheses の挿入順も含めて一致する
+    assert working_memory_state(decoded["wm"]) == working_memory_state(session["wm"])
+    assert decoded["wm"].evaluated_rules == session["wm"].evaluated_rules
+
+
+def test_rejects_tampered_token(engine, codec):
+    token = codec.encode(str(uuid.uuid4()), build_session(engine, 5))
+    raw = bytearray(raw_bytes(token))
+    # 形式バージョン・fingerprint・本体・発行時刻・有効期限・署名
+    for position in (0, len(codec.header), len(raw) // 2, len(raw) - 24, len(raw) - 20, len(raw) - 1):
+        tampered = bytearray(raw)
+        tampered[position] ^= 0x01
+        with pytest.raises(InvalidSessionToken):
+            codec.decode(to_token(bytes(tampered)))
+    with pytest.raises(InvalidSessionToken):
+        codec.decode(token[:-4])
+    with pytest.raises(InvalidSessionToken):
+        codec.decode("not a token!")
+
+
+def test_rejects_other_secret(engine, codec, visa_rules):
+    token = codec.encode(str(uuid.uuid4()), build_session(engine, 6))
+    other = SessionTokenCodec(RuleBase(visa_rules), b"other-secret")
+    with pytest.raises(InvalidSessionToken):
+        other.decode(token)
+
+
+def test_rejects_changed_rule_base(engine, codec, visa_rules):
+    """署名は正しくても、発行時とルールベースが異なるトークンは SessionTokenMismatch"""
+    token = codec.encode(str(uuid.uuid4()), build_session(engine, 7))
+    changed = SessionTokenCodec(RuleBase(visa_rules[:-1]), SECRET)
+    with pytest.raises(SessionTokenMismatch):
+        changed.decode(token)
+
+
+def test_expires_after_ttl(engine, visa_rules):
+    clock = FakeClock()
+    codec = SessionTokenCodec(RuleBase(visa_rules), SECRET, ttl=600, clock=clock)
+    session_id = str(uuid.uuid4())
+    token = codec.encode(session_id, build_session(engine, 8))
+
+    clock.now = NOW + 600
+    assert codec.decode(token)[0] == session_id
+    clock.now = NOW + 601
+    with pytest.raises(SessionTokenExpired):
+        codec.decode(token)
+
+
+def test_shortened_ttl_applies_to_issued_tokens(engine, visa_rules):
+    """トークンに書かれた期限より、発行時刻から現在の ttl 秒の方が早ければそちらで切れる"""
+    token = SessionTokenCodec(RuleBase(visa_rules), SECRET, ttl=3600, clock=FakeClock()).encode(
+        str(uuid.uuid4()), build_session(engine, 9)
+    )
+    shortened = SessionTokenCodec(RuleBase(visa_rules), SECRET, ttl=60, clock=FakeClock(NOW + 61))
+    with pytest.raises(SessionTokenExpired):
+        shortened.decode(token)
+
+
+def test_rejects_future_issued_at(engine, visa_rules):
+    """発行時刻が時計のずれの許容より未来のトークンは不正"""
+    issuer = SessionTokenCodec(RuleBase(visa_rules), SECRET, clock=FakeClock(NOW + CLOCK_SKEW + 1))
+    token = issuer.encode(str(uuid.uuid4()), build_session(engine, 10))
+    codec = SessionTokenCodec(RuleBase(visa_rules), SECRET, clock=FakeClock())
+    with pytest.raises(InvalidSessionToken):
+        codec.decode(token)
+    codec.clock.now = NOW + 1
+    codec.decode(token)
@@ -0,0 +1,72 @@
+"""
+回答ごとの差分（trail）による取り消しのテスト
+取り消した後の作業記憶が、残った回答を最初から適用し直した作業記憶と一致することを確かめる
+"""
+
+import random
+
+import pytest
+
+from app.services.inference_engine import AnswerType
+
+from conftest import working_memory_state
+
+GOALS = ["Eビザでの申請ができます", "Bビザの申請ができます", "Blanket Lビザでの申請ができます"]
+ANSWERS = [AnswerType.YES, AnswerType.NO, AnswerType.UNKNOWN]
+
+
+def play(engine, answers, compact):
+    wm = engine.create_working_memory(compact=compact)
+    for fact, answer in answers:
+        engine.process_answer(fact, answer, wm)
+    return wm
+
+
+def random_answers(engine, rng, wm, count):
+    """次の質問に答えていく回答列（詳細質問になる「わからない」も含む）"""
+    answers = []
+    for _ in range(count):
+        fact = engine.get_next_question(GOALS, wm)
+        if fact is None:
+            break
+        answer = rng.choice(ANSWERS)
+        engine.process_answer(fact, answer, wm)
+        answers.append((fact, answer))
+    return answers
+
+
+@pytest.mark.parametrize("compact", [False, True])
+@pytest.mark.parametrize("seed", range(20))
+def test_rollback_matches_replay(engine, compact, seed):
+    rng = random.Random(seed)
+    answers = random_answers(engine, rng, engine.create_working_memory(compact=compact), 25)
+
+    wm = engine.create_working_memory(compact=compact)
+    trails = []
+    for fact, answer in answers:
+        with wm.journal() as trail:
+            engine.process_answer(fact, answer, wm)
+        trails.append(trail)
+
+    for undone in range(len(answers), 0, -1):
+        wm.rollback(trails.pop())
+        expected = play(engine, answers[:undone - 1], compact)
+        assert working_memory_state(wm) == working_memory_state(expected)
+        assert wm.evaluated_rules == expected.evaluated_rules
+
+
+@pytest.mark.parametrize("compact", [False, True])
+def test_rollback_can_be_undone(engine, compact):
+    """journal() の間の rollback は取り消しも記録し、その差分で元に戻せる"""
+    rng = random.Random(0)
+    wm = engine.create_working_memory(compact=compact)
+    random_answers(engine, rng, wm, 5)
+    with wm.journal() as trail:
+        random_answers(engine, rng, wm, 5)
+    after = working_memory_state(wm)
+
+    with wm.journal() as undo_trail:
+        wm.rollback(trail)
+    assert working_memory_state(wm) != after
+    wm.rollback(undo_trail)
+    assert working_memory_state(wm) == after
@@ -23,20 +23,26 @@ function DiagnosisApp() {
   const [isLoading, setIsLoading] = useState(false)
   const [detailQuestionsMode, setDetailQuestionsMode] = useState(false)
   const [detailQuestionsContext, setDetailQuestionsContext] = useState(null)
+  const [ruleDefinitions, setRuleDefinitions] = useState(null)
+  const [stateVersion, setStateVersion] = useState(null)  // 最後に反映した状態の版
 
   // 診断開始
   const startDiagnosis = async () => {
     setIsLoading(true)
     try {
-      const response = await fetch(`${API_BASE_URL}/api/consultation/start`, {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-          visa_types: ["E", "B", "L"]  // システムイメージ.txt 行21準拠
-        })
-      })
+      const [response, definitions] = await Promise.all([
+        fetch(`${API_BASE_URL}/api/consultation/start`, {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+          },
+          body: JSON.stringify({
+            visa_types: ["E", "B", "L"],  // システムイメージ.txt 行21準拠
+            include_state: true
+          })
+        }),
+        fetchRuleDefinitions()
+      ])
 
       const data = await response.json()
       setSessionId(data.session_id)
@@ -45,8 +51,8 @@ function DiagnosisApp() {
       setIsCompleted(false)
       setResult(null)
 
-      // ルールと作業記憶を取得
-      await fetchRulesAndMemory(data.session_id)
+      // ルールと作業記憶（全体）を反映
+      applyState(data.state, definitions)
     } catch (error) {
       console.error('診断開始エラー:', error)
       alert('診断を開始できませんでした')
@@ -55,22 +61,56 @@ function DiagnosisApp() {
     }
   }
 
-  // ルールと作業記憶を取得
-  const fetchRulesAndMemory = async (sid) => {
-    try {
-      const [rulesResponse, memoryResponse] = await Promise.all([
-        fetch(`${API_BASE_URL}/api/consultation/${sid}/rules`),
-        fetch(`${API_BASE_URL}/api/consultation/${sid}/working-memory`)
-      ])
+  // ルール定義を取得（診断中は変わらないため最初の1回のみ）
+  const fetchRuleDefinitions = async () => {
+    if (ruleDefinitions) return ruleDefinitions
+    const response = await fetch(`${API_BASE_URL}/api/rules`)
+    const data = await response.json()
+    setRuleDefinitions(data)
+    return data
+  }
 
-      const rulesData = await rulesResponse.json()
-      const memoryData = await memoryResponse.json()
+  // レスポンスに含まれるルール状態と作業記憶を反映（full なら全体を置き換え、それ以外は差分を適用）
+  const applyState = (state, definitions = ruleDefinitions) => {
+    if (!state) return
+    const statuses = state.rule_statuses
 
-      setRules(rulesData)
-      setWorkingMemory(memoryData)
-    } catch (error) {
-      console.error('データ取得エラー:', error)
+    if (state.full) {
+      setRules((definitions || []).map(rule => ({ ...rule, status: statuses[rule.id] || 'not_evaluated' })))
+      setWorkingMemory({
+        findings: state.findings,
+        hypotheses: state.hypotheses,
+        conflict_set: state.conflict_set,
+        evaluated_rules: Object.fromEntries(
+          Object.entries(statuses).filter(([, status]) => status !== 'not_evaluated')
+        )
+      })
+    } else {
+      setRules(prev => prev.map(rule => (
+        rule.id in statuses ? { ...rule, status: statuses[rule.id] } : rule
+      )))
+      setWorkingMemory(prev => {
+        const findings = { ...prev.findings, ...state.findings }
+        state.removed_findings.forEach(fact => delete findings[fact])
+        const hypotheses = { ...prev.hypotheses, ...state.hypotheses }
+        state.removed_hypotheses.forEach(fact => delete hypotheses[fact])
+        const evaluatedRules = { ...prev.evaluated_rules }
+        Object.entries(statuses).forEach(([ruleId, status]) => {
+          if (status === 'not_evaluated') {
+            delete evaluatedRules[ruleId]
+          } else {
+            evaluatedRules[ruleId] = status
+          }
+        })
+        return {
+          findings,
+          hypotheses,
+          conflict_set: state.conflict_set ?? prev.conflict_set,
+          evaluated_rules: evaluatedRules
+        }
+      })
     }
+    setStateVersion(state.version)
   }
 
   // 回答を送信
@@ -87,7 +127,9 @@ function DiagnosisApp() {
         body: JSON.stringify({
           session_id: sessionId,
           fact: currentQuestion,
-          answer: answer
+          answer: answer,
+          include_state: true,
+          state_version: stateVersion
         })
       })
 
@@ -114,8 +156,8 @@ function DiagnosisApp() {
         setResult(data.result)
       }
 
-      // ルールと作業記憶を更新
-      await fetchRulesAndMemory(sessionId)
+      // ルールと作業記憶を更新（変化した分のみ）
+      applyState(data.state)
     } catch (error) {
       console.error('回答送信エラー:', error)
       alert('回答を送信できませんでした')
@@ -137,7 +179,9 @@ function DiagnosisApp() {
           'Content-Type': 'application/json',
         },
         body: JSON.stringify({
-          session_id: sessionId
+          session_id: sessionId,
+          include_state: true,
+          state_version: stateVersion
         })
       })
 
@@ -154,8 +198,8 @@ function DiagnosisApp() {
         setIsCompleted(false)
         setResult(null)
 
-        // ルールと作業記憶を更新
-        await fetchRulesAndMemory(sessionId)
+        // ルールと作業記憶を更新（変化した分のみ）
+        applyState(data.state)
       } else {
         alert(data.message || '前の質問に戻れませんでした')
       }
@@ -174,6 +218,7 @@ function DiagnosisApp() {
     setAnswers([])
     setRules([])
     setWorkingMemory(null)
+    setStateVersion(null)
     setIsCompleted(false)
     setResult(null)
     setDetailQuestionsMode(false)